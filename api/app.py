@@ -1,20 +1,73 @@
+import asyncio
 import os
+import sys
 import time
-from fastapi import FastAPI, HTTPException
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, List, Literal, Optional, Tuple
+from fastapi import FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-import uvicorn
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field, field_validator
+
+from bus import now_in_tz, get_day_type, next_across_all, next_batch, next_buses, shape_item
+from broadcast import broadcaster
+from congestion import STALE_SECS as CONGESTION_STALE_SECS, WINDOWS_MIN, history as congestion_history, sensors as congestion_sensors
+from http_cache import (
+    CompressionMiddleware, FastJSONResponse, dump_json, encode, negotiated_response, pick_media_type,
+    prepare_body, prepared_response,
+)
+import archive
+import forecast
+import gtfs_realtime
+import metrics
+import shared_state
+from timetable_store import store as timetable_store
+
+# Serverless deployments (Vercel sets VERCEL=1) serve requests from short-lived
+# functions: the MQTT subscriber and background refreshers never run there, so
+# the AWS SDKs are never imported. The bike module (and httpx with it) is only
+# imported by the first request that needs it.
+SERVERLESS = os.getenv("SERVERLESS", "1" if os.getenv("VERCEL") else "0") == "1"
+
+_bike_module = None
+_mqtt_module = None
+_mqtt_unavailable = False
+
+
+def _bike():
+    global _bike_module
+    if _bike_module is None:
+        import bike
+
+        bike.add_listener(_publish_bike)
+        bike.add_listener(lambda snapshot: archive.on_bike_snapshot(snapshot, bike.WATCHED_STATION_IDS))
+        _bike_module = bike
+    return _bike_module
 
-from bus_data import TIMETABLE_FROM_SCHOOL, TIMETABLE_TO_SCHOOL
-from bus import now_in_tz, get_day_type, next_across_all, shape_item
-from bike import compute_bike_metrics, compute_bike_metrics_directional
-try:
-    from mqtt_subscriber import start_subscriber, get_latest_object_count
-except Exception:
-    def start_subscriber() -> None:  # type: ignore
-        return None
 
-    def get_latest_object_count() -> int:  # type: ignore
-        return 0
+def _mqtt():
+    global _mqtt_module, _mqtt_unavailable
+    if _mqtt_module is None and not _mqtt_unavailable:
+        if SERVERLESS:
+            _mqtt_unavailable = True
+            return None
+        try:
+            import mqtt_subscriber
+        except Exception as e:
+            print(f"mqtt subscriber unavailable: {e}", file=sys.stderr)
+            _mqtt_unavailable = True
+            return None
+        _mqtt_module = mqtt_subscriber
+    return _mqtt_module
+
+
+def get_connection_stats() -> dict:
+    # Never triggers the import: no subscriber has run if it is not loaded yet.
+    return _mqtt_module.get_connection_stats() if _mqtt_module is not None else {}
+
+
+def get_message_stats() -> dict:
+    return _mqtt_module.get_message_stats() if _mqtt_module is not None else {}
 
 
 def _classify_level(count: int) -> str:
@@ -25,89 +78,563 @@ def _classify_level(count: int) -> str:
     return "high"
 
 
-app = FastAPI()
+STREAM_MIN_INTERVAL = 1.0
+_last_congestion_push = {"level": "", "at": 0.0}
+
+
+def _publish_congestion(count: int, ts: float) -> None:
+    level = _classify_level(count)
+    last = _last_congestion_push
+    if level == last["level"] and ts - last["at"] < STREAM_MIN_INTERVAL:
+        return
+    last["level"] = level
+    last["at"] = ts
+    broadcaster.publish("congestion", {"count": count, "level": level})
+
+
+def _publish_bike(snapshot: dict) -> None:
+    broadcaster.publish("bike", _bike().compute_bike_metrics_directional(snapshot))
+
+
+congestion_history.add_listener(_publish_congestion)
+congestion_history.add_listener(forecast.on_sample)
+congestion_history.add_listener(archive.on_combined_sample)
+congestion_sensors.add_listener(archive.on_sensor_sample)
+
+
+async def _bike_pump() -> None:
+    # Keeps the bike snapshot fresh while someone is listening on /stream,
+    # since push clients no longer poll /bike-direction themselves.
+    while True:
+        await asyncio.sleep(5)
+        if broadcaster.subscriber_count:
+            try:
+                await _bike().get_snapshot()
+            except Exception as e:
+                print(f"bike pump: {e}", file=sys.stderr)
+
+
+STATE_SYNC_INTERVAL = 1.0
+_EMPTY_CONGESTION_VIEW = {"updatedAt": 0.0, "count": 0, "sensors": {}, "windows": {}, "history": {}}
+_subscriber_started = False
+
+
+def _start_leader_duties() -> None:
+    global _subscriber_started
+    if _subscriber_started:
+        return
+    _subscriber_started = True
+    archive.archive.start()
+    mqtt = _mqtt()
+    if mqtt is not None:
+        mqtt.start_subscriber()
+    _bike().refresh_in_background()
+    if gtfs_realtime.enabled():
+        _background_tasks.add(asyncio.get_running_loop().create_task(gtfs_realtime.poll_forever()))
+
+
+async def _state_sync() -> None:
+    # Leader: publish the congestion view for the other workers.
+    # Followers: take over if the leader went away, and relay published
+    # changes to this worker's /stream subscribers.
+    published_at = 0.0
+    seen = {"congestion": 0, "bike": 0}
+    while True:
+        await asyncio.sleep(STATE_SYNC_INTERVAL)
+        try:
+            if shared_state.is_leader():
+                _start_leader_duties()
+                updated_at = congestion_history.latest()[0]
+                if shared_state.is_shared() and updated_at != published_at:
+                    shared_state.publish("congestion", congestion_sensors.view())
+                    published_at = updated_at
+                continue
+            v = shared_state.version("congestion")
+            if v != seen["congestion"]:
+                seen["congestion"] = v
+                count = _congestion_view()["count"]
+                broadcaster.publish("congestion", {"count": count, "level": _classify_level(count)})
+            v = shared_state.version("bike")
+            if v != seen["bike"]:
+                seen["bike"] = v
+                _publish_bike(await _bike().get_snapshot())
+        except Exception as e:
+            print(f"state sync: {e}", file=sys.stderr)
+
+
+def _congestion_stale(updated_at: float, now: float) -> bool:
+    return not updated_at or now - updated_at > CONGESTION_STALE_SECS
+
+
+def _congestion_view() -> Dict:
+    if shared_state.is_leader():
+        return congestion_sensors.view()
+    return shared_state.read("congestion") or _EMPTY_CONGESTION_VIEW
+
+
+app = FastAPI(default_response_class=FastJSONResponse)
+app.add_middleware(CompressionMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(metrics.MetricsMiddleware)
 
 
 @app.get("/congestion")
-def get_congestion():
-    count = get_latest_object_count()
-    level = _classify_level(count)
-    return {"count": count, "level": level}
+def get_congestion(request: Request, window: Optional[int] = None, sensor: Optional[str] = None):
+    view = _congestion_view()
+    name = "*" if sensor is None else sensor
+    if sensor is not None and sensor not in view["sensors"]:
+        raise HTTPException(status_code=404, detail=f"unknown sensor: {sensor}")
+    now = time.time()
+    sensors_updated = view.get("sensorsUpdatedAt", {})
+    count = view["count"] if sensor is None else view["sensors"][sensor]
+    updated_at = view["updatedAt"] if sensor is None else sensors_updated.get(sensor, 0.0)
+    out = {
+        "count": count,
+        "level": _classify_level(count),
+        "updatedAt": updated_at,
+        "stale": _congestion_stale(updated_at, now),
+        "sensors": {
+            s: {
+                "count": c,
+                "level": _classify_level(c),
+                "updatedAt": sensors_updated.get(s, 0.0),
+                "stale": _congestion_stale(sensors_updated.get(s, 0.0), now),
+            }
+            for s, c in view["sensors"].items()
+        },
+    }
+    if sensor is not None:
+        out["sensor"] = sensor
+    if window is not None:
+        stats = view["windows"].get(name, {}).get(str(window))
+        if stats is None:
+            raise HTTPException(status_code=400, detail=f"unsupported window: {window}")
+        mean = stats["mean"]
+        out["level"] = _classify_level(round(mean) if mean is not None else count)
+        out["window"] = stats
+    return negotiated_response(request, out)
 
-@app.get("/timetable/from-school")
-def get_timetable_from_school():
+
+@app.get("/congestion/history")
+def get_congestion_history(window: int = 15, limit: int = Query(500, ge=1, le=5000), sensor: Optional[str] = None):
+    if window not in WINDOWS_MIN:
+        raise HTTPException(status_code=400, detail=f"unsupported window: {window}")
+    if shared_state.is_leader():
+        try:
+            source = congestion_history if sensor is None else congestion_sensors.sensor_history(sensor)
+        except LookupError as e:
+            raise HTTPException(status_code=404, detail=str(e.args[0]))
+        samples = source.samples(window, limit)
+    else:
+        view = _congestion_view()
+        name = "*" if sensor is None else sensor
+        if name not in view["history"]:
+            raise HTTPException(status_code=404, detail=f"unknown sensor: {sensor}")
+        cutoff = time.time() - window * 60
+        samples = [s for s in view["history"][name] if s[0] >= cutoff]
+        step = max(1, -(-len(samples) // limit))
+        samples = samples[::step]
+    return {"windowMinutes": window, "sensor": sensor, "samples": samples}
+
+
+@app.get("/congestion/forecast")
+def get_congestion_forecast(sensor: Optional[str] = None):
+    view = _congestion_view()
+    if sensor is None:
+        count, updated_at = view["count"], view["updatedAt"]
+    elif sensor in view["sensors"]:
+        count, updated_at = view["sensors"][sensor], view.get("sensorsUpdatedAt", {}).get(sensor, 0.0)
+    else:
+        raise HTTPException(status_code=404, detail=f"unknown sensor: {sensor}")
+    out = forecast.latest(count, updated_at)
+    out["stale"] = _congestion_stale(updated_at, time.time())
+    out["sensor"] = sensor
+    return out
+
+
+_timetable_bodies: Dict[Tuple[int, str, str, str, str], Dict] = {}
+
+
+def _timetable_response(request: Request, direction: str) -> Response:
+    timetables = timetable_store.current()
     tz = os.environ.get("TZ", "Asia/Tokyo")
     now = now_in_tz(tz)
     day_type = get_day_type(now)
-    return {
-        "tz": tz,
-        "dayTypeToday": day_type,
-        "lines": list(TIMETABLE_FROM_SCHOOL.keys()),
-        "timetable": TIMETABLE_FROM_SCHOOL,
-    }
+    media_type = pick_media_type(request)
+    key = (timetables.version, direction, tz, day_type, media_type)
+    prepared = _timetable_bodies.get(key)
+    if prepared is None:
+        if any(k[0] != timetables.version for k in _timetable_bodies):
+            _timetable_bodies.clear()
+        timetable = timetables.tables[direction]
+        prepared = prepare_body(encode({
+            "tz": tz,
+            "dayTypeToday": day_type,
+            "lines": list(timetable.keys()),
+            "timetable": timetable,
+        }, media_type))
+        _timetable_bodies[key] = prepared
+    return prepared_response(request, prepared, "public, max-age=300", media_type, "Accept, Accept-Encoding")
+
+
+@app.get("/timetable/from-school")
+def get_timetable_from_school(request: Request):
+    return _timetable_response(request, "from-school")
 
 @app.get("/timetable/to-school")
-def get_timetable_to_school():
+def get_timetable_to_school(request: Request):
+    return _timetable_response(request, "to-school")
+
+
+_next_cache: Dict[Tuple[int, int, str, Optional[str], int, str], bytes] = {}
+_next_cache_minute: Tuple[int, int, str] = (0, 0, "")
+
+
+def _departures(direction: str, timetable: Dict, line: Optional[str], now, count: int) -> List[Dict]:
+    def fetch(since, n):
+        if line is None:
+            return next_across_all(timetable, since, n)
+        return next_buses(timetable, line, since, n)
+
+    upcoming = fetch(now, count)
+    if not gtfs_realtime.enabled():
+        return upcoming
+    # A later departure may overtake a delayed one, so look past the count-th
+    # by the same window delays are tracked over.
+    if upcoming:
+        horizon = upcoming[-1]["datetime"] + timedelta(minutes=gtfs_realtime.LOOKBACK_MIN)
+        upcoming = [it for it in fetch(now, count + 64) if it["datetime"] <= horizon]
+    # Delayed buses may still be coming after their scheduled time.
+    since = now - timedelta(minutes=gtfs_realtime.LOOKBACK_MIN)
+    past = [it for it in fetch(since, 64) if it["datetime"] < now]
+    return gtfs_realtime.merge(direction, past, upcoming, now, count)
+
+
+def _next_response(direction: str, line: Optional[str], count: int) -> Response:
+    global _next_cache_minute
+    timetables = timetable_store.current()
+    timetable = timetables.tables[direction]
+    rt_version = gtfs_realtime.version()
     tz = os.environ.get("TZ", "Asia/Tokyo")
-    now = now_in_tz(tz)
-    day_type = get_day_type(now)
-    return {
-        "tz": tz,
-        "dayTypeToday": day_type,
-        "lines": list(TIMETABLE_TO_SCHOOL.keys()),
-        "timetable": TIMETABLE_TO_SCHOOL,
-    }
+    wall = now_in_tz(tz)
+    now = wall.replace(second=0, microsecond=0)
+    minute = now.isoformat()
+    if (timetables.version, rt_version, minute) != _next_cache_minute:
+        _next_cache.clear()
+        _next_cache_minute = (timetables.version, rt_version, minute)
+    key = (timetables.version, rt_version, direction, line, count, minute)
+    body = _next_cache.get(key)
+    if body is None:
+        if line is not None and line not in timetable:
+            raise HTTPException(status_code=404, detail=f"unknown line: {line}")
+        items = _departures(direction, timetable, line, now, count)
+        body = dump_json({
+            "tz": tz,
+            "now": minute,
+            "dayTypeToday": get_day_type(now),
+            "line": line,
+            "next": [shape_item(now, it, tz) for it in items],
+        })
+        _next_cache[key] = body
+    return Response(
+        content=body,
+        media_type="application/json",
+        headers={"Cache-Control": f"public, max-age={60 - wall.second}"},
+    )
 
-@app.get("/bike")
-def get_bike():
-    global _bike_cache, _bike_cache_ts
+
+@app.get("/next/from-school")
+def get_next_from_school(line: Optional[str] = None, count: int = Query(5, ge=1, le=50)):
+    return _next_response("from-school", line, count)
+
+
+@app.get("/next/to-school")
+def get_next_to_school(line: Optional[str] = None, count: int = Query(5, ge=1, le=50)):
+    return _next_response("to-school", line, count)
+
+
+BATCH_MAX_TIMES = 2000
+# Cap on the departures a request can ask for (times x count, summed over
+# queries), which bounds both the work and the response size.
+BATCH_MAX_RESULTS = 20000
+# Query times must fall within this many days of today; the timetables and
+# service calendar mean nothing far outside it.
+BATCH_MAX_DAYS = 366
+
+
+class NextBatchQuery(BaseModel):
+    direction: Literal["from-school", "to-school"]
+    times: List[datetime]
+    line: Optional[str] = None
+    count: int = Field(5, ge=1, le=50)
+
+    @field_validator("times")
+    @classmethod
+    def _within_window(cls, times: List[datetime]) -> List[datetime]:
+        today = datetime.now().date().toordinal()
+        for t in times:
+            if abs(t.toordinal() - today) > BATCH_MAX_DAYS:
+                raise ValueError(f"times must be within {BATCH_MAX_DAYS} days of today: {t.isoformat()}")
+        return times
+
+
+class NextBatchRequest(BaseModel):
+    queries: List[NextBatchQuery] = Field(..., min_length=1)
+
+
+@app.post("/next/batch")
+def post_next_batch(req: NextBatchRequest):
+    # Static schedule only: for planning and pre-rendering, not live display.
+    if sum(len(q.times) for q in req.queries) > BATCH_MAX_TIMES:
+        raise HTTPException(status_code=413, detail=f"at most {BATCH_MAX_TIMES} times per request")
+    if sum(len(q.times) * q.count for q in req.queries) > BATCH_MAX_RESULTS:
+        raise HTTPException(status_code=413, detail=f"at most {BATCH_MAX_RESULTS} departures (times x count) per request")
+    timetables = timetable_store.current()
+    tz = os.environ.get("TZ", "Asia/Tokyo")
+    zone = now_in_tz(tz).tzinfo
+    results = []
+    for q in req.queries:
+        timetable = timetables.tables[q.direction]
+        if q.line is not None and q.line not in timetable:
+            raise HTTPException(status_code=404, detail=f"unknown line: {q.line}")
+        times = [t.astimezone(zone) if t.tzinfo else t.replace(tzinfo=zone) for t in q.times]
+        found = next_batch(timetable, times, q.count, q.line)
+        results.append({
+            "direction": q.direction,
+            "line": q.line,
+            "results": [
+                {
+                    "time": t.isoformat(),
+                    "dayType": get_day_type(t),
+                    "next": [shape_item(t, it, tz) for it in items],
+                }
+                for t, items in zip(times, found)
+            ],
+        })
+    return Response(content=dump_json({"tz": tz, "queries": results}), media_type="application/json")
+
+
+@app.get("/archive/{series}")
+def get_archive(series: str, key: str = "*", start: Optional[float] = None, end: Optional[float] = None,
+                step: float = Query(60, ge=1)):
+    # Range read of the on-disk archive, downsampled into step-second buckets
+    # of [start, samples, mean, min, max, mean of the second value (docks)].
+    if series not in archive.SERIES:
+        raise HTTPException(status_code=404, detail=f"unknown series: {series}")
     now = time.time()
-    if _bike_cache is not None and (now - _bike_cache_ts) < 60:
-        return _bike_cache
+    if end is None:
+        end = now
+    if start is None:
+        start = end - 3600
+    if not (now - archive.MAX_AGE_DAYS * 86400 <= start < end <= now + 86400):
+        raise HTTPException(status_code=400, detail=(
+            f"need start < end, within the last {archive.MAX_AGE_DAYS} days"))
+    if end - start > archive.MAX_RANGE_DAYS * 86400:
+        raise HTTPException(status_code=400, detail=f"at most {archive.MAX_RANGE_DAYS} days per query")
+    if (end - start) / step > archive.MAX_POINTS:
+        raise HTTPException(status_code=400, detail=f"at most {archive.MAX_POINTS} points; use a larger step")
+    try:
+        points = archive.archive.query(series, key, start, end, step)
+    except (OSError, ValueError) as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return {"series": series, "key": key, "start": start, "end": end, "step": step, "points": points}
+
+
+@app.get("/archive/{series}/keys")
+def get_archive_keys(series: str, day: Optional[date] = None):
+    # Sensor or station IDs archived on a UTC day (today by default).
+    if series not in archive.SERIES:
+        raise HTTPException(status_code=404, detail=f"unknown series: {series}")
+    day = day or datetime.now(timezone.utc).date()
+    return {"series": series, "day": day.isoformat(), "keys": archive.archive.keys(series, day.isoformat())}
+
+
+@app.get("/bike")
+async def get_bike(group: Optional[str] = None):
+    bike = _bike()
+    if group is not None and group not in bike.STATION_GROUPS:
+        raise HTTPException(status_code=404, detail=f"unknown station group: {group}")
     try:
-        data = compute_bike_metrics()
-        _bike_cache = data
-        _bike_cache_ts = now
-        return data
+        snapshot = await bike.get_snapshot()
     except Exception as e:
-        if _bike_cache is not None:
-            return _bike_cache
         raise HTTPException(status_code=502, detail=str(e))
+    if group is not None:
+        return bike.compute_group_metrics(snapshot, group)
+    return bike.compute_bike_metrics(snapshot)
+
+
+@app.get("/bike/nearby")
+async def get_bike_nearby(lat: float = Query(..., ge=-90, le=90), lon: float = Query(..., ge=-180, le=180),
+                          radius: float = Query(500, gt=0, le=5000), limit: int = Query(20, ge=1, le=100)):
+    bike = _bike()
+    try:
+        snapshot = await bike.get_snapshot()
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=str(e))
+    # Measuring distances is CPU work; keep it off the event loop.
+    try:
+        return await asyncio.get_running_loop().run_in_executor(
+            None, bike.compute_nearby, snapshot, lat, lon, radius, limit)
+    except LookupError as e:
+        raise HTTPException(status_code=503, detail=str(e.args[0]))
 
 
 @app.get("/bike-direction")
-def get_bike_direction():
-    global _bike2_cache, _bike2_cache_ts
-    now = time.time()
-    if _bike2_cache is not None and (now - _bike2_cache_ts) < 60:
-        return _bike2_cache
+async def get_bike_direction(request: Request):
+    bike = _bike()
     try:
-        data = compute_bike_metrics_directional()
-        _bike2_cache = data
-        _bike2_cache_ts = now
-        return data
+        payload = bike.compute_bike_metrics_directional(await bike.get_snapshot())
     except Exception as e:
-        if _bike2_cache is not None:
-            return _bike2_cache
         raise HTTPException(status_code=502, detail=str(e))
+    return negotiated_response(request, payload)
+
+
+@app.get("/stream")
+async def get_stream():
+    # Serverless instances run no subscriber or bike pump, so nothing would
+    # ever be pushed; clients keep polling instead.
+    if SERVERLESS:
+        raise HTTPException(status_code=503, detail="push updates are not available on this deployment")
+    count = _congestion_view()["count"]
+    broadcaster.publish("congestion", {"count": count, "level": _classify_level(count)})
+    try:
+        _publish_bike(await _bike().get_snapshot())
+    except Exception:
+        pass
+    return StreamingResponse(
+        broadcaster.stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 
+def _bike_sources() -> Dict:
+    bike = _bike()
+    snapshot = bike.current_snapshot()
+    feeds = bike.upstream.get_stats()
+    out = {}
+    for name, url, key in (("gbfs_info", bike.HELLO_INFO_URL, "info_last_updated"),
+                           ("gbfs_status", bike.HELLO_STATUS_URL, "last_updated")):
+        fetch = feeds.get(url, {})
+        out[name] = {
+            "lastUpdated": (snapshot or {}).get(key, 0),
+            "fetchedAt": (snapshot or {}).get("fetched_at", 0.0),
+            "lastSuccessAt": fetch.get("last_success_at", 0.0),
+            "lastDuration": fetch.get("last_duration"),
+            "requests": fetch.get("requests", 0),
+            "notModified": fetch.get("not_modified", 0),
+            "errors": fetch.get("errors", 0),
+            "stale": snapshot is None or bike.is_overdue(snapshot),
+        }
+    status = out["gbfs_status"]
+    if snapshot is not None and snapshot["last_updated"]:
+        status["ageSeconds"] = max(0, int(time.time() - snapshot["last_updated"]))
+    status["frozen"] = snapshot is not None and bike.is_frozen(snapshot)
+    status["stale"] = status["stale"] or status["frozen"]
+    return out
 
-_bike_cache = None  # type: ignore[var-annotated]
-_bike_cache_ts: float = 0.0
-_bike2_cache = None  # type: ignore[var-annotated]
-_bike2_cache_ts: float = 0.0
+
+@app.get("/healthz")
+def get_healthz():
+    now = time.time()
+    view = _congestion_view()
+    mqtt = {
+        "updatedAt": view["updatedAt"],
+        "stale": _congestion_stale(view["updatedAt"], now),
+        "sensors": {
+            s: {
+                "updatedAt": ts,
+                "stale": _congestion_stale(ts, now),
+                "messagesPerSecond": view.get("rates", {}).get(s),
+            }
+            for s, ts in view.get("sensorsUpdatedAt", {}).items()
+        },
+        "connection": get_connection_stats(),
+        "messages": get_message_stats(),
+    }
+    sources = {"mqtt": mqtt}
+    sources.update(_bike_sources())
+    degraded = any(s["stale"] for s in sources.values())
+    return {
+        "status": "degraded" if degraded else "ok",
+        "leader": shared_state.is_leader(),
+        "sources": sources,
+    }
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    now = time.time()
+    view = _congestion_view()
+    sensors_updated = view.get("sensorsUpdatedAt", {})
+    rates = view.get("rates", {})
+    conn = get_connection_stats()
+    msgs = get_message_stats()
+    bike_sources = _bike_sources()
+    gauges = [
+        ("congestion_count", "gauge", "Latest people count per sensor.",
+         [({"sensor": s}, c) for s, c in view["sensors"].items()] + [({"sensor": "*"}, view["count"])]),
+        ("congestion_last_update_timestamp_seconds", "gauge", "Time of the latest sample per sensor.",
+         [({"sensor": s}, ts) for s, ts in sensors_updated.items()] + [({"sensor": "*"}, view["updatedAt"])]),
+        ("congestion_stale", "gauge", "1 when a sensor has not reported recently.",
+         [({"sensor": s}, _congestion_stale(ts, now)) for s, ts in sensors_updated.items()]),
+        ("congestion_messages_per_second", "gauge", "Message rate over the shortest window.",
+         [({"sensor": s}, r) for s, r in rates.items()]),
+        ("mqtt_messages_total", "counter", "MQTT messages by outcome.",
+         [({"outcome": k}, v) for k, v in msgs.items() if k != "queued"]),
+        ("mqtt_queue_depth", "gauge", "Messages waiting to be decoded.",
+         [({}, msgs.get("queued", 0))]),
+        ("mqtt_connected", "gauge", "1 while the MQTT connection is up.",
+         [({}, bool(conn.get("connected")))]),
+        ("mqtt_connection_events_total", "counter", "MQTT connection lifecycle events.",
+         [({"event": k}, conn.get(k, 0)) for k in ("connects", "connect_failures", "interruptions", "resumes")]),
+        ("mqtt_outage_seconds_total", "counter", "Total time spent disconnected after a connection was up.",
+         [({}, conn.get("outage_secs_total", 0.0))]),
+        ("mqtt_last_reconnect_seconds", "gauge", "Duration of the most recent outage.",
+         [({}, conn.get("last_reconnect_secs"))]),
+        ("gbfs_feed_last_updated_timestamp_seconds", "gauge", "last_updated reported by each GBFS feed.",
+         [({"feed": k}, v["lastUpdated"]) for k, v in bike_sources.items()]),
+        ("gbfs_feed_stale", "gauge", "1 when the feed is past its expiry or has stopped updating.",
+         [({"feed": k}, v["stale"]) for k, v in bike_sources.items()]),
+        ("gbfs_fetch_duration_seconds", "gauge", "Duration of the latest fetch per feed.",
+         [({"feed": k}, v["lastDuration"]) for k, v in bike_sources.items()]),
+        ("gbfs_fetch_total", "counter", "Upstream fetches by feed and outcome.",
+         [({"feed": k, "outcome": o}, v[f]) for k, v in bike_sources.items()
+          for o, f in (("requests", "requests"), ("not_modified", "notModified"), ("errors", "errors"))]),
+        ("archive_rows_total", "counter", "Archive rows by outcome.",
+         [({"outcome": k}, v) for k, v in archive.archive.stats.items() if k != "blocks"]),
+        ("archive_blocks_total", "counter", "Compressed blocks written to the archive.",
+         [({}, archive.archive.stats["blocks"])]),
+    ]
+    return metrics.render(gauges)
+
+
+_background_tasks = set()
 
 
 @app.on_event("startup")
-def _startup():
-    start_subscriber()
+async def _startup():
+    if SERVERLESS:
+        return
+    if shared_state.is_leader():
+        _start_leader_duties()
+    loop = asyncio.get_running_loop()
+    _background_tasks.add(loop.create_task(_bike_pump()))
+    _background_tasks.add(loop.create_task(_state_sync()))
+
+
+@app.on_event("shutdown")
+async def _shutdown():
+    if _bike_module is not None:
+        await _bike_module.upstream.aclose()
 
 
 if __name__ == '__main__':
+    import uvicorn
+
     uvicorn.run(app, host="0.0.0.0", port=8000, reload=False)
@@ -0,0 +1,260 @@
+import json
+import os
+import queue
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from array import array
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", os.path.join(tempfile.gettempdir(), "digital-twin-bus", "archive"))
+QUEUE_SIZE = int(os.getenv("ARCHIVE_QUEUE_SIZE", "65536"))
+BLOCK_ROWS = 4096
+FLUSH_SECS = float(os.getenv("ARCHIVE_FLUSH_SECS", "30"))
+SERIES = ("congestion", "bike")
+MAX_POINTS = 5000
+# Range queries reach back at most MAX_AGE_DAYS and span at most
+# MAX_RANGE_DAYS (one partition is opened per day in the range).
+MAX_AGE_DAYS = int(os.getenv("ARCHIVE_MAX_AGE_DAYS", "400"))
+MAX_RANGE_DAYS = int(os.getenv("ARCHIVE_MAX_RANGE_DAYS", "31"))
+
+# Each series is split into one log per UTC day, written as compressed blocks
+# of up to BLOCK_ROWS rows. A block stores its columns one after another
+# (timestamp as milliseconds since the block start, key id, two values), which
+# compresses far better than rows. Every block gets a fixed-width entry in the
+# day's .idx file, so a range query reads the small index and decompresses
+# only the blocks it overlaps. Key names (sensor or station IDs) live in .keys.json.
+BLOCK = struct.Struct("<4sIdI")  # magic, rows, start ts, compressed length
+BLOCK_MAGIC = b"ARCB"
+INDEX = struct.Struct("<QIIdd")  # offset, length, rows, first ts, last ts
+
+
+class _Partition:
+
+    def __init__(self, directory: str, day: str):
+        self.base = os.path.join(directory, day)
+        self.keys: Dict[str, int] = {}
+        if os.path.exists(self.base + ".keys.json"):
+            with open(self.base + ".keys.json") as f:
+                self.keys = json.load(f)
+
+    def key_id(self, key: str) -> int:
+        i = self.keys.get(key)
+        if i is None:
+            i = self.keys[key] = len(self.keys)
+            tmp = self.base + ".keys.json.tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.keys, f)
+            os.replace(tmp, self.base + ".keys.json")
+        return i
+
+    def append(self, rows: List[Tuple[float, str, int, int]]) -> None:
+        # Rows can arrive out of order (the bike feed reports its own times);
+        # sorted, the offsets stay non-negative and the index gets the real
+        # first and last times.
+        rows = sorted(rows, key=lambda r: r[0])
+        start = rows[0][0]
+        ts = array("I", (int((r[0] - start) * 1000) for r in rows))
+        keys = array("H", (self.key_id(r[1]) for r in rows))
+        v1 = array("H", (min(max(r[2], 0), 65535) for r in rows))
+        v2 = array("H", (min(max(r[3], 0), 65535) for r in rows))
+        payload = zlib.compress(ts.tobytes() + keys.tobytes() + v1.tobytes() + v2.tobytes(), 6)
+        with open(self.base + ".log", "ab") as f:
+            offset = f.tell()
+            f.write(BLOCK.pack(BLOCK_MAGIC, len(rows), start, len(payload)))
+            f.write(payload)
+        with open(self.base + ".idx", "ab") as f:
+            f.write(INDEX.pack(offset, BLOCK.size + len(payload), len(rows), start, rows[-1][0]))
+
+
+def _day(ts: float) -> str:
+    return datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m-%d")
+
+
+def _read_block(f, offset: int, length: int):
+    f.seek(offset)
+    data = f.read(length)
+    magic, n, start, clen = BLOCK.unpack_from(data)
+    if magic != BLOCK_MAGIC:
+        raise ValueError(f"corrupt archive block at {offset}")
+    raw = zlib.decompress(data[BLOCK.size:BLOCK.size + clen])
+    ts = array("I")
+    ts.frombytes(raw[:4 * n])
+    cols = []
+    for i in range(3):
+        col = array("H")
+        col.frombytes(raw[4 * n + 2 * n * i:4 * n + 2 * n * (i + 1)])
+        cols.append(col)
+    return start, ts, cols[0], cols[1], cols[2]
+
+
+# Rows are queued by the producers (MQTT decode thread, bike refresh) with
+# put_nowait and written by a single daemon thread; when the queue is full the
+# row is counted as dropped instead of blocking the producer.
+class Archive:
+
+    def __init__(self, directory: str = ARCHIVE_DIR):
+        self.directory = directory
+        self._queue: "queue.Queue[Tuple[str, float, str, int, int]]" = queue.Queue(maxsize=QUEUE_SIZE)
+        self._pending: Dict[str, List[Tuple[float, str, int, int]]] = {s: [] for s in SERIES}
+        self._lock = threading.Lock()
+        self._partitions: Dict[Tuple[str, str], _Partition] = {}
+        self._started = False
+        self.stats = {"queued": 0, "written": 0, "dropped": 0, "blocks": 0, "errors": 0}
+
+    def start(self) -> None:
+        if self._started:
+            return
+        for s in SERIES:
+            os.makedirs(os.path.join(self.directory, s), exist_ok=True)
+        self._started = True
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def record(self, series: str, key: str, ts: float, v1: int, v2: int = 0) -> None:
+        if not self._started:
+            return
+        try:
+            self._queue.put_nowait((series, ts, key, int(v1), int(v2)))
+            self.stats["queued"] += 1
+        except queue.Full:
+            self.stats["dropped"] += 1
+
+    def _partition(self, series: str, day: str) -> _Partition:
+        p = self._partitions.get((series, day))
+        if p is None:
+            if len(self._partitions) > 8:
+                self._partitions.clear()
+            p = self._partitions[(series, day)] = _Partition(os.path.join(self.directory, series), day)
+        return p
+
+    def _flush(self, series: str) -> None:
+        with self._lock:
+            rows = self._pending[series]
+            self._pending[series] = []
+        by_day: Dict[str, List] = {}
+        for row in rows:
+            by_day.setdefault(_day(row[0]), []).append(row)
+        for day, day_rows in by_day.items():
+            try:
+                self._partition(series, day).append(day_rows)
+                self.stats["written"] += len(day_rows)
+                self.stats["blocks"] += 1
+            except Exception as e:
+                self.stats["errors"] += len(day_rows)
+                print(f"archive {series}/{day}: {e}", file=sys.stderr)
+
+    def _run(self) -> None:
+        flushed_at = time.monotonic()
+        while True:
+            timeout = max(0.0, FLUSH_SECS - (time.monotonic() - flushed_at))
+            try:
+                series, ts, key, v1, v2 = self._queue.get(timeout=timeout)
+                with self._lock:
+                    pending = self._pending[series]
+                    pending.append((ts, key, v1, v2))
+                if len(pending) >= BLOCK_ROWS:
+                    self._flush(series)
+            except queue.Empty:
+                pass
+            if time.monotonic() - flushed_at >= FLUSH_SECS:
+                for s in SERIES:
+                    if self._pending[s]:
+                        self._flush(s)
+                flushed_at = time.monotonic()
+
+    def query(self, series: str, key: str, start: float, end: float, step: float) -> List[List]:
+        # Downsampled to buckets of step seconds: [bucket start, n, mean, min,
+        # max, mean of the second value].
+        buckets: Dict[int, List] = {}
+
+        def add(ts: float, v1: int, v2: int) -> None:
+            b = int((ts - start) // step)
+            acc = buckets.get(b)
+            if acc is None:
+                buckets[b] = [1, v1, v1, v1, v2]
+            else:
+                acc[0] += 1
+                acc[1] += v1
+                acc[2] = min(acc[2], v1)
+                acc[3] = max(acc[3], v1)
+                acc[4] += v2
+
+        day = datetime.fromtimestamp(start, timezone.utc).date()
+        last = datetime.fromtimestamp(end, timezone.utc).date()
+        while day <= last:
+            self._scan(os.path.join(self.directory, series, day.isoformat()), key, start, end, add)
+            day += timedelta(days=1)
+        with self._lock:
+            pending = list(self._pending.get(series, ()))
+        for ts, k, v1, v2 in pending:
+            if k == key and start <= ts < end:
+                add(ts, v1, v2)
+        return [
+            [start + b * step, acc[0], round(acc[1] / acc[0], 2), acc[2], acc[3], round(acc[4] / acc[0], 2)]
+            for b, acc in sorted(buckets.items())
+        ]
+
+    def _scan(self, base: str, key: str, start: float, end: float, add) -> None:
+        try:
+            with open(base + ".keys.json") as f:
+                key_id = json.load(f).get(key)
+            with open(base + ".idx", "rb") as f:
+                raw = f.read()
+        except FileNotFoundError:
+            return
+        if key_id is None:
+            return
+        with open(base + ".log", "rb") as f:
+            for offset, length, _, t0, t1 in INDEX.iter_unpack(raw[:len(raw) - len(raw) % INDEX.size]):
+                if t1 < start or t0 >= end:
+                    continue
+                block_start, ts, keys, v1, v2 = _read_block(f, offset, length)
+                for i in range(len(ts)):
+                    if keys[i] != key_id:
+                        continue
+                    t = block_start + ts[i] / 1000
+                    if start <= t < end:
+                        add(t, v1[i], v2[i])
+
+    def keys(self, series: str, day: Optional[str] = None) -> List[str]:
+        day = day or _day(time.time())
+        path = os.path.join(self.directory, series, day + ".keys.json")
+        try:
+            with open(path) as f:
+                return sorted(json.load(f))
+        except FileNotFoundError:
+            return []
+
+
+archive = Archive()
+
+
+def on_sensor_sample(sensor: str, count: int, ts: float) -> None:
+    archive.record("congestion", sensor, ts, count)
+
+
+def on_combined_sample(count: int, ts: float) -> None:
+    archive.record("congestion", "*", ts, count)
+
+
+_bike_archived_at = 0.0
+
+
+def on_bike_snapshot(snapshot: dict, station_ids: Iterable[str]) -> None:
+    # A refresh answered with 304 hands over the same status again.
+    global _bike_archived_at
+    ts = float(snapshot.get("last_updated") or snapshot["fetched_at"])
+    if ts == _bike_archived_at:
+        return
+    _bike_archived_at = ts
+    status_by_id = snapshot["status_by_id"]
+    for sid in station_ids:
+        s = status_by_id.get(sid)
+        if s is None:
+            continue
+        archive.record("bike", sid, ts, int(s.get("num_bikes_available", 0) or 0),
+                       int(s.get("num_docks_available", 0) or 0))
@@ -0,0 +1,67 @@
+# Micro-benchmarks for the timetable lookups.
+#
+#     python bench/bench_bus.py [--queries 2000] [--json out.json] [--compare before.json]
+#
+# Every lookup is timed individually over the same seeded set of query times,
+# spread across all day types and hours, so runs are comparable.
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+from common import load_results, print_table, save_results, summarize
+
+from bus import next_across_all, next_batch, next_buses
+from bus_data import TIMETABLE_FROM_SCHOOL, TIMETABLE_TO_SCHOOL
+
+
+def query_times(n: int, seed: int = 1):
+    rng = random.Random(seed)
+    start = datetime(2025, 4, 7)
+    return [start + timedelta(minutes=rng.randrange(14 * 24 * 60)) for _ in range(n)]
+
+
+def run(name: str, fn, times):
+    latencies = []
+    t0 = time.perf_counter()
+    for t in times:
+        s = time.perf_counter()
+        fn(t)
+        latencies.append(time.perf_counter() - s)
+    return name, summarize(latencies, time.perf_counter() - t0)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--count", type=int, default=5)
+    parser.add_argument("--json")
+    parser.add_argument("--compare")
+    args = parser.parse_args()
+
+    times = query_times(args.queries)
+    cases = []
+    for direction, table in (("from-school", TIMETABLE_FROM_SCHOOL), ("to-school", TIMETABLE_TO_SCHOOL)):
+        cases.append((f"next_across_all {direction}",
+                      lambda t, table=table: next_across_all(table, t, args.count)))
+        for line in table:
+            cases.append((f"next_buses {direction} {line}",
+                          lambda t, table=table, line=line: next_buses(table, line, t, args.count)))
+
+    for _, fn in cases:
+        fn(times[0])
+    results = dict(run(name, fn, times) for name, fn in cases)
+    for direction, table in (("from-school", TIMETABLE_FROM_SCHOOL), ("to-school", TIMETABLE_TO_SCHOOL)):
+        # One call for all query times; n is the number of times resolved.
+        next_batch(table, times[:1], args.count)
+        t0 = time.perf_counter()
+        next_batch(table, times, args.count)
+        elapsed = time.perf_counter() - t0
+        results[f"next_batch {direction}"] = summarize([elapsed / len(times)] * len(times), elapsed)
+    print_table(results, load_results(args.compare))
+    if args.json:
+        save_results(args.json, results)
+
+
+if __name__ == "__main__":
+    main()
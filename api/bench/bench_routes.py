@@ -0,0 +1,178 @@
+# End-to-end throughput and latency of the API routes, in process.
+#
+#     python bench/bench_routes.py [--requests 500] [--concurrency 16] [--json out.json] [--compare before.json]
+#
+# Requests go through httpx's ASGI transport, so the numbers include routing,
+# validation, middleware and serialization but no sockets. Bike routes read
+# from the local GBFS stand-in (bench/gbfs_fixture.py) and congestion routes
+# from synthetic samples recorded before the run. Runs in serverless mode: no
+# MQTT subscriber or background tasks. Requests ask for identity encoding
+# unless the route sets Accept-Encoding; "bytes" is the body size on the wire.
+# The archive routes read blocks written from the seeded congestion samples
+# into a temporary ARCHIVE_DIR.
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+os.environ.setdefault("SERVERLESS", "1")
+os.environ.setdefault("ARCHIVE_DIR", tempfile.mkdtemp(prefix="bench-archive-"))
+
+from common import load_results, print_table, save_results, summarize
+
+import httpx
+
+import app
+import archive
+import bike
+from congestion import sensors
+from gbfs_fixture import FixtureServer, ensure_fixtures, point_bike_at
+
+ROUTES = [
+    ("GET /timetable/from-school", "/timetable/from-school", {}),
+    ("GET /timetable/to-school gzip", "/timetable/to-school", {"Accept-Encoding": "gzip"}),
+    ("GET /timetable/from-school msgpack", "/timetable/from-school", {"Accept": "application/msgpack"}),
+    ("GET /next/from-school", "/next/from-school", {}),
+    ("GET /next/to-school?count=20", "/next/to-school?count=20", {}),
+    ("GET /congestion", "/congestion", {}),
+    ("GET /congestion?window=5", "/congestion?window=5", {}),
+    ("GET /congestion?window=5 cbor", "/congestion?window=5", {"Accept": "application/cbor"}),
+    ("GET /congestion/history", "/congestion/history?window=15&limit=500", {}),
+    ("GET /congestion/history br", "/congestion/history?window=15&limit=500", {"Accept-Encoding": "br"}),
+    ("GET /congestion/forecast", "/congestion/forecast", {}),
+    ("GET /congestion/forecast?sensor=", "/congestion/forecast?sensor=sensor-0", {}),
+    ("GET /archive/congestion", "/archive/congestion?key=sensor-0&step=60", {}),
+    ("GET /archive/congestion *", "/archive/congestion?step=10", {}),
+    ("GET /bike", "/bike", {}),
+    ("GET /bike?group=", "/bike?group=shonandai-primary", {}),
+    ("GET /bike-direction", "/bike-direction", {}),
+    ("GET /bike-direction gzip", "/bike-direction", {"Accept-Encoding": "gzip"}),
+    ("GET /bike-direction msgpack", "/bike-direction", {"Accept": "application/msgpack"}),
+    ("GET /healthz", "/healthz", {}),
+    ("GET /metrics", "/metrics", {}),
+]
+
+BATCH_REQUESTS = 40
+
+
+def batch_body(times: int = 200, count: int = 5):
+    # A day of query times, every 7 minutes from now.
+    start = datetime.now()
+    return {"queries": [
+        {"direction": direction, "count": count,
+         "times": [(start + timedelta(minutes=7 * i)).isoformat() for i in range(times)]}
+        for direction in ("from-school", "to-school")
+    ]}
+
+
+def nearby_routes():
+    # Centred on a fixture station, so the radius always catches some.
+    index = bike.station_index()
+    lat, lon = index.lat[0], index.lon[0]
+    return [
+        ("GET /bike/nearby", f"/bike/nearby?lat={lat}&lon={lon}&radius=500", {}),
+        ("GET /bike/nearby r=5000", f"/bike/nearby?lat={lat}&lon={lon}&radius=5000&limit=100", {}),
+    ]
+
+
+def seed_congestion(sensor_count: int = 3, seconds: int = 900, rate: float = 2.0) -> None:
+    rng = random.Random(4)
+    now = time.time()
+    n = int(seconds * rate)
+    for i in range(n):
+        sensor = f"sensor-{i % sensor_count}"
+        sensors.record(sensor, rng.randint(0, 30), now - seconds + i / rate)
+
+
+def seed_archive() -> None:
+    # The samples recorded by seed_congestion, written out as blocks.
+    while not archive.archive._queue.empty():
+        time.sleep(0.01)
+    for series in archive.SERIES:
+        archive.archive._flush(series)
+
+
+async def bench_route(client: httpx.AsyncClient, path: str, headers, requests: int, concurrency: int,
+                      body=None):
+    latencies = []
+    remaining = requests
+    size = 0
+
+    async def worker():
+        nonlocal remaining, size
+        while remaining > 0:
+            remaining -= 1
+            s = time.perf_counter()
+            if body is None:
+                resp = await client.get(path, headers=headers)
+            else:
+                resp = await client.post(path, headers=headers, json=body)
+            latencies.append(time.perf_counter() - s)
+            if resp.status_code >= 400:
+                raise RuntimeError(f"{path}: HTTP {resp.status_code}")
+            size = int(resp.headers.get("content-length", len(resp.content)))
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    result = summarize(latencies, time.perf_counter() - t0)
+    result["bytes"] = size
+    return result
+
+
+async def run(args):
+    transport = httpx.ASGITransport(app=app.app)
+    results = {}
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench",
+                                 headers={"Accept-Encoding": "identity"}) as client:
+        await client.get("/bike")
+        for name, path, headers in ROUTES + nearby_routes():
+            if args.only and args.only not in name:
+                continue
+            await client.get(path, headers=headers)
+            results[name] = await bench_route(client, path, headers, args.requests, args.concurrency)
+        # Batches cost hundreds of times a single lookup; a few dozen
+        # requests are enough to measure them.
+        for name, body in (("POST /next/batch 2x200", batch_body()),
+                           ("POST /next/batch 2x1000 count=10", batch_body(1000, 10))):
+            if args.only and args.only not in name:
+                continue
+            results[name] = await bench_route(client, "/next/batch", {}, min(args.requests, BATCH_REQUESTS),
+                                              args.concurrency, body)
+        # Revalidation: the client already holds the ETag.
+        resp = await client.get("/timetable/from-school")
+        results["GET /timetable/from-school 304"] = await bench_route(
+            client, "/timetable/from-school", {"If-None-Match": resp.headers["etag"]},
+            args.requests, args.concurrency)
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--stations", type=int, default=15000)
+    parser.add_argument("--only", help="substring filter on route names")
+    parser.add_argument("--json")
+    parser.add_argument("--compare")
+    args = parser.parse_args()
+
+    server = FixtureServer(ensure_fixtures(args.stations)).start()
+    point_bike_at(server)
+    archive.archive.start()
+    seed_congestion()
+    seed_archive()
+    try:
+        results = asyncio.run(run(args))
+    finally:
+        server.stop()
+    print_table(results, load_results(args.compare))
+    print(f"gbfs fixture: {server.requests} requests, {server.not_modified} not modified")
+    if args.json:
+        save_results(args.json, results)
+
+
+if __name__ == "__main__":
+    main()
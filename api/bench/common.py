@@ -0,0 +1,57 @@
+import json
+import os
+import sys
+from typing import Dict, List, Optional, Sequence
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if API_DIR not in sys.path:
+    sys.path.insert(0, API_DIR)
+
+
+def percentile(sorted_samples: Sequence[float], p: float) -> float:
+    if not sorted_samples:
+        return float("nan")
+    k = max(0, min(len(sorted_samples) - 1, -(-p * len(sorted_samples) // 100) - 1))
+    return sorted_samples[int(k)]
+
+
+def summarize(latencies: List[float], elapsed: float) -> Dict[str, float]:
+    s = sorted(latencies)
+    return {
+        "n": len(s),
+        "rps": round(len(s) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(s, 50) * 1000, 3),
+        "p90_ms": round(percentile(s, 90) * 1000, 3),
+        "p99_ms": round(percentile(s, 99) * 1000, 3),
+        "max_ms": round(s[-1] * 1000, 3) if s else float("nan"),
+    }
+
+
+def print_table(results: Dict[str, Dict[str, float]], baseline: Optional[Dict[str, Dict[str, float]]] = None) -> None:
+    columns = ("n", "rps", "p50_ms", "p90_ms", "p99_ms", "max_ms", "bytes")
+    width = max([len(k) for k in results] + [4])
+    print(f"{'name':<{width}}  " + "  ".join(f"{c:>10}" for c in columns))
+    for name, row in results.items():
+        cells = []
+        for c in columns:
+            cell = f"{row.get(c, ''):>10}"
+            before = (baseline or {}).get(name, {}).get(c)
+            if before and c != "n" and c in row:
+                cells.append(cell + f" ({(row[c] - before) / before * 100:+.0f}%)")
+            else:
+                cells.append(cell)
+        print(f"{name:<{width}}  " + "  ".join(cells))
+
+
+# Results are plain JSON so a run before a change can be passed back in with
+# --compare after it.
+def save_results(path: str, results: Dict) -> None:
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def load_results(path: Optional[str]) -> Optional[Dict]:
+    if not path:
+        return None
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,122 @@
+# Fake MQTT publisher: drives mqtt_subscriber.on_message_received directly,
+# the way the CRT callback thread does, without AWS credentials or a broker.
+#
+#     python bench/fake_mqtt.py [--rate 10] [--duration 30] [--sensors 3]
+#                               [--spike 10:5:200] [--objects 15] [--spike-objects 60]
+#
+# --spike AT:SECONDS:RATE replays a class-change rush: starting AT seconds in,
+# every sensor publishes at RATE messages/s for SECONDS with --spike-objects
+# people per frame. The decode thread runs as in production, and the queue,
+# drop and lag counters are reported once per second and at the end.
+import argparse
+import json
+import random
+import threading
+import time
+
+from common import summarize
+
+import mqtt_subscriber
+from congestion import sensors
+
+
+def payload(objects: int, rng: random.Random) -> bytes:
+    return json.dumps({
+        "timestamp": time.time(),
+        "objects": [
+            {"id": i, "class": "person",
+             "position": [round(rng.uniform(-5, 5), 2), round(rng.uniform(-5, 5), 2), 0.0],
+             "velocity": [0.0, 0.0, 0.0]}
+            for i in range(objects)
+        ],
+    }).encode()
+
+
+_payloads = {}
+
+
+def payload_for(objects: int, rng: random.Random) -> bytes:
+    # Encoding is done once per size so the publisher can reach high rates.
+    body = _payloads.get(objects)
+    if body is None:
+        body = _payloads[objects] = payload(objects, rng)
+    return body
+
+
+def _parse_spike(spec):
+    if not spec:
+        return None
+    at, seconds, rate = (float(x) for x in spec.split(":"))
+    return at, at + seconds, rate
+
+
+def publish(args, stop: threading.Event, send_latencies) -> None:
+    rng = random.Random(5)
+    spike = _parse_spike(args.spike)
+    topics = [f"object/lidar/sensor-{i}/person" for i in range(args.sensors)]
+    start = time.perf_counter()
+    next_at = start
+    while not stop.is_set():
+        elapsed = time.perf_counter() - start
+        if elapsed >= args.duration:
+            break
+        in_spike = spike is not None and spike[0] <= elapsed < spike[1]
+        rate = spike[2] if in_spike else args.rate
+        objects = args.spike_objects if in_spike else args.objects
+        for topic in topics:
+            body = payload_for(max(0, objects + rng.randint(-3, 3)), rng)
+            s = time.perf_counter()
+            mqtt_subscriber.on_message_received(topic, body, False, 0, False)
+            send_latencies.append(time.perf_counter() - s)
+        next_at += 1.0 / rate
+        delay = next_at - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            next_at = time.perf_counter()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rate", type=float, default=10.0, help="messages/s per sensor")
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--sensors", type=int, default=3)
+    parser.add_argument("--objects", type=int, default=15)
+    parser.add_argument("--spike", help="AT:SECONDS:RATE")
+    parser.add_argument("--spike-objects", type=int, default=60)
+    parser.add_argument("--quiet", action="store_true")
+    args = parser.parse_args()
+
+    threading.Thread(target=mqtt_subscriber.process_messages, daemon=True).start()
+    stop = threading.Event()
+    send_latencies = []
+    publisher = threading.Thread(target=publish, args=(args, stop, send_latencies), daemon=True)
+    t0 = time.perf_counter()
+    publisher.start()
+    try:
+        while publisher.is_alive():
+            publisher.join(1.0)
+            if not args.quiet:
+                m = mqtt_subscriber.get_message_stats()
+                print(f"{time.perf_counter() - t0:6.1f}s  count={sensors.combined.latest()[1]:4d}  "
+                      f"received={m['received']}  processed={m['processed']}  queued={m['queued']}  "
+                      f"dropped={m['dropped']}  late={m['late']}")
+    except KeyboardInterrupt:
+        stop.set()
+        publisher.join()
+    elapsed = time.perf_counter() - t0
+    while mqtt_subscriber.get_message_stats()["queued"]:
+        time.sleep(0.01)
+    drained = time.perf_counter() - t0 - elapsed
+
+    m = mqtt_subscriber.get_message_stats()
+    callback = summarize(send_latencies, elapsed)
+    print(f"callback: {callback['rps']} msg/s  p50 {callback['p50_ms']} ms  p99 {callback['p99_ms']} ms  "
+          f"max {callback['max_ms']} ms")
+    print(f"decode: processed {m['processed']}/{m['received']}  dropped {m['dropped']}  late {m['late']}  "
+          f"decode errors {m['decode_errors']}  drained {drained:.2f}s after the last message")
+    print(f"congestion view: {json.dumps(sensors.view()['windows']['*'])}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+# Local stand-in for the ODPT HELLO CYCLING GBFS feeds.
+#
+#     python bench/gbfs_fixture.py [--port 8765] [--stations 15000] [--record]
+#
+# Serves station_information.json and station_status.json from bench/fixtures,
+# generating synthetic feeds the size of the nationwide ones (about 4 MB each)
+# on first use, or downloading the real ones with --record. ETag and
+# If-None-Match are honoured like the upstream CDN; --churn rewrites the status
+# feed periodically so refreshes see new data.
+import argparse
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+
+from common import API_DIR
+
+from bike import HELLO_INFO_URL, HELLO_STATUS_URL, WATCHED_STATION_IDS
+
+FIXTURE_DIR = os.path.join(API_DIR, "bench", "fixtures")
+FEEDS = {
+    "station_information.json": HELLO_INFO_URL,
+    "station_status.json": HELLO_STATUS_URL,
+}
+TTL = 60
+
+
+def _station_ids(n: int):
+    ids = sorted(WATCHED_STATION_IDS, key=int)
+    i = 1
+    while len(ids) < n:
+        if str(i) not in WATCHED_STATION_IDS:
+            ids.append(str(i))
+        i += 1
+    return ids
+
+
+def synth_information(n: int, seed: int = 1) -> Dict:
+    rng = random.Random(seed)
+    stations = []
+    for sid in _station_ids(n):
+        stations.append({
+            "station_id": sid,
+            "name": f"ステーション{sid}",
+            "lat": 35.39 + rng.uniform(-1.5, 1.5),
+            "lon": 139.46 + rng.uniform(-1.5, 1.5),
+            "capacity": rng.randint(4, 30),
+            "address": f"神奈川県藤沢市{sid}",
+            "rental_uris": {"android": f"https://www.hellocycling.jp/app/port/detail/{sid}",
+                            "ios": f"https://www.hellocycling.jp/app/port/detail/{sid}"},
+        })
+    return {"last_updated": int(time.time()), "ttl": TTL, "version": "2.3", "data": {"stations": stations}}
+
+
+def synth_status(information: Dict, rng: Optional[random.Random] = None) -> Dict:
+    rng = rng or random.Random(2)
+    now = int(time.time())
+    stations = []
+    for info in information["data"]["stations"]:
+        bikes = rng.randint(0, info["capacity"])
+        stations.append({
+            "station_id": info["station_id"],
+            "num_bikes_available": bikes,
+            "num_docks_available": info["capacity"] - bikes,
+            "is_installed": True,
+            "is_renting": True,
+            "is_returning": True,
+            "last_reported": now - rng.randint(0, 600),
+            "vehicle_types_available": [{"vehicle_type_id": "hello-bike", "count": bikes}],
+        })
+    return {"last_updated": now, "ttl": TTL, "version": "2.3", "data": {"stations": stations}}
+
+
+def _dump(payload: Dict) -> bytes:
+    return json.dumps(payload, ensure_ascii=False).encode("utf-8")
+
+
+def ensure_fixtures(stations: int = 15000, record: bool = False, directory: str = FIXTURE_DIR) -> Dict[str, bytes]:
+    os.makedirs(directory, exist_ok=True)
+    out: Dict[str, bytes] = {}
+    for name, url in FEEDS.items():
+        path = os.path.join(directory, name)
+        if record:
+            with urllib.request.urlopen(url, timeout=30) as resp:
+                data = resp.read()
+            with open(path, "wb") as f:
+                f.write(data)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                out[name] = f.read()
+    if len(out) < len(FEEDS):
+        info = synth_information(stations)
+        out = {
+            "station_information.json": _dump(info),
+            "station_status.json": _dump(synth_status(info)),
+        }
+        for name, data in out.items():
+            with open(os.path.join(directory, name), "wb") as f:
+                f.write(data)
+    return out
+
+
+class FixtureServer:
+
+    def __init__(self, feeds: Dict[str, bytes], port: int = 0, delay: float = 0.0):
+        self._feeds: Dict[str, Tuple[bytes, str]] = {}
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.not_modified = 0
+        for name, data in feeds.items():
+            self.set_feed(name, data)
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                name = self.path.lstrip("/").split("?")[0]
+                with server._lock:
+                    server.requests += 1
+                    entry = server._feeds.get(name)
+                if delay:
+                    time.sleep(delay)
+                if entry is None:
+                    self.send_error(404)
+                    return
+                data, etag = entry
+                if self.headers.get("If-None-Match") == etag:
+                    with server._lock:
+                        server.not_modified += 1
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.send_header("ETag", etag)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self._httpd.daemon_threads = True
+        self.port = self._httpd.server_address[1]
+        self.base_url = f"http://127.0.0.1:{self.port}"
+
+    def set_feed(self, name: str, data: bytes) -> None:
+        etag = '"' + hashlib.sha1(data).hexdigest() + '"'
+        with self._lock:
+            self._feeds[name] = (data, etag)
+
+    def url(self, name: str) -> str:
+        return f"{self.base_url}/{name}"
+
+    def start(self) -> "FixtureServer":
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+def point_bike_at(server: FixtureServer) -> None:
+    # bike reads the feed URLs from its module globals on every fetch.
+    import bike
+
+    bike.HELLO_INFO_URL = server.url("station_information.json")
+    bike.HELLO_STATUS_URL = server.url("station_status.json")
+
+
+def _churn(server: FixtureServer, information: Dict, every: float) -> None:
+    rng = random.Random(3)
+    while True:
+        time.sleep(every)
+        server.set_feed("station_status.json", _dump(synth_status(information, rng)))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--stations", type=int, default=15000)
+    parser.add_argument("--record", action="store_true", help="download the real feeds into the fixture dir")
+    parser.add_argument("--delay-ms", type=float, default=0.0, help="added latency per request")
+    parser.add_argument("--churn", type=float, default=0.0, help="rewrite the status feed every N seconds")
+    args = parser.parse_args()
+
+    feeds = ensure_fixtures(args.stations, args.record)
+    server = FixtureServer(feeds, args.port, args.delay_ms / 1000).start()
+    for name, data in feeds.items():
+        print(f"{server.url(name)}  {len(data) / 1e6:.1f} MB")
+    if args.churn:
+        information = json.loads(feeds["station_information.json"])
+        threading.Thread(target=_churn, args=(server, information, args.churn), daemon=True).start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+# Local stand-in for the GTFS static and GTFS-RT TripUpdates feeds.
+#
+#     python bench/gtfs_fixture.py [--port 8766] [--max-delay 600] [--every 15]
+#
+# Builds a GTFS zip from the timetables in bus_data (one trip per departure,
+# boarding stop "SFC" or "SND", alighting at the other end) and serves it with
+# a TripUpdates feed that gives every trip of the next two hours a random
+# delay, regenerated every --every seconds. Point the API at it with the
+# environment variables printed on start. Needs gtfs-realtime-bindings.
+import argparse
+import io
+import random
+import time
+import zipfile
+from datetime import timedelta
+
+import common  # noqa: F401  puts the API directory on sys.path
+
+from google.transit import gtfs_realtime_pb2
+
+from bus import get_day_type, now_in_tz
+from bus_data import TIMETABLE_FROM_SCHOOL, TIMETABLE_TO_SCHOOL
+from gbfs_fixture import FixtureServer
+
+BOARDING = {"from-school": ("SFC", "SND"), "to-school": ("SND", "SFC")}
+RIDE_MIN = 25
+
+
+def _trips():
+    for direction, table in (("from-school", TIMETABLE_FROM_SCHOOL), ("to-school", TIMETABLE_TO_SCHOOL)):
+        for line, spec in table.items():
+            route = line.split("-", 1)[1]
+            for day_type in ("weekday", "saturday", "holiday"):
+                for h, minutes in (spec.get(day_type) or {}).items():
+                    for m in minutes:
+                        yield f"{direction}-{route}-{day_type}-{int(h):02d}{m:02d}", direction, route, day_type, int(h) * 60 + m
+
+
+def build_static() -> bytes:
+    routes = sorted({t[2] for t in _trips()})
+    trips = ["route_id,service_id,trip_id"]
+    stop_times = ["trip_id,arrival_time,departure_time,stop_id,stop_sequence"]
+    for trip_id, direction, route, day_type, minute in _trips():
+        trips.append(f"{route},{day_type},{trip_id}")
+        board, alight = BOARDING[direction]
+        for seq, stop, at in ((1, board, minute), (2, alight, minute + RIDE_MIN)):
+            hms = f"{at // 60:02d}:{at % 60:02d}:00"
+            stop_times.append(f"{trip_id},{hms},{hms},{stop},{seq}")
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr("routes.txt", "route_id,route_short_name\n" + "".join(f"{r},{r}\n" for r in routes))
+        z.writestr("trips.txt", "\n".join(trips) + "\n")
+        z.writestr("stop_times.txt", "\n".join(stop_times) + "\n")
+    return buf.getvalue()
+
+
+def build_trip_updates(max_delay: int, rng: random.Random) -> bytes:
+    now = now_in_tz("Asia/Tokyo")
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = "2.0"
+    feed.header.timestamp = int(time.time())
+    for day in (0, 1):
+        service = (now + timedelta(days=day)).replace(hour=0, minute=0, second=0, microsecond=0)
+        day_type = get_day_type(service)
+        for trip_id, _, _, trip_day_type, minute in _trips():
+            departs = service + timedelta(minutes=minute)
+            if trip_day_type != day_type or not now - timedelta(minutes=30) <= departs <= now + timedelta(hours=2):
+                continue
+            entity = feed.entity.add()
+            entity.id = trip_id
+            update = entity.trip_update
+            update.trip.trip_id = trip_id
+            update.trip.start_date = service.strftime("%Y%m%d")
+            update.timestamp = feed.header.timestamp
+            stu = update.stop_time_update.add()
+            stu.stop_sequence = 1
+            stu.departure.delay = rng.randint(0, max_delay)
+    return feed.SerializeToString()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--max-delay", type=int, default=600, help="seconds")
+    parser.add_argument("--every", type=float, default=15.0)
+    args = parser.parse_args()
+
+    rng = random.Random(6)
+    server = FixtureServer({
+        "gtfs.zip": build_static(),
+        "trip_updates.pb": build_trip_updates(args.max_delay, rng),
+    }, args.port).start()
+    print(f"GTFS_STATIC={server.url('gtfs.zip')}")
+    print(f"GTFS_RT_TRIP_UPDATES_URL={server.url('trip_updates.pb')}")
+    print("GTFS_BOARDING_STOPS=from-school:SFC,to-school:SND")
+    while True:
+        time.sleep(args.every)
+        server.set_feed("trip_updates.pb", build_trip_updates(args.max_delay, rng))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+# Cold-start guard: times `import app` in fresh interpreters in serverless mode.
+#
+#     python bench/import_time.py [--runs 7] [--budget-ms 60]
+#
+# FastAPI is imported first and reported separately, so the budget only covers
+# what this repo adds on top of the framework. Exits non-zero when the median
+# is over budget or a module that must stay lazy was imported.
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Must not be imported by `import app` in serverless mode.
+LAZY_MODULES = ("boto3", "botocore", "awscrt", "awsiot", "mqtt_subscriber", "httpx", "bike", "uvicorn", "msgpack", "cbor2")
+
+_PROBE = """
+import json, sys, time
+t0 = time.perf_counter()
+import fastapi
+t1 = time.perf_counter()
+import app
+t2 = time.perf_counter()
+print(json.dumps({
+    "fastapi_ms": (t1 - t0) * 1000,
+    "app_ms": (t2 - t1) * 1000,
+    "loaded": [m for m in %r if m in sys.modules],
+}))
+"""
+
+
+def measure(runs: int):
+    env = dict(os.environ, SERVERLESS="1")
+    env.pop("VERCEL", None)
+    samples = []
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, "-c", _PROBE % (LAZY_MODULES,)],
+            cwd=API_DIR, env=env, check=True, capture_output=True, text=True,
+        ).stdout
+        samples.append(json.loads(out.strip().splitlines()[-1]))
+    return samples
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=7)
+    parser.add_argument("--budget-ms", type=float, default=float(os.getenv("IMPORT_BUDGET_MS", "60")))
+    args = parser.parse_args()
+
+    samples = measure(args.runs)
+    fastapi_ms = statistics.median(s["fastapi_ms"] for s in samples)
+    app_ms = statistics.median(s["app_ms"] for s in samples)
+    loaded = sorted({m for s in samples for m in s["loaded"]})
+    print(f"fastapi: {fastapi_ms:7.1f} ms (median of {args.runs})")
+    print(f"app:     {app_ms:7.1f} ms (median of {args.runs}, budget {args.budget_ms:.0f} ms)")
+
+    failed = False
+    if loaded:
+        print(f"FAIL: imported eagerly in serverless mode: {', '.join(loaded)}")
+        failed = True
+    if app_ms > args.budget_ms:
+        print("FAIL: import time over budget")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,90 +1,299 @@
+import asyncio
 import os
-import requests
+import sys
+import time
+from typing import Callable, Dict, List, Optional
+
+import shared_state
+import upstream
+from bike_trend import FORECAST_MIN, trends
+from gbfs_stream import StationStreamParser
+from stations import StationIndex, groups as STATION_GROUPS
 
 HELLO_INFO_URL = "https://api-public.odpt.org/api/v4/gbfs/hellocycling/station_information.json"
 HELLO_STATUS_URL = "https://api-public.odpt.org/api/v4/gbfs/hellocycling/station_status.json"
 
-# Constants (no env)
-SFC_STATION_ID = "5143"
-SHONANDAI_TIER1_STATION_IDS = ["5609", "7395", "11403", "16084"]
-SHONANDAI_TIER2_STATION_IDS = ["12189", "5113", "12189", "4035", "11908"]
+# Named station groups come from station_groups.json; the directional
+# metrics use these three.
+SFC_STATION_ID = (STATION_GROUPS.get("sfc") or [""])[0]
+SHONANDAI_TIER1_STATION_IDS = STATION_GROUPS.get("shonandai-primary", [])
+SHONANDAI_TIER2_STATION_IDS = STATION_GROUPS.get("shonandai-secondary", [])
+WATCHED_STATION_IDS = frozenset(sid for ids in STATION_GROUPS.values() for sid in ids)
+
+# Bounds applied to the feeds' own ttl
+MIN_TTL = 15
+MAX_TTL = 300
+# Followers fall back to fetching themselves if the leader's snapshot is older
+FOLLOWER_MAX_AGE = 2 * MAX_TTL
+# A snapshot this long past its expiry is reported as stale
+STALE_GRACE = 60
+# So is one whose station_status last_updated is older than this, even if
+# the feed keeps answering: the upstream has stopped moving.
+MAX_DATA_AGE = int(os.getenv("BIKE_MAX_DATA_AGE", str(4 * MAX_TTL)))
+
+
+# station_information goes straight into a StationIndex as it is parsed.
+class _InfoParser(StationStreamParser):
+
+    def __init__(self):
+        super().__init__()
+        self.index = StationIndex()
+
+    def add(self, station: Dict) -> None:
+        self.index.add(station)
+
+    def close(self) -> Dict:
+        out = super().close()
+        out["index"] = self.index
+        self.index.version = int(out.get("last_updated") or 0)
+        return out
+
+
+# station_status keeps full records for the grouped stations only; every
+# other station is reduced to [bikes, docks] (docks None when the feed
+# omits it) for nearby queries.
+class _StatusParser(StationStreamParser):
+
+    def __init__(self):
+        super().__init__()
+        self.availability: Dict[str, list] = {}
+
+    def add(self, station: Dict) -> None:
+        sid = str(station.get("station_id"))
+        docks = station.get("num_docks_available")
+        self.availability[sid] = [
+            int(station.get("num_bikes_available", 0) or 0),
+            None if docks is None else int(docks or 0),
+        ]
+        if sid in WATCHED_STATION_IDS:
+            self.stations.append(station)
+
+    def close(self) -> Dict:
+        out = super().close()
+        out["availability"] = self.availability
+        return out
+
+
+_feeds: Dict[str, dict] = {}
+
+
+async def _fetch_stations(url: str, parser_cls) -> dict:
+    feed = await upstream.fetch_stream(url, parser_cls(), conditional=url in _feeds)
+    if feed is None:
+        return _feeds[url]
+    _feeds[url] = feed
+    return feed
+
+
+def _expires_at(fetched_at: float, *feeds: dict) -> float:
+    ttls = [int(f.get("ttl") or 0) for f in feeds if f.get("ttl") is not None]
+    ttl = min(ttls) if ttls else 60
+    ttl = min(max(ttl, MIN_TTL), MAX_TTL)
+    last_updated = max(int(f.get("last_updated") or 0) for f in feeds)
+    expires = last_updated + ttl if last_updated else fetched_at + ttl
+    return min(max(expires, fetched_at + MIN_TTL), fetched_at + MAX_TTL)
 
 
-def compute_bike_metrics() -> dict:
-    info = requests.get(HELLO_INFO_URL, timeout=10).json()
-    status = requests.get(HELLO_STATUS_URL, timeout=10).json()
+_index: Optional[StationIndex] = None
+_index_source = None
+_index_shared_version = 0
 
-    stations = info.get("data", {}).get("stations", [])
+
+def _update_index(info: dict) -> StationIndex:
+    # Rebuilt only when station_information came back with a new body; a 304
+    # hands back the same feed object.
+    global _index, _index_source
+    if info is not _index_source or _index is None:
+        _index = info["index"]
+        _index_source = info
+        if shared_state.is_shared() and shared_state.is_leader():
+            shared_state.publish("stations", _index.to_rows())
+    return _index
+
+
+def station_index() -> Optional[StationIndex]:
+    global _index, _index_shared_version
+    if not shared_state.is_leader():
+        version = shared_state.version("stations")
+        if version and version != _index_shared_version:
+            rows = shared_state.read("stations")
+            if rows is not None:
+                _index = StationIndex.from_rows(rows)
+                _index_shared_version = version
+    return _index
+
+
+async def fetch_snapshot() -> dict:
+    info, status = await asyncio.gather(
+        _fetch_stations(HELLO_INFO_URL, _InfoParser),
+        _fetch_stations(HELLO_STATUS_URL, _StatusParser),
+    )
+    fetched_at = time.time()
+
+    index = _update_index(info)
     statuses = status.get("data", {}).get("stations", [])
-    status_by_id = {s.get("station_id"): s for s in statuses}
-    info_by_id = {s.get("station_id"): s for s in stations}
+    return {
+        "info_by_id": {sid: index.get(sid) for sid in WATCHED_STATION_IDS if index.get(sid) is not None},
+        "status_by_id": {str(s.get("station_id")): s for s in statuses},
+        "availability": status["availability"],
+        "last_updated": int(status.get("last_updated") or 0),
+        "info_last_updated": int(info.get("last_updated") or 0),
+        "fetched_at": fetched_at,
+        "expires_at": _expires_at(fetched_at, info, status),
+    }
+
+
+_snapshot: Optional[dict] = None
+_listeners: List[Callable[[dict], None]] = []
+_refresh_task: Optional[asyncio.Task] = None
+_retry_at = 0.0
+
+
+async def _refresh() -> dict:
+    global _snapshot, _retry_at
+    try:
+        snapshot = await fetch_snapshot()
+        snapshot["trend_by_id"] = trends.update(snapshot, WATCHED_STATION_IDS)
+        _snapshot = snapshot
+    except Exception as e:
+        _retry_at = time.time() + MIN_TTL
+        print(f"bike refresh failed: {e}", file=sys.stderr)
+        raise
+    if shared_state.is_shared() and shared_state.is_leader():
+        shared_state.publish("bike", _snapshot)
+    for fn in _listeners:
+        fn(_snapshot)
+    return _snapshot
+
+
+def add_listener(fn: Callable[[dict], None]) -> None:
+    _listeners.append(fn)
+
+
+def refresh_in_background() -> asyncio.Task:
+    global _refresh_task
+    task = _refresh_task
+    if task is None or task.done() or task.get_loop() is not asyncio.get_running_loop():
+        task = asyncio.get_running_loop().create_task(_refresh())
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        _refresh_task = task
+    return task
 
-    sfc_station_id = SFC_STATION_ID
 
-    def returnable_for(sid: str) -> int:
-        st_status = status_by_id.get(sid) or {}
-        if not st_status:
-            return 0
-        if "num_docks_available" in st_status:
-            return int(st_status.get("num_docks_available", 0) or 0)
-        cap = (info_by_id.get(sid) or {}).get("capacity", 0) or 0
-        nba = int(st_status.get("num_bikes_available", 0) or 0)
-        return max(0, int(cap) - int(nba))
+def current_snapshot() -> Optional[dict]:
+    if not shared_state.is_leader():
+        shared = shared_state.read("bike")
+        if shared is not None:
+            return shared
+    return _snapshot
+
+
+async def get_snapshot() -> dict:
+    if not shared_state.is_leader():
+        shared = shared_state.read("bike")
+        if shared is not None and time.time() - shared["fetched_at"] < FOLLOWER_MAX_AGE:
+            return shared
+    snap = _snapshot
+    if snap is not None:
+        now = time.time()
+        if now >= snap["expires_at"] and now >= _retry_at:
+            refresh_in_background()
+        return snap
+    return await asyncio.shield(refresh_in_background())
+
+
+def is_overdue(snapshot: dict) -> bool:
+    # The refresh has fallen behind the feeds' ttl.
+    return time.time() > snapshot["expires_at"] + STALE_GRACE
+
+
+def is_frozen(snapshot: dict) -> bool:
+    # Fetched on time, but station_status itself has stopped updating.
+    last_updated = snapshot["last_updated"]
+    return bool(last_updated) and time.time() - last_updated > MAX_DATA_AGE
+
+
+def is_stale(snapshot: dict) -> bool:
+    return is_overdue(snapshot) or is_frozen(snapshot)
+
+
+def _with_age(snapshot: dict, payload: dict) -> dict:
+    updated_at = snapshot["last_updated"] or int(snapshot["fetched_at"])
+    payload["updatedAt"] = updated_at
+    payload["ageSeconds"] = max(0, int(time.time() - updated_at))
+    payload["stale"] = is_stale(snapshot)
+    return payload
+
+
+def _rentable_for(snapshot: dict, sid: str) -> int:
+    s = snapshot["status_by_id"].get(sid) or {}
+    return int(s.get("num_bikes_available", 0) or 0)
+
+
+def _returnable_for(snapshot: dict, sid: str) -> int:
+    s = snapshot["status_by_id"].get(sid) or {}
+    if not s:
+        return 0
+    if "num_docks_available" in s:
+        return int(s.get("num_docks_available", 0) or 0)
+    info = snapshot["info_by_id"].get(sid)
+    if info is None and station_index() is not None:
+        info = station_index().get(sid)
+    cap = (info or {}).get("capacity", 0) or 0
+    nba = int(s.get("num_bikes_available", 0) or 0)
+    return max(0, int(cap) - int(nba))
+
+
+def compute_bike_metrics(snapshot: dict) -> dict:
+    status_by_id: Dict[str, dict] = snapshot["status_by_id"]
+
+    sfc_station_id = SFC_STATION_ID
 
     # total_available: bikes at fixed SFC station id
     if sfc_station_id and sfc_station_id in status_by_id:
-        total_available = int((status_by_id.get(sfc_station_id) or {}).get("num_bikes_available", 0) or 0)
+        total_available = _rentable_for(snapshot, sfc_station_id)
     else:
         total_available = 0
 
     primary_ids = SHONANDAI_TIER1_STATION_IDS
     secondary_ids = SHONANDAI_TIER2_STATION_IDS
 
-    total_returnable_primary = sum(returnable_for(sid) for sid in primary_ids)
-    total_returnable_secondary = sum(returnable_for(sid) for sid in secondary_ids)
+    total_returnable_primary = sum(_returnable_for(snapshot, sid) for sid in primary_ids)
+    total_returnable_secondary = sum(_returnable_for(snapshot, sid) for sid in secondary_ids)
 
-    return {
+    return _with_age(snapshot, {
         "total_available": int(total_available),
         "returnable_primary": int(total_returnable_primary),
         "returnable_secondary": int(total_returnable_secondary),
-    }
+    })
 
 
-def compute_bike_metrics_directional() -> dict:
-    info = requests.get(HELLO_INFO_URL, timeout=10).json()
-    status = requests.get(HELLO_STATUS_URL, timeout=10).json()
+def _predicted(snapshot: dict, field: str, minutes: str, current):
+    # The station's projected count, or its current one if it has no trend
+    # yet (or the snapshot predates trends).
+    def count(sid: str) -> int:
+        trend = (snapshot.get("trend_by_id") or {}).get(sid)
+        if trend is None:
+            return current(snapshot, sid)
+        return trend[field][minutes]
+    return count
 
-    stations = info.get("data", {}).get("stations", [])
-    statuses = status.get("data", {}).get("stations", [])
-    status_by_id = {s.get("station_id"): s for s in statuses}
-    info_by_id = {s.get("station_id"): s for s in stations}
-
-    sfc_station_id = SFC_STATION_ID
 
-    def rentable_for(sid: str) -> int:
-        s = status_by_id.get(sid) or {}
-        return int(s.get("num_bikes_available", 0) or 0)
+def _directional(snapshot: dict, rentable, returnable) -> dict:
+    status_by_id: Dict[str, dict] = snapshot["status_by_id"]
 
-    def returnable_for(sid: str) -> int:
-        s = status_by_id.get(sid) or {}
-        if not s:
-            return 0
-        if "num_docks_available" in s:
-            return int(s.get("num_docks_available", 0) or 0)
-        cap = (info_by_id.get(sid) or {}).get("capacity", 0) or 0
-        nba = int(s.get("num_bikes_available", 0) or 0)
-        return max(0, int(cap) - int(nba))
+    sfc_station_id = SFC_STATION_ID
 
     primary_ids = SHONANDAI_TIER1_STATION_IDS
     secondary_ids = SHONANDAI_TIER2_STATION_IDS
 
-    sfc_rentable = rentable_for(sfc_station_id) if sfc_station_id in status_by_id else 0
-    sfc_returnable = returnable_for(sfc_station_id) if sfc_station_id in status_by_id else 0
+    sfc_rentable = rentable(sfc_station_id) if sfc_station_id in status_by_id else 0
+    sfc_returnable = returnable(sfc_station_id) if sfc_station_id in status_by_id else 0
 
-    shonan_rentable_primary = sum(rentable_for(sid) for sid in primary_ids)
-    shonan_rentable_secondary = sum(rentable_for(sid) for sid in secondary_ids)
-    shonan_returnable_primary = sum(returnable_for(sid) for sid in primary_ids)
-    shonan_returnable_secondary = sum(returnable_for(sid) for sid in secondary_ids)
+    shonan_rentable_primary = sum(rentable(sid) for sid in primary_ids if sid in status_by_id)
+    shonan_rentable_secondary = sum(rentable(sid) for sid in secondary_ids if sid in status_by_id)
+    shonan_returnable_primary = sum(returnable(sid) for sid in primary_ids if sid in status_by_id)
+    shonan_returnable_secondary = sum(returnable(sid) for sid in secondary_ids if sid in status_by_id)
 
     return {
         "go": {
@@ -103,3 +312,77 @@ def compute_bike_metrics_directional() -> dict:
         },
     }
 
+
+def compute_bike_metrics_directional(snapshot: dict) -> dict:
+    payload = _directional(
+        snapshot,
+        lambda sid: _rentable_for(snapshot, sid),
+        lambda sid: _returnable_for(snapshot, sid),
+    )
+    # The same figures projected ahead from each station's recent trend.
+    payload["forecast"] = {
+        str(m): _directional(
+            snapshot,
+            _predicted(snapshot, "bikes", str(m), _rentable_for),
+            _predicted(snapshot, "docks", str(m), _returnable_for),
+        )
+        for m in FORECAST_MIN
+    }
+    return _with_age(snapshot, payload)
+
+
+def _station_entry(snapshot: dict, sid: str, index: Optional[StationIndex]) -> dict:
+    info = (index.get(sid) if index is not None else None) or snapshot["info_by_id"].get(sid) or {}
+    counts = (snapshot.get("availability") or {}).get(sid)
+    if sid in snapshot["status_by_id"] or counts is None:
+        rentable = _rentable_for(snapshot, sid)
+        returnable = _returnable_for(snapshot, sid)
+    else:
+        rentable, returnable = counts
+        if returnable is None:
+            returnable = max(0, int(info.get("capacity", 0) or 0) - rentable)
+    return {
+        "id": sid,
+        "name": info.get("name"),
+        "rentable": rentable,
+        "returnable": returnable,
+        "reporting": sid in snapshot["status_by_id"] or counts is not None,
+    }
+
+
+def compute_group_metrics(snapshot: dict, group: str) -> dict:
+    ids = STATION_GROUPS.get(group)
+    if ids is None:
+        raise LookupError(f"unknown station group: {group}")
+    index = station_index()
+    trend_by_id = snapshot.get("trend_by_id") or {}
+    stations = []
+    for sid in ids:
+        entry = _station_entry(snapshot, sid, index)
+        entry["trend"] = trend_by_id.get(sid)
+        stations.append(entry)
+    return _with_age(snapshot, {
+        "group": group,
+        "rentable": sum(s["rentable"] for s in stations),
+        "returnable": sum(s["returnable"] for s in stations),
+        "stations": stations,
+    })
+
+
+def compute_nearby(snapshot: dict, lat: float, lon: float, radius: float, limit: int) -> dict:
+    index = station_index()
+    if index is None:
+        raise LookupError("station information not loaded yet")
+    stations = []
+    for distance, i in index.nearby(lat, lon, radius, limit):
+        entry = _station_entry(snapshot, index.ids[i], index)
+        entry.update({"lat": index.lat[i], "lon": index.lon[i], "distanceMeters": round(distance)})
+        stations.append(entry)
+    return _with_age(snapshot, {
+        "lat": lat,
+        "lon": lon,
+        "radiusMeters": radius,
+        "rentable": sum(s["rentable"] for s in stations),
+        "returnable": sum(s["returnable"] for s in stations),
+        "stations": stations,
+    })
@@ -0,0 +1,150 @@
+import os
+import threading
+from array import array
+from typing import Dict, Iterable, Optional
+
+HISTORY_SIZE = int(os.getenv("BIKE_HISTORY_SIZE", "64"))
+TREND_WINDOW_MIN = int(os.getenv("BIKE_TREND_WINDOW_MIN", "30"))
+FORECAST_MIN = tuple(int(m) for m in os.getenv("BIKE_FORECAST_MIN", "10,20").split(","))
+# Below this many samples, or this short a span, the trend is taken as flat.
+MIN_SAMPLES = 3
+MIN_SPAN_SECS = 120
+
+# Running sums kept per station over the trend window.
+_T, _TT, _B, _TB, _D, _TD = range(6)
+_NSUMS = 6
+
+
+# One fixed-size ring of (timestamp, bikes, docks) per station, laid out as
+# consecutive slot ranges in flat arrays and indexed by a small integer
+# assigned on first sight of a station ID. Each station keeps least-squares
+# running sums over the trend window, updated as samples enter and leave it
+# (as CongestionHistory does for its windows), so a snapshot costs O(1) per
+# station and a prediction is read straight from the sums.
+class StationTrends:
+
+    def __init__(self, capacity: int = HISTORY_SIZE, window_min: int = TREND_WINDOW_MIN):
+        self.capacity = capacity
+        self.window = window_min * 60
+        self._index: Dict[str, int] = {}
+        self._ts = array("d")
+        self._bikes = array("H")
+        self._docks = array("H")
+        self._seq = array("q")
+        self._start = array("q")
+        self._sums = array("d")
+        # Times enter the sums relative to the first sample seen, which keeps
+        # the squared terms small enough for doubles.
+        self._origin: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def _register(self, sid: str) -> int:
+        i = len(self._index)
+        self._ts.extend(array("d", bytes(8 * self.capacity)))
+        self._bikes.extend(array("H", bytes(2 * self.capacity)))
+        self._docks.extend(array("H", bytes(2 * self.capacity)))
+        self._seq.append(0)
+        self._start.append(0)
+        self._sums.extend(array("d", bytes(8 * _NSUMS)))
+        self._index[sid] = i
+        return i
+
+    def _add(self, i: int, slot: int, sign: int) -> None:
+        t = self._ts[slot] - self._origin
+        b = self._bikes[slot]
+        d = self._docks[slot]
+        s = i * _NSUMS
+        sums = self._sums
+        sums[s + _T] += sign * t
+        sums[s + _TT] += sign * t * t
+        sums[s + _B] += sign * b
+        sums[s + _TB] += sign * t * b
+        sums[s + _D] += sign * d
+        sums[s + _TD] += sign * t * d
+
+    def _evict_one(self, i: int) -> None:
+        self._add(i, i * self.capacity + self._start[i] % self.capacity, -1)
+        self._start[i] += 1
+
+    def append(self, sid: str, ts: float, bikes: int, docks: int) -> bool:
+        # False when the sample is not newer than the station's latest one,
+        # e.g. a status feed that has not changed since the last refresh.
+        with self._lock:
+            if self._origin is None:
+                self._origin = ts
+            i = self._index.get(sid)
+            if i is None:
+                i = self._register(sid)
+            base = i * self.capacity
+            seq = self._seq[i]
+            if seq and ts <= self._ts[base + (seq - 1) % self.capacity]:
+                return False
+            if seq - self._start[i] >= self.capacity:
+                self._evict_one(i)
+            slot = base + seq % self.capacity
+            self._ts[slot] = ts
+            self._bikes[slot] = min(max(int(bikes), 0), 65535)
+            self._docks[slot] = min(max(int(docks), 0), 65535)
+            self._seq[i] = seq + 1
+            self._add(i, slot, 1)
+            cutoff = ts - self.window
+            while self._start[i] < self._seq[i] - 1 and self._ts[base + self._start[i] % self.capacity] < cutoff:
+                self._evict_one(i)
+            return True
+
+    def _slopes(self, i: int):
+        # Least-squares slopes of bikes and docks in units per second.
+        n = self._seq[i] - self._start[i]
+        base = i * self.capacity
+        first = self._ts[base + self._start[i] % self.capacity]
+        last = self._ts[base + (self._seq[i] - 1) % self.capacity]
+        if n < MIN_SAMPLES or last - first < MIN_SPAN_SECS:
+            return n, 0.0, 0.0
+        s = self._sums[i * _NSUMS:(i + 1) * _NSUMS]
+        denom = n * s[_TT] - s[_T] * s[_T]
+        if denom <= 0:
+            return n, 0.0, 0.0
+        return n, (n * s[_TB] - s[_T] * s[_B]) / denom, (n * s[_TD] - s[_T] * s[_D]) / denom
+
+    def trend(self, sid: str) -> Optional[Dict]:
+        # Latest counts projected FORECAST_MIN minutes past the latest sample,
+        # clamped to the station's size (bikes + docks).
+        with self._lock:
+            i = self._index.get(sid)
+            if i is None or self._seq[i] == 0:
+                return None
+            slot = i * self.capacity + (self._seq[i] - 1) % self.capacity
+            ts, bikes, docks = self._ts[slot], self._bikes[slot], self._docks[slot]
+            n, db, dd = self._slopes(i)
+        size = bikes + docks
+        return {
+            "at": ts,
+            "samples": n,
+            "bikesPerMinute": round(db * 60, 3),
+            "docksPerMinute": round(dd * 60, 3),
+            "bikes": {str(m): int(round(min(max(bikes + db * m * 60, 0), size))) for m in FORECAST_MIN},
+            "docks": {str(m): int(round(min(max(docks + dd * m * 60, 0), size))) for m in FORECAST_MIN},
+        }
+
+    def update(self, snapshot: dict, station_ids: Iterable[str]) -> Dict[str, Dict]:
+        # Records the snapshot's status for the given stations and returns
+        # their trends, keyed by station ID.
+        ts = float(snapshot.get("last_updated") or snapshot["fetched_at"])
+        status_by_id = snapshot["status_by_id"]
+        out = {}
+        for sid in station_ids:
+            s = status_by_id.get(sid)
+            if not s:
+                continue
+            bikes = int(s.get("num_bikes_available", 0) or 0)
+            if "num_docks_available" in s:
+                docks = int(s.get("num_docks_available", 0) or 0)
+            else:
+                cap = (snapshot["info_by_id"].get(sid) or {}).get("capacity", 0) or 0
+                docks = max(0, int(cap) - bikes)
+            self.append(sid, float(s.get("last_reported") or ts), bikes, docks)
+            out[sid] = self.trend(sid)
+        return out
+
+
+trends = StationTrends()
@@ -0,0 +1,68 @@
+import asyncio
+import threading
+from typing import AsyncIterator, Dict, List, Set, Tuple
+
+from http_cache import dump_json
+
+KEEPALIVE_SECS = 15
+
+
+# Keeps only the latest serialized state per event name. Subscribers remember
+# the last version they sent, so a slow client skips straight to the newest
+# state instead of draining a backlog. publish() may be called from any thread.
+class Broadcaster:
+
+    def __init__(self):
+        self._state: Dict[str, Tuple[int, bytes]] = {}
+        self._version = 0
+        self._subscribers: Set[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = set()
+        self._lock = threading.Lock()
+
+    @property
+    def subscriber_count(self) -> int:
+        return len(self._subscribers)
+
+    def publish(self, event: str, data) -> bool:
+        body = dump_json(data)
+        with self._lock:
+            current = self._state.get(event)
+            if current is not None and current[1] == body:
+                return False
+            self._version += 1
+            self._state[event] = (self._version, body)
+            subscribers = list(self._subscribers)
+        for loop, wakeup in subscribers:
+            try:
+                loop.call_soon_threadsafe(wakeup.set)
+            except RuntimeError:
+                pass
+        return True
+
+    def changes_since(self, seen: int) -> Tuple[int, List[Tuple[str, bytes]]]:
+        with self._lock:
+            changed = [(name, body) for name, (v, body) in self._state.items() if v > seen]
+            return self._version, changed
+
+    async def stream(self) -> AsyncIterator[bytes]:
+        wakeup = asyncio.Event()
+        entry = (asyncio.get_running_loop(), wakeup)
+        with self._lock:
+            self._subscribers.add(entry)
+        seen = 0
+        try:
+            yield b"retry: 3000\n\n"
+            while True:
+                wakeup.clear()
+                seen, changed = self.changes_since(seen)
+                for name, body in changed:
+                    yield b"event: " + name.encode() + b"\ndata: " + body + b"\n\n"
+                try:
+                    await asyncio.wait_for(wakeup.wait(), KEEPALIVE_SECS)
+                except asyncio.TimeoutError:
+                    yield b": keepalive\n\n"
+        finally:
+            with self._lock:
+                self._subscribers.discard(entry)
+
+
+broadcaster = Broadcaster()
@@ -1,6 +1,13 @@
-from datetime import datetime, timedelta
+from array import array
+from bisect import bisect_left
+from datetime import date, datetime, time as dtime, timedelta
+import heapq
 import os
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
+
+from bus_data import TIMETABLE_FROM_SCHOOL, TIMETABLE_TO_SCHOOL
+import service_calendar
+from service_calendar import DAY_TYPES
 
 try:
     from zoneinfo import ZoneInfo
@@ -17,70 +24,186 @@ def now_in_tz(tz_name: str) -> datetime:
 
 
 def get_day_type(d: datetime) -> str:
-    wd = d.weekday()
-    if wd == 5:
-        return "saturday"
-    if wd == 6:
-        return "holiday"
-    return "weekday"
-
-
-def _expand_day_departures(timetable: Dict, line_name: str, day_start: datetime, day_type: str) -> List[datetime]:
-    table = (timetable.get(line_name, {}).get(day_type)) or {}
-    out: List[datetime] = []
-    for h in range(0, 25):
-        mins = table.get(h)
-        if not mins:
-            continue
-        for m in mins:
-            dt = day_start.replace(hour=h, minute=m, second=0, microsecond=0)
-            out.append(dt)
-    out.sort()
-    return out
+    return service_calendar.calendar.day_type(d)
 
 
-def next_buses(timetable: Dict, line_name: str, from_date: Optional[datetime] = None, count: int = 5) -> List[Dict]:
-    if line_name not in timetable:
-        raise KeyError(f"未知の系統: {line_name}")
-    if from_date is None:
-        from_date = now_in_tz(os.environ.get("TZ", "Asia/Tokyo"))
+def compile_timetable(timetable: Dict) -> Dict:
+    lines = list(timetable.keys())
+    by_line: Dict[str, Dict[str, array]] = {}
+    merged: Dict[str, Tuple[array, List[str]]] = {}
+    for day_type in DAY_TYPES:
+        per_line: List[List[Tuple[int, int, str]]] = []
+        for idx, line in enumerate(lines):
+            table = (timetable.get(line, {}).get(day_type)) or {}
+            mins = sorted(int(h) * 60 + int(m) for h, ms in table.items() for m in (ms or []))
+            by_line.setdefault(line, {})[day_type] = array("H", mins)
+            per_line.append([(t, idx, line) for t in mins])
+        merged_mins = array("H")
+        merged_lines: List[str] = []
+        for t, _, line in heapq.merge(*per_line):
+            merged_mins.append(t)
+            merged_lines.append(line)
+        merged[day_type] = (merged_mins, merged_lines)
+    return {"lines": lines, "by_line": by_line, "merged": merged}
+
+
+_compiled: Dict[int, Tuple[Dict, Dict]] = {}
+
+
+def get_index(timetable: Dict) -> Dict:
+    entry = _compiled.get(id(timetable))
+    if entry is not None and entry[0] is timetable:
+        return entry[1]
+    index = compile_timetable(timetable)
+    _compiled[id(timetable)] = (timetable, index)
+    return index
 
+
+def set_index(timetable: Dict, index: Dict) -> None:
+    _compiled[id(timetable)] = (timetable, index)
+
+
+def forget_index(timetable: Dict) -> None:
+    entry = _compiled.get(id(timetable))
+    if entry is not None and entry[0] is timetable:
+        del _compiled[id(timetable)]
+
+
+def _minute_of_day_ceil(d: datetime) -> int:
+    m = d.hour * 60 + d.minute
+    if d.second or d.microsecond:
+        m += 1
+    return m
+
+
+def _collect(index: Dict, line_name: Optional[str], from_date: datetime, count: int) -> List[Dict]:
     results: List[Dict] = []
-    probe = from_date
+    day_start = from_date.replace(hour=0, minute=0, second=0, microsecond=0)
+    start_min = _minute_of_day_ceil(from_date)
     for day_offset in range(0, 7):
         if len(results) >= count:
             break
-        day_start = probe.replace(hour=0, minute=0, second=0, microsecond=0)
-        day_type = get_day_type(probe)
-        deps = _expand_day_departures(timetable, line_name, day_start, day_type)
-        filtered = [dt for dt in deps if (day_offset > 0 or dt >= from_date)]
-        for dt in filtered:
-            results.append({"line": line_name, "dayType": day_type, "datetime": dt})
-            if len(results) >= count:
-                break
-        probe = day_start + timedelta(days=1)
+        day_type = get_day_type(day_start)
+        if line_name is None:
+            mins, lines = index["merged"][day_type]
+        else:
+            mins, lines = index["by_line"][line_name][day_type], None
+        i = bisect_left(mins, start_min) if day_offset == 0 else 0
+        stop = min(len(mins), i + count - len(results))
+        for j in range(i, stop):
+            results.append({
+                "line": lines[j] if lines is not None else line_name,
+                "dayType": day_type,
+                "datetime": day_start + timedelta(minutes=mins[j]),
+            })
+        day_start = day_start + timedelta(days=1)
     return results
 
 
+def next_buses(timetable: Dict, line_name: str, from_date: Optional[datetime] = None, count: int = 5) -> List[Dict]:
+    if line_name not in timetable:
+        raise KeyError(f"未知の系統: {line_name}")
+    if from_date is None:
+        from_date = now_in_tz(os.environ.get("TZ", "Asia/Tokyo"))
+    return _collect(get_index(timetable), line_name, from_date, count)
+
+
 def next_across_all(timetable: Dict, from_date: Optional[datetime] = None, count: int = 5) -> List[Dict]:
-    lines = list(timetable.keys())
     if from_date is None:
         from_date = now_in_tz(os.environ.get("TZ", "Asia/Tokyo"))
-    bucket: List[Dict] = []
-    probe = from_date
-    for day_offset in range(0, 7):
-        if len(bucket) >= count:
-            break
-        day_start = probe.replace(hour=0, minute=0, second=0, microsecond=0)
-        for line in lines:
-            day_type = get_day_type(probe)
-            deps = _expand_day_departures(timetable, line, day_start, day_type)
-            filtered = [dt for dt in deps if (day_offset > 0 or dt >= from_date)]
-            for dt in filtered:
-                bucket.append({"line": line, "dayType": day_type, "datetime": dt})
-        probe = day_start + timedelta(days=1)
-    bucket.sort(key=lambda x: x["datetime"]) 
-    return bucket[:count]
+    return _collect(get_index(timetable), None, from_date, count)
+
+
+# Batch lookups work on a "span": every departure between a start date and
+# a number of days later as one sorted array of minutes since the start date,
+# each day laid out with its calendar day type. All query times are then
+# resolved with one searchsorted (NumPy, when installed) or bisect each.
+SEARCH_DAYS = 7
+_spans: Dict[Tuple, Tuple[Dict, array, List[str]]] = {}
+_MAX_SPANS = 16
+_MINUTES = [timedelta(minutes=m) for m in range(1440)]
+
+
+def _numpy():
+    try:
+        import numpy
+    except Exception:
+        return None
+    return numpy
+
+
+def compile_days(index: Dict, line_name: Optional[str], ordinals: List[int]) -> Tuple[array, List[str]]:
+    # Departures of the given service dates (sorted ordinals) laid end to end,
+    # as minutes counted from the first: the k-th date occupies
+    # [k * 1440, (k + 1) * 1440) whatever the gap to the date before it.
+    key = (id(index), line_name, tuple(ordinals))
+    cached = _spans.get(key)
+    if cached is not None and cached[0] is index:
+        return cached[1], cached[2]
+    mins = array("l")
+    lines: List[str] = []
+    for k, o in enumerate(ordinals):
+        day_type = get_day_type(date.fromordinal(o))
+        if line_name is None:
+            day_mins, day_lines = index["merged"][day_type]
+            lines.extend(day_lines)
+        else:
+            day_mins = index["by_line"][line_name][day_type]
+            lines.extend([line_name] * len(day_mins))
+        base = k * 1440
+        mins.extend(base + m for m in day_mins)
+    if len(_spans) >= _MAX_SPANS:
+        _spans.clear()
+    _spans[key] = (index, mins, lines)
+    return mins, lines
+
+
+def next_batch(timetable: Dict, times: List[datetime], count: int = 5, line_name: Optional[str] = None) -> List[List[Dict]]:
+    # Same results as calling next_buses / next_across_all for each time;
+    # the times are expected to share one tzinfo (or all be naive). Only the
+    # SEARCH_DAYS service dates following each distinct query date are
+    # compiled, so the cost does not depend on how far apart the times are.
+    if line_name is not None and line_name not in timetable:
+        raise KeyError(f"未知の系統: {line_name}")
+    if not times:
+        return []
+    index = get_index(timetable)
+    query_dates = {t.toordinal() for t in times}
+    ordinals = sorted({o + d for o in query_dates for d in range(SEARCH_DAYS)})
+    if ordinals[-1] > date.max.toordinal():
+        raise ValueError("query time too close to the end of the calendar")
+    slot = {o: k for k, o in enumerate(ordinals)}
+    mins, lines = compile_days(index, line_name, ordinals)
+
+    # A query date's SEARCH_DAYS dates are consecutive, so they occupy
+    # consecutive slots and the search ends at the slot after the last one.
+    offsets = [slot[t.toordinal()] * 1440 for t in times]
+    starts = [o + _minute_of_day_ceil(t) for o, t in zip(offsets, times)]
+    ends = [o + SEARCH_DAYS * 1440 for o in offsets]
+    np = _numpy()
+    if np is not None:
+        arr = np.frombuffer(mins, dtype=np.dtype(f"i{mins.itemsize}"))
+        lo = np.searchsorted(arr, starts).tolist()
+        hi = np.searchsorted(arr, ends).tolist()
+    else:
+        lo = [bisect_left(mins, x) for x in starts]
+        hi = [bisect_left(mins, x) for x in ends]
+
+    tzinfo = times[0].tzinfo
+    day_starts = [datetime.combine(date.fromordinal(o), dtime(), tzinfo) for o in ordinals]
+    day_types = [get_day_type(d) for d in day_starts]
+    results: List[List[Dict]] = []
+    for i, end in zip(lo, hi):
+        items = []
+        for j in range(i, min(end, i + count)):
+            d, m = divmod(mins[j], 1440)
+            items.append({
+                "line": lines[j],
+                "dayType": day_types[d],
+                "datetime": day_starts[d] + _MINUTES[m],
+            })
+        results.append(items)
+    return results
 
 
 def shape_item(now: datetime, item: Dict, tz_name: str = "Asia/Tokyo") -> Dict:
@@ -99,10 +222,14 @@ def shape_item(now: datetime, item: Dict, tz_name: str = "Asia/Tokyo") -> Dict:
             if now.tzinfo is None:
                 now = now.replace(tzinfo=tz)
 
-    minutes_until = max(0, round((dt - now).total_seconds() / 60))
+    rt = item.get("realtime")
+    expected = dt
+    if rt is not None:
+        expected = datetime.fromtimestamp(rt["predicted"], dt.tzinfo)
+    minutes_until = max(0, round((expected - now).total_seconds() / 60))
     local_str = dt.strftime("%Y/%m/%d %H:%M")
     time_str = dt.strftime("%H:%M")
-    return {
+    out = {
         "line": item["line"],
         "dayType": item["dayType"],
         "iso": dt.isoformat(),
@@ -110,3 +237,17 @@ def shape_item(now: datetime, item: Dict, tz_name: str = "Asia/Tokyo") -> Dict:
         "time": time_str,
         "minutesUntil": minutes_until,
     }
+    if rt is not None:
+        out["realtime"] = {
+            "iso": expected.isoformat(),
+            "time": expected.strftime("%H:%M"),
+            "delaySeconds": rt["delay"],
+            "canceled": rt["canceled"],
+            "vehicle": rt.get("vehicle"),
+            "updatedAt": rt["updatedAt"],
+        }
+    return out
+
+
+get_index(TIMETABLE_FROM_SCHOOL)
+get_index(TIMETABLE_TO_SCHOOL)
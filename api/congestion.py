@@ -0,0 +1,267 @@
+import os
+import sys
+import threading
+import time
+from array import array
+from typing import Callable, Dict, List, Optional, Tuple
+
+WINDOWS_MIN = tuple(int(w) for w in os.getenv("CONGESTION_WINDOWS_MIN", "1,5,15").split(","))
+HISTORY_SIZE = int(os.getenv("CONGESTION_HISTORY_SIZE", "16384"))
+SENSOR_HISTORY_SIZE = int(os.getenv("CONGESTION_SENSOR_HISTORY_SIZE", "4096"))
+MAX_COUNT = 511
+# A sensor silent for longer than this is reported stale and drops out of
+# the combined count.
+STALE_SECS = float(os.getenv("CONGESTION_STALE_SECS", "60"))
+PERCENTILES = (50, 90, 95)
+VIEW_MIN_INTERVAL = 0.25
+VIEW_HISTORY_POINTS = 300
+# History points shared out between the sensors in a view, which keeps the
+# published view inside its shared-state slot however many sensors report.
+VIEW_SENSOR_HISTORY_BUDGET = 6000
+VIEW_SENSOR_HISTORY_MIN = 10
+
+
+# Fixed-size ring of (timestamp, count) samples. Every window keeps a running
+# sum and a count histogram that are updated as samples enter and leave it,
+# so append() is O(1) and allocates no containers; percentiles and max are
+# read from the histogram on query.
+class CongestionHistory:
+
+    def __init__(self, capacity: int = HISTORY_SIZE, windows_min=WINDOWS_MIN, max_count: int = MAX_COUNT):
+        self.capacity = capacity
+        self.windows = tuple(int(w) * 60 for w in windows_min)
+        self.max_count = max_count
+        self._ts = array("d", bytes(8 * capacity))
+        self._counts = array("H", bytes(2 * capacity))
+        self._seq = 0
+        self._start = array("q", bytes(8 * len(self.windows)))
+        self._sums = array("q", bytes(8 * len(self.windows)))
+        self._hist = [array("I", bytes(4 * (max_count + 1))) for _ in self.windows]
+        self._lock = threading.Lock()
+        self._listeners: List[Callable[[int, float], None]] = []
+
+    def add_listener(self, fn: Callable[[int, float], None]) -> None:
+        self._listeners.append(fn)
+
+    def _evict_one(self, w: int) -> None:
+        slot = self._start[w] % self.capacity
+        c = self._counts[slot]
+        self._sums[w] -= c
+        self._hist[w][c] -= 1
+        self._start[w] += 1
+
+    def _evict_older(self, w: int, cutoff: float) -> None:
+        ts = self._ts
+        cap = self.capacity
+        while self._start[w] < self._seq and ts[self._start[w] % cap] < cutoff:
+            self._evict_one(w)
+
+    def append(self, count: int, ts: Optional[float] = None) -> None:
+        if ts is None:
+            ts = time.time()
+        c = min(max(int(count), 0), self.max_count)
+        with self._lock:
+            overwritten = self._seq - self.capacity
+            for w in range(len(self.windows)):
+                if self._start[w] <= overwritten:
+                    self._evict_one(w)
+            slot = self._seq % self.capacity
+            self._ts[slot] = ts
+            self._counts[slot] = c
+            self._seq += 1
+            for w, seconds in enumerate(self.windows):
+                self._sums[w] += c
+                self._hist[w][c] += 1
+                self._evict_older(w, ts - seconds)
+        for fn in self._listeners:
+            fn(c, ts)
+
+    def latest(self) -> Tuple[float, int]:
+        with self._lock:
+            if self._seq == 0:
+                return 0.0, 0
+            slot = (self._seq - 1) % self.capacity
+            return self._ts[slot], self._counts[slot]
+
+    def _window_index(self, window_min: int) -> int:
+        try:
+            return self.windows.index(int(window_min) * 60)
+        except ValueError:
+            raise KeyError(f"unsupported window: {window_min}")
+
+    def stats(self, window_min: int, now: Optional[float] = None) -> Dict:
+        w = self._window_index(window_min)
+        if now is None:
+            now = time.time()
+        with self._lock:
+            self._evict_older(w, now - self.windows[w])
+            n = self._seq - self._start[w]
+            total = self._sums[w]
+            hist = self._hist[w][:]
+        out: Dict = {"windowMinutes": int(window_min), "samples": n}
+        if n == 0:
+            out.update({"mean": None, "max": None})
+            out.update({f"p{p}": None for p in PERCENTILES})
+            return out
+        out["mean"] = round(total / n, 2)
+        ranks = [(p, max(1, -(-p * n // 100))) for p in PERCENTILES]
+        seen = 0
+        ri = 0
+        top = 0
+        for value, k in enumerate(hist):
+            if not k:
+                continue
+            top = value
+            seen += k
+            while ri < len(ranks) and seen >= ranks[ri][1]:
+                out[f"p{ranks[ri][0]}"] = value
+                ri += 1
+        out["max"] = top
+        return out
+
+    def samples(self, window_min: int, limit: int = 500, now: Optional[float] = None) -> List[List]:
+        w = self._window_index(window_min)
+        if now is None:
+            now = time.time()
+        with self._lock:
+            self._evict_older(w, now - self.windows[w])
+            start, end = self._start[w], self._seq
+            step = max(1, -(-(end - start) // max(1, limit)))
+            return [
+                [self._ts[i % self.capacity], self._counts[i % self.capacity]]
+                for i in range(start, end, step)
+            ]
+
+
+# Per-sensor latest counts live in parallel arrays indexed by a small integer
+# assigned on first sight of a topic. The combined count is maintained as a
+# running total, so record() is O(1) no matter how many sensors report;
+# sensors that have gone stale are taken out of it by a sweep that runs at
+# most once per second.
+class SensorTable:
+
+    def __init__(self, sensor_capacity: int = SENSOR_HISTORY_SIZE, combined_capacity: int = HISTORY_SIZE,
+                 stale_secs: float = STALE_SECS):
+        self.sensor_capacity = sensor_capacity
+        self.stale_secs = stale_secs
+        self.combined = CongestionHistory(combined_capacity)
+        self._index: Dict[str, int] = {}
+        self._names: List[str] = []
+        self._histories: List[CongestionHistory] = []
+        self._latest = array("H")
+        self._latest_ts = array("d")
+        # What each sensor currently adds to _total: its latest count while
+        # it is live, 0 once it has gone stale.
+        self._contrib = array("H")
+        self._total = 0
+        self._expire_at = 0.0
+        self._lock = threading.Lock()
+        self._view: Optional[Dict] = None
+        self._view_at = 0.0
+        self._listeners: List[Callable[[str, int, float], None]] = []
+
+    def add_listener(self, fn: Callable[[str, int, float], None]) -> None:
+        self._listeners.append(fn)
+
+    def _register(self, sensor: str) -> int:
+        # Called with _lock held.
+        i = len(self._names)
+        self._histories.append(CongestionHistory(self.sensor_capacity))
+        self._latest.append(0)
+        self._latest_ts.append(0.0)
+        self._contrib.append(0)
+        self._names.append(sensor)
+        self._index[sensor] = i
+        return i
+
+    def record(self, sensor: str, count: int, ts: Optional[float] = None) -> None:
+        if ts is None:
+            ts = time.time()
+        c = min(max(int(count), 0), MAX_COUNT)
+        with self._lock:
+            i = self._index.get(sensor)
+            if i is None:
+                i = self._register(sensor)
+            self._total += c - self._contrib[i]
+            self._contrib[i] = c
+            self._latest[i] = c
+            self._latest_ts[i] = ts
+            if ts >= self._expire_at:
+                self._expire(ts)
+            total = self._total
+            history = self._histories[i]
+        history.append(c, ts)
+        self.combined.append(total, ts)
+        # Listeners (archive, broadcast, ...) are independent of each other
+        # and of the table: one failing must not skip the rest.
+        for fn in self._listeners:
+            try:
+                fn(sensor, c, ts)
+            except Exception as e:
+                print(f"congestion listener {getattr(fn, '__name__', fn)}: {e!r}", file=sys.stderr)
+
+    def _expire(self, now: float) -> None:
+        # Called with _lock held.
+        self._expire_at = now + 1
+        cutoff = now - self.stale_secs
+        contrib = self._contrib
+        latest_ts = self._latest_ts
+        for j in range(len(contrib)):
+            if contrib[j] and latest_ts[j] < cutoff:
+                self._total -= contrib[j]
+                contrib[j] = 0
+
+    def sensor_history(self, sensor: str) -> CongestionHistory:
+        i = self._index.get(sensor)
+        if i is None:
+            raise LookupError(f"unknown sensor: {sensor}")
+        return self._histories[i]
+
+    def latest(self) -> Dict[str, int]:
+        with self._lock:
+            return {name: self._latest[i] for i, name in enumerate(self._names)}
+
+    def updated_at(self) -> Dict[str, float]:
+        with self._lock:
+            return {name: self._latest_ts[i] for i, name in enumerate(self._names)}
+
+    def view(self, now: Optional[float] = None) -> Dict:
+        # Everything the read endpoints need, in a JSON-friendly shape so it can
+        # be published to other workers; rebuilt at most every VIEW_MIN_INTERVAL.
+        if now is None:
+            now = time.time()
+        if self._view is not None and now - self._view_at < VIEW_MIN_INTERVAL:
+            return self._view
+        with self._lock:
+            sources = [("*", self.combined)] + list(zip(self._names, self._histories))
+        sensor_points = min(VIEW_HISTORY_POINTS, max(VIEW_SENSOR_HISTORY_MIN,
+                                                     VIEW_SENSOR_HISTORY_BUDGET // max(1, len(sources) - 1)))
+        longest = max(WINDOWS_MIN)
+        shortest = min(WINDOWS_MIN)
+        updated_at, count = self.combined.latest()
+        windows = {
+            name: {str(w): h.stats(w, now) for w in WINDOWS_MIN}
+            for name, h in sources
+        }
+        view = {
+            "updatedAt": updated_at,
+            "count": count,
+            "sensors": self.latest(),
+            "sensorsUpdatedAt": self.updated_at(),
+            "rates": {
+                name: round(w[str(shortest)]["samples"] / (shortest * 60), 3)
+                for name, w in windows.items()
+            },
+            "windows": windows,
+            "history": {
+                name: h.samples(longest, VIEW_HISTORY_POINTS if name == "*" else sensor_points, now)
+                for name, h in sources
+            },
+        }
+        self._view = view
+        self._view_at = now
+        return view
+
+
+sensors = SensorTable()
+history = sensors.combined
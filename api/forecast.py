@@ -0,0 +1,140 @@
+import os
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from typing import Dict, List, NamedTuple, Optional
+
+import gtfs_realtime
+from bus import next_across_all, now_in_tz
+from timetable_store import store as timetable_store
+
+# The LiDAR watches the queue at the SFC stop, so forecasts use the
+# from-school departures.
+DIRECTION = "from-school"
+# Seats plus standing room. Keys are line names ("下校-湘25") or route
+# names ("湘25"); the twin-liner articulated buses on 湘25 carry about 110.
+DEFAULT_CAPACITY = int(os.getenv("BUS_CAPACITY_DEFAULT", "70"))
+LINE_CAPACITIES = {
+    k.strip(): int(v)
+    for k, _, v in (
+        part.partition("=") for part in os.getenv("BUS_CAPACITIES", "湘25=110").split(",") if "=" in part
+    )
+}
+PLAN_DEPARTURES = 30
+
+
+def capacity_for(line: str) -> int:
+    if line in LINE_CAPACITIES:
+        return LINE_CAPACITIES[line]
+    return LINE_CAPACITIES.get(line.split("-", 1)[-1], DEFAULT_CAPACITY)
+
+
+class Plan(NamedTuple):
+    key: tuple
+    departures: List[Dict]
+    leaves_at: array  # epoch seconds, predicted where known
+    cumulative: array  # people carried by departures[0..i] inclusive
+
+
+_plan: Optional[Plan] = None
+_plan_lock = threading.Lock()
+_latest: Optional[Dict] = None
+
+
+# Upcoming departures and their running capacity total. Rebuilt when the
+# minute, the timetables or the realtime predictions change; every sample in
+# between only bisects the totals.
+def get_plan(now: Optional[datetime] = None) -> Plan:
+    global _plan
+    if now is None:
+        now = now_in_tz(os.environ.get("TZ", "Asia/Tokyo"))
+    minute = now.replace(second=0, microsecond=0)
+    timetables = timetable_store.current()
+    key = (minute, timetables.version, gtfs_realtime.version())
+    plan = _plan
+    if plan is not None and plan.key == key:
+        return plan
+    with _plan_lock:
+        if _plan is not None and _plan.key == key:
+            return _plan
+        timetable = timetables.tables[DIRECTION]
+        items = next_across_all(timetable, minute, PLAN_DEPARTURES)
+        if gtfs_realtime.enabled():
+            if items:
+                horizon = items[-1]["datetime"] + timedelta(minutes=gtfs_realtime.LOOKBACK_MIN)
+                items = [it for it in next_across_all(timetable, minute, PLAN_DEPARTURES + 64)
+                         if it["datetime"] <= horizon]
+            since = minute - timedelta(minutes=gtfs_realtime.LOOKBACK_MIN)
+            past = [it for it in next_across_all(timetable, since, 64) if it["datetime"] < minute]
+            items = gtfs_realtime.merge(DIRECTION, past, items, minute, PLAN_DEPARTURES)
+        departures: List[Dict] = []
+        leaves_at = array("d")
+        cumulative = array("l")
+        total = 0
+        for it in items:
+            rt = it.get("realtime")
+            if rt is not None and rt["canceled"]:
+                continue
+            total += capacity_for(it["line"])
+            departures.append(it)
+            leaves_at.append(rt["predicted"] if rt is not None else it["datetime"].timestamp())
+            cumulative.append(total)
+        _plan = Plan(key, departures, leaves_at, cumulative)
+        return _plan
+
+
+def forecast(count: int, now: Optional[datetime] = None) -> Dict:
+    # Someone joining now is number count + 1 in the queue and boards the
+    # first bus whose running capacity reaches that position.
+    if now is None:
+        now = now_in_tz(os.environ.get("TZ", "Asia/Tokyo"))
+    plan = get_plan(now)
+    position = int(count) + 1
+    k = bisect_left(plan.cumulative, position)
+    out = {
+        "queue": int(count),
+        "position": position,
+        "busesUntilBoard": None,
+        "expectedWaitMinutes": None,
+        "board": None,
+        "capacityAhead": plan.cumulative[-1] if plan.cumulative else 0,
+    }
+    if k < len(plan.departures):
+        it = plan.departures[k]
+        out["busesUntilBoard"] = k
+        out["expectedWaitMinutes"] = max(0, round((plan.leaves_at[k] - now.timestamp()) / 60))
+        out["board"] = {
+            "line": it["line"],
+            "time": datetime.fromtimestamp(plan.leaves_at[k], now.tzinfo).strftime("%H:%M"),
+            "capacity": capacity_for(it["line"]),
+        }
+    return out
+
+
+def on_sample(count: int, ts: float) -> None:
+    # Congestion listener: runs for every MQTT message, on the decode thread,
+    # which must survive a bad timetable.
+    global _latest
+    try:
+        zone = now_in_tz(os.environ.get("TZ", "Asia/Tokyo")).tzinfo
+        result = forecast(count, datetime.fromtimestamp(ts, zone))
+    except Exception as e:
+        print(f"forecast: {e}", file=sys.stderr)
+        return
+    result["updatedAt"] = ts
+    _latest = result
+
+
+def latest(count: int, updated_at: float) -> Dict:
+    # The leader's forecast when it matches the given sample and minute;
+    # otherwise (followers, a new minute) a fresh bisect over the plan.
+    result = _latest
+    if (result is not None and result["updatedAt"] == updated_at and result["queue"] == count
+            and _plan is not None and int(time.time() // 60) == int(updated_at // 60)):
+        return result
+    result = forecast(count)
+    result["updatedAt"] = updated_at
+    return result
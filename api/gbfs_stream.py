@@ -0,0 +1,80 @@
+import codecs
+import json
+import re
+from typing import Dict, List
+
+_STATIONS_START = re.compile(r'"stations"\s*:\s*\[')
+_LAST_UPDATED = re.compile(r'"last_updated"\s*:\s*(\d+)')
+_TTL = re.compile(r'"ttl"\s*:\s*(\d+)')
+_SKIP = re.compile(r"[\s,]*")
+
+
+# Decodes station objects one at a time as chunks arrive and hands each to
+# add(); the full document is never materialized. add() keeps every station
+# as is; subclasses override it to keep something smaller.
+class StationStreamParser:
+
+    def __init__(self):
+        self.stations: List[Dict] = []
+        self._decoder = json.JSONDecoder()
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._buf = ""
+        self._state = "header"
+        self._meta_text = ""
+
+    def add(self, station: Dict) -> None:
+        self.stations.append(station)
+
+    def feed(self, chunk: bytes) -> None:
+        self._buf += self._utf8.decode(chunk)
+        self._advance(final=False)
+
+    def close(self) -> Dict:
+        self._buf += self._utf8.decode(b"", final=True)
+        self._advance(final=True)
+        if self._state == "array":
+            raise ValueError("truncated GBFS feed: stations array not closed")
+        meta = self._meta_text + self._buf
+        out: Dict = {"data": {"stations": self.stations}}
+        m = _LAST_UPDATED.search(meta)
+        if m:
+            out["last_updated"] = int(m.group(1))
+        m = _TTL.search(meta)
+        if m:
+            out["ttl"] = int(m.group(1))
+        return out
+
+    def _advance(self, final: bool) -> None:
+        if self._state == "header":
+            m = _STATIONS_START.search(self._buf)
+            if m is None:
+                return
+            self._meta_text = self._buf[:m.start()]
+            self._buf = self._buf[m.end():]
+            self._state = "array"
+        if self._state != "array":
+            return
+
+        buf = self._buf
+        pos = 0
+        n = len(buf)
+        add = self.add
+        skip = _SKIP.match
+        decode = self._decoder.raw_decode
+        while True:
+            pos = skip(buf, pos).end()
+            if pos >= n:
+                break
+            if buf[pos] == "]":
+                pos += 1
+                self._state = "trailer"
+                break
+            try:
+                obj, end = decode(buf, pos)
+            except json.JSONDecodeError:
+                if final:
+                    raise
+                break
+            pos = end
+            add(obj)
+        self._buf = buf[pos:]
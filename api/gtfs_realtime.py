@@ -0,0 +1,365 @@
+import asyncio
+import csv
+import io
+import os
+import sys
+import time
+import zipfile
+from datetime import date, datetime
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import shared_state
+
+try:
+    from zoneinfo import ZoneInfo
+except Exception:
+    ZoneInfo = None
+
+# GTFS static zip (path or URL) and GTFS-RT feeds, e.g. the ODPT feeds for
+# Kanachu with ?acl:consumerKey=... appended. Realtime is off unless the
+# static feed, the boarding stops and at least one RT feed are configured;
+# gtfs-realtime-bindings is only imported by the poller.
+STATIC_SOURCE = os.getenv("GTFS_STATIC", "")
+TRIP_UPDATES_URL = os.getenv("GTFS_RT_TRIP_UPDATES_URL", "")
+VEHICLE_POSITIONS_URL = os.getenv("GTFS_RT_VEHICLE_POSITIONS_URL", "")
+POLL_SECS = float(os.getenv("GTFS_RT_POLL_SECS", "15"))
+STATIC_REFRESH_SECS = float(os.getenv("GTFS_STATIC_REFRESH_SECS", "86400"))
+# Boarding stop per direction: "from-school:<stop_id>|<stop_id>,to-school:<stop_id>"
+BOARDING_STOPS = {
+    direction: set(ids.split("|"))
+    for direction, _, ids in (
+        part.strip().partition(":")
+        for part in os.getenv("GTFS_BOARDING_STOPS", "").split(",") if part.strip()
+    )
+}
+# Line names in bus_data are the direction prefix plus route_short_name.
+LINE_PREFIX = {"from-school": "下校-", "to-school": "登校-"}
+# Delayed departures are looked for this far before the current time
+LOOKBACK_MIN = 30
+# Predictions for departures this long in the past are dropped
+EXPIRE_SECS = 3600
+
+TRIP_CANCELED = 3  # TripDescriptor.ScheduleRelationship.CANCELED
+STOP_SKIPPED = 1  # StopTimeUpdate.ScheduleRelationship.SKIPPED
+DIFFERENTIAL = 1  # FeedHeader.Incrementality.DIFFERENTIAL
+
+
+class TripRef(NamedTuple):
+    direction: str
+    line: str
+    stop_sequence: int
+    minute: int  # scheduled departure at the boarding stop, may exceed 1440
+
+
+# (direction, line, service date ordinal, minute of day) -> prediction
+Key = Tuple[str, str, int, int]
+
+
+def enabled() -> bool:
+    return bool(STATIC_SOURCE and BOARDING_STOPS and (TRIP_UPDATES_URL or VEHICLE_POSITIONS_URL))
+
+
+def _tz():
+    name = os.environ.get("TZ", "Asia/Tokyo")
+    if ZoneInfo is None:
+        return None
+    try:
+        return ZoneInfo(name)
+    except Exception:
+        return ZoneInfo("Asia/Tokyo")
+
+
+def _gtfs_minutes(hms: str) -> int:
+    h, m, _ = hms.strip().split(":")
+    return int(h) * 60 + int(m)
+
+
+# Only trips that call at a boarding stop are kept, so the index stays a few
+# thousand entries even for an operator-wide feed; stop_times.txt is streamed.
+def build_trip_index(zip_bytes: bytes) -> Dict[str, TripRef]:
+    stop_direction = {sid: d for d, ids in BOARDING_STOPS.items() for sid in ids}
+    with zipfile.ZipFile(io.BytesIO(zip_bytes)) as z:
+        def rows(name):
+            with z.open(name) as f:
+                yield from csv.DictReader(io.TextIOWrapper(f, encoding="utf-8-sig"))
+
+        route_names = {r["route_id"]: r.get("route_short_name") or r.get("route_long_name") or r["route_id"]
+                       for r in rows("routes.txt")}
+        trip_routes = {t["trip_id"]: t["route_id"] for t in rows("trips.txt")}
+        index: Dict[str, TripRef] = {}
+        for st in rows("stop_times.txt"):
+            direction = stop_direction.get(st["stop_id"])
+            if direction is None:
+                continue
+            trip_id = st["trip_id"]
+            seq = int(st["stop_sequence"])
+            # A trip from school later calls at the station stop where the
+            # to-school trips board; the first boarding stop decides.
+            if trip_id in index and index[trip_id].stop_sequence < seq:
+                continue
+            route = route_names.get(trip_routes.get(trip_id, ""), "")
+            index[trip_id] = TripRef(
+                direction,
+                LINE_PREFIX.get(direction, "") + route,
+                seq,
+                _gtfs_minutes(st.get("departure_time") or st["arrival_time"]),
+            )
+    return index
+
+
+_trips: Dict[str, TripRef] = {}
+_predictions: Dict[Key, Dict] = {}
+_trip_keys: Dict[str, Key] = {}
+_trip_stamps: Dict[str, int] = {}
+_version = 0
+_loaded_version = 0
+
+
+def version() -> int:
+    if shared_state.is_shared() and not shared_state.is_leader():
+        _sync_from_shared()
+    return _version
+
+
+def load_static(zip_bytes: bytes) -> None:
+    global _trips
+    _trips = build_trip_index(zip_bytes)
+    print(f"gtfs: {len(_trips)} trips call at the boarding stops", file=sys.stderr)
+
+
+def _service_date(trip) -> date:
+    if trip.start_date:
+        return datetime.strptime(trip.start_date, "%Y%m%d").date()
+    return datetime.now(_tz()).date()
+
+
+def _key(ref: TripRef, service_date: date) -> Key:
+    # GTFS times past 24:00 belong to the previous service date.
+    return (ref.direction, ref.line, service_date.toordinal() + ref.minute // 1440, ref.minute % 1440)
+
+
+def _scheduled_ts(key: Key) -> float:
+    d = date.fromordinal(key[2])
+    return datetime(d.year, d.month, d.day, key[3] // 60, key[3] % 60, tzinfo=_tz()).timestamp()
+
+
+def _boarding_event(update, ref: TripRef) -> Optional[Tuple[Optional[int], int, bool]]:
+    # Per the GTFS-RT spec a delay propagates to later stops until the next
+    # update, so use the update at the boarding stop or the last one before it.
+    # Returns (absolute time, delay, skipped), or None once the bus is past it.
+    stops = BOARDING_STOPS.get(ref.direction, ())
+    best = None
+    at_stop = False
+    for stu in update.stop_time_update:
+        at_stop = stu.stop_sequence == ref.stop_sequence or stu.stop_id in stops
+        if stu.stop_sequence > ref.stop_sequence and not at_stop:
+            break
+        best = stu
+        if at_stop:
+            break
+    if best is None:
+        return None
+    event = best.departure if best.HasField("departure") else best.arrival
+    return (event.time or None) if at_stop else None, event.delay, at_stop and best.schedule_relationship == STOP_SKIPPED
+
+
+def _set(trip_id: str, key: Key, entry: Dict) -> bool:
+    old_key = _trip_keys.get(trip_id)
+    if old_key is not None and old_key != key:
+        _predictions.pop(old_key, None)
+    _trip_keys[trip_id] = key
+    current = _predictions.get(key)
+    entry["vehicle"] = (current or {}).get("vehicle")
+    if current is not None and all(current.get(k) == v for k, v in entry.items() if k != "updatedAt"):
+        return False
+    _predictions[key] = entry
+    return True
+
+
+def _drop(trip_id: str) -> bool:
+    key = _trip_keys.pop(trip_id, None)
+    _trip_stamps.pop(trip_id, None)
+    return key is not None and _predictions.pop(key, None) is not None
+
+
+# Applies one TripUpdates FeedMessage. Only trips whose update timestamp moved
+# are recomputed, and with a full-dataset feed only trips that vanished from
+# it are removed; the rest of the table is left untouched.
+def apply_trip_updates(feed) -> int:
+    global _version
+    now = time.time()
+    changed = 0
+    seen = set()
+    for entity in feed.entity:
+        if not entity.HasField("trip_update"):
+            continue
+        update = entity.trip_update
+        trip_id = update.trip.trip_id
+        ref = _trips.get(trip_id)
+        if ref is None:
+            continue
+        seen.add(trip_id)
+        stamp = update.timestamp or feed.header.timestamp
+        if stamp and _trip_stamps.get(trip_id) == stamp:
+            continue
+        _trip_stamps[trip_id] = stamp
+        key = _key(ref, _service_date(update.trip))
+        scheduled = _scheduled_ts(key)
+        if update.trip.schedule_relationship == TRIP_CANCELED:
+            changed += _set(trip_id, key, {"tripId": trip_id, "predicted": scheduled, "delay": 0,
+                                           "canceled": True, "updatedAt": now})
+            continue
+        event = _boarding_event(update, ref)
+        if event is None:
+            changed += _drop(trip_id)
+            continue
+        at, delay, skipped = event
+        predicted = at if at else scheduled + delay
+        changed += _set(trip_id, key, {"tripId": trip_id, "predicted": predicted, "delay": int(predicted - scheduled),
+                                       "canceled": skipped, "updatedAt": now})
+    if feed.header.incrementality != DIFFERENTIAL:
+        for trip_id in [t for t in _trip_keys if t not in seen]:
+            changed += _drop(trip_id)
+    for trip_id in [v["tripId"] for v in _predictions.values() if v["predicted"] < now - EXPIRE_SECS]:
+        changed += _drop(trip_id)
+    if changed:
+        _version += 1
+    return changed
+
+
+def apply_vehicle_positions(feed) -> int:
+    global _version
+    changed = 0
+    for entity in feed.entity:
+        if not entity.HasField("vehicle"):
+            continue
+        v = entity.vehicle
+        trip_id = v.trip.trip_id
+        # Positions are attached to trips that have a prediction; on their
+        # own they do not say when the bus reaches the boarding stop.
+        entry = _predictions.get(_trip_keys.get(trip_id))
+        if entry is None:
+            continue
+        vehicle = {
+            "lat": round(v.position.latitude, 6),
+            "lon": round(v.position.longitude, 6),
+            "stopSequence": v.current_stop_sequence,
+            "timestamp": v.timestamp,
+        }
+        if entry.get("vehicle") != vehicle:
+            entry["vehicle"] = vehicle
+            changed += 1
+    if changed:
+        _version += 1
+    return changed
+
+
+def _publish() -> None:
+    shared_state.publish("realtime", {
+        "version": _version,
+        "entries": [list(k) + [v] for k, v in _predictions.items()],
+    })
+
+
+def _sync_from_shared() -> None:
+    # Followers take the leader's predictions when its version moves.
+    global _predictions, _loaded_version, _version
+    v = shared_state.version("realtime")
+    if v == _loaded_version:
+        return
+    data = shared_state.read("realtime") or {}
+    _predictions = {tuple(e[:4]): e[4] for e in data.get("entries", [])}
+    _loaded_version = v
+    _version = data.get("version", _version)
+
+
+def prediction_for(direction: str, item: Dict) -> Optional[Dict]:
+    dt: datetime = item["datetime"]
+    return _predictions.get((direction, item["line"], dt.toordinal(), dt.hour * 60 + dt.minute))
+
+
+def merge(direction: str, past: List[Dict], upcoming: List[Dict], now: datetime, count: int) -> List[Dict]:
+    # past: scheduled in the last LOOKBACK_MIN minutes; upcoming: scheduled
+    # from now on, reaching LOOKBACK_MIN minutes past the count-th departure
+    # so that a delayed bus cannot hide one that now leaves before it. Items
+    # are kept only if predicted to leave from now on (cancelled ones too, so
+    # riders see them) and ordered by predicted time.
+    if not _predictions:
+        return upcoming[:count]
+    now_ts = now.timestamp()
+    out = []
+    for item in past + upcoming:
+        rt = prediction_for(direction, item)
+        if rt is not None:
+            item = dict(item, realtime=rt)
+            if rt["predicted"] < now_ts:
+                continue
+        elif item["datetime"] < now:
+            continue
+        out.append(item)
+    out.sort(key=lambda it: it["realtime"]["predicted"] if "realtime" in it else it["datetime"].timestamp())
+    return out[:count]
+
+
+class _BytesSink:
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def feed(self, chunk: bytes) -> None:
+        self._chunks.append(chunk)
+
+    def close(self) -> bytes:
+        return b"".join(self._chunks)
+
+
+async def _fetch(url: str, conditional: bool = True) -> Optional[bytes]:
+    import upstream
+
+    return await upstream.fetch_stream(url, _BytesSink(), conditional=conditional)
+
+
+def _parse(pb2, data: bytes):
+    feed = pb2.FeedMessage()
+    feed.ParseFromString(data)
+    return feed
+
+
+async def _load_static_source() -> None:
+    if STATIC_SOURCE.startswith(("http://", "https://")):
+        data = await _fetch(STATIC_SOURCE, conditional=bool(_trips))
+        if data is None:
+            return
+    else:
+        with open(STATIC_SOURCE, "rb") as f:
+            data = f.read()
+    await asyncio.get_running_loop().run_in_executor(None, load_static, data)
+
+
+# Leader only: polls the RT feeds with conditional requests and publishes the
+# resulting predictions for the other workers.
+async def poll_forever() -> None:
+    try:
+        from google.transit import gtfs_realtime_pb2
+    except Exception as e:
+        print(f"gtfs-rt disabled, gtfs-realtime-bindings unavailable: {e}", file=sys.stderr)
+        return
+    static_at = 0.0
+    while True:
+        try:
+            if time.time() - static_at >= STATIC_REFRESH_SECS:
+                await _load_static_source()
+                static_at = time.time()
+            before = _version
+            for url, apply in ((TRIP_UPDATES_URL, apply_trip_updates),
+                               (VEHICLE_POSITIONS_URL, apply_vehicle_positions)):
+                if not url:
+                    continue
+                data = await _fetch(url)
+                if data is not None:
+                    apply(_parse(gtfs_realtime_pb2, data))
+            if _version != before and shared_state.is_shared():
+                _publish()
+        except Exception as e:
+            print(f"gtfs-rt poll: {e}", file=sys.stderr)
+        await asyncio.sleep(POLL_SECS)
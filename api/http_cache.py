@@ -0,0 +1,243 @@
+import gzip
+import hashlib
+import json
+import os
+from typing import Callable, Dict, Optional
+
+from fastapi import Request, Response
+from fastapi.responses import JSONResponse
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except Exception:
+    brotli = None
+
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+# Dynamic responses smaller than this go out uncompressed: below about a
+# packet the saving does not pay for the CPU.
+COMPRESS_MIN_SIZE = int(os.getenv("HTTP_COMPRESS_MIN_BYTES", "512"))
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+JSON_TYPE = "application/json"
+# Binary representations a route may offer via Accept, by media type.
+BINARY_TYPES = {
+    "application/msgpack": "msgpack",
+    "application/x-msgpack": "msgpack",
+    "application/vnd.msgpack": "msgpack",
+    "application/cbor": "cbor",
+}
+COMPRESSIBLE_TYPES = (JSON_TYPE, "text/plain", "text/html") + tuple(BINARY_TYPES)
+
+
+def dump_json(payload) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+# Default response class: the same compact UTF-8 JSON as dump_json, encoded
+# by orjson when it is installed.
+class FastJSONResponse(JSONResponse):
+
+    def render(self, content) -> bytes:
+        return dump_json(content)
+
+
+_encoders: Dict[str, Optional[Callable]] = {}
+
+
+def _encoder(name: str) -> Optional[Callable]:
+    # msgpack and cbor2 are optional and only imported once a client asks.
+    if name not in _encoders:
+        try:
+            if name == "msgpack":
+                import msgpack
+
+                _encoders[name] = lambda payload: msgpack.packb(payload, use_bin_type=True)
+            else:
+                import cbor2
+
+                _encoders[name] = cbor2.dumps
+        except Exception:
+            _encoders[name] = None
+    return _encoders[name]
+
+
+def pick_media_type(request: Request) -> str:
+    # The binary type the client prefers over JSON, if its encoder is
+    # installed; JSON otherwise.
+    best, best_q = JSON_TYPE, 0.0
+    for media_type, q in _parse_qlist(request.headers.get("accept", "")).items():
+        if q <= 0:
+            continue
+        if media_type in BINARY_TYPES:
+            if q > best_q and _encoder(BINARY_TYPES[media_type]) is not None:
+                best, best_q = media_type, q
+        elif media_type in (JSON_TYPE, "application/*", "*/*") and q >= best_q:
+            best, best_q = JSON_TYPE, q
+    return best
+
+
+def _str_keys(value):
+    # Map keys as JSON has them (timetable hours are ints in memory), so
+    # binary clients decode the same document. Lists are homogeneous here, so
+    # lists of scalars are passed through as they are.
+    if isinstance(value, dict):
+        return {k if isinstance(k, str) else str(k): _str_keys(v) for k, v in value.items()}
+    if isinstance(value, list) and value and isinstance(value[0], (dict, list)):
+        return [_str_keys(v) for v in value]
+    return value
+
+
+def encode(payload, media_type: str) -> bytes:
+    if media_type == JSON_TYPE:
+        return dump_json(payload)
+    return _encoder(BINARY_TYPES[media_type])(_str_keys(payload))
+
+
+def negotiated_response(request: Request, payload) -> Response:
+    media_type = pick_media_type(request)
+    return Response(content=encode(payload, media_type), media_type=media_type, headers={"Vary": "Accept"})
+
+
+def prepare_body(raw: bytes) -> Dict:
+    digest = hashlib.sha256(raw).hexdigest()[:32]
+    return {
+        "raw": raw,
+        "etag": f'"{digest}"',
+        "gzip": gzip.compress(raw, compresslevel=9, mtime=0),
+        "br": brotli.compress(raw) if brotli is not None else None,
+    }
+
+
+def _parse_qlist(header: str) -> Dict[str, float]:
+    out: Dict[str, float] = {}
+    for part in header.split(","):
+        coding, _, params = part.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            param = param.strip()
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        out[coding] = q
+    return out
+
+
+def accepted_encodings(request: Request) -> Dict[str, float]:
+    return _parse_qlist(request.headers.get("accept-encoding", ""))
+
+
+def _pick_coding(accepted: Dict[str, float], available=("br", "gzip")) -> Optional[str]:
+    # The available coding the client weights highest; ties go to the
+    # earlier one in available (br before gzip).
+    best, best_q = None, 0.0
+    for coding in available:
+        q = accepted.get(coding, accepted.get("*", 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def pick_encoding(request: Request, prepared: Dict) -> Optional[str]:
+    return _pick_coding(accepted_encodings(request), [c for c in ("br", "gzip") if prepared.get(c) is not None])
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    base = etag.strip('"')
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        tag = tag.strip('"')
+        if tag == base or tag in (f"{base}-gzip", f"{base}-br"):
+            return True
+    return False
+
+
+def prepared_response(request: Request, prepared: Dict, cache_control: str,
+                      media_type: str = JSON_TYPE, vary: str = "Accept-Encoding") -> Response:
+    headers = {"Cache-Control": cache_control, "Vary": vary}
+    if _etag_matches(request, prepared["etag"]):
+        headers["ETag"] = prepared["etag"]
+        return Response(status_code=304, headers=headers)
+
+    coding = pick_encoding(request, prepared)
+    if coding is None:
+        headers["ETag"] = prepared["etag"]
+        return Response(content=prepared["raw"], media_type=media_type, headers=headers)
+    base = prepared["etag"].strip('"')
+    headers["ETag"] = f'"{base}-{coding}"'
+    headers["Content-Encoding"] = coding
+    return Response(content=prepared[coding], media_type=media_type, headers=headers)
+
+
+# Pure ASGI middleware compressing complete responses (br, else gzip) for
+# clients that accept it. Responses that already carry a Content-Encoding
+# (the prepared timetable bodies), streamed ones (/stream), small ones and
+# non-text types pass through untouched.
+class CompressionMiddleware:
+
+    def __init__(self, app, minimum_size: int = COMPRESS_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        available = ("br", "gzip") if brotli is not None else ("gzip",)
+        coding = _pick_coding(_parse_qlist(Headers(scope=scope).get("accept-encoding", "")), available)
+        if coding is None:
+            return await self.app(scope, receive, send)
+        start = None
+        passthrough = False
+
+        async def send_wrapper(message):
+            nonlocal start, passthrough
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if passthrough or message["type"] != "http.response.body":
+                await send(message)
+                return
+            passthrough = True
+            headers = MutableHeaders(raw=start["headers"])
+            media_type = headers.get("content-type", "").split(";")[0].strip()
+            body = message.get("body", b"")
+            if ("content-encoding" in headers or message.get("more_body")
+                    or not media_type.startswith(COMPRESSIBLE_TYPES)):
+                await send(start)
+                await send(message)
+                return
+            headers.add_vary_header("Accept-Encoding")
+            if len(body) >= self.minimum_size:
+                if coding == "br":
+                    compressed = brotli.compress(body, quality=BROTLI_QUALITY)
+                else:
+                    compressed = gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+                if len(compressed) < len(body):
+                    body = compressed
+                    headers["Content-Encoding"] = coding
+                    headers["Content-Length"] = str(len(body))
+                    etag = headers.get("etag")
+                    if etag is not None and not etag.startswith("W/"):
+                        headers["ETag"] = "W/" + etag
+            await send(start)
+            await send({"type": "http.response.body", "body": body})
+
+        await self.app(scope, receive, send_wrapper)
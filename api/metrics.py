@@ -0,0 +1,110 @@
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Tuple
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = array("Q", bytes(8 * (len(buckets) + 1)))
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+_lock = threading.Lock()
+_request_latency: Dict[Tuple[str, str], Histogram] = {}
+_request_totals: Dict[Tuple[str, str, int], int] = {}
+
+
+def observe_request(route: str, method: str, status: int, seconds: float) -> None:
+    with _lock:
+        hist = _request_latency.get((route, method))
+        if hist is None:
+            hist = _request_latency[(route, method)] = Histogram()
+        hist.observe(seconds)
+        key = (route, method, status)
+        _request_totals[key] = _request_totals.get(key, 0) + 1
+
+
+# Pure ASGI middleware: times each request until its response headers are sent,
+# so long-lived responses such as /stream are measured to first byte.
+class MetricsMiddleware:
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        recorded = False
+
+        async def send_wrapper(message):
+            nonlocal recorded
+            if message["type"] == "http.response.start" and not recorded:
+                recorded = True
+                route = scope.get("route")
+                path = getattr(route, "path", None) or "unmatched"
+                observe_request(path, scope["method"], message["status"], time.perf_counter() - start)
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+
+def _labels(**labels) -> str:
+    if not labels:
+        return ""
+    parts = []
+    for k, v in labels.items():
+        v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{k}="{v}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def _fmt(value) -> str:
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if value is None:
+        return "NaN"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(gauges: Iterable[Tuple[str, str, str, List[Tuple[Dict, object]]]]) -> str:
+    lines: List[str] = []
+    with _lock:
+        latency = [(k, h.buckets, h.counts[:], h.sum, h.count) for k, h in _request_latency.items()]
+        totals = list(_request_totals.items())
+
+    lines.append("# HELP http_request_duration_seconds Time until response headers are sent.")
+    lines.append("# TYPE http_request_duration_seconds histogram")
+    for (route, method), buckets, counts, total, n in sorted(latency):
+        cumulative = 0
+        for le, c in zip(buckets, counts):
+            cumulative += c
+            lines.append(f"http_request_duration_seconds_bucket{_labels(route=route, method=method, le=le)} {cumulative}")
+        lines.append(f"http_request_duration_seconds_bucket{_labels(route=route, method=method, le='+Inf')} {n}")
+        lines.append(f"http_request_duration_seconds_sum{_labels(route=route, method=method)} {_fmt(total)}")
+        lines.append(f"http_request_duration_seconds_count{_labels(route=route, method=method)} {n}")
+
+    lines.append("# HELP http_requests_total Requests by route, method and status.")
+    lines.append("# TYPE http_requests_total counter")
+    for (route, method, status), n in sorted(totals):
+        lines.append(f"http_requests_total{_labels(route=route, method=method, status=status)} {n}")
+
+    for name, kind, help_text, samples in gauges:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            lines.append(f"{name}{_labels(**labels)} {_fmt(value)}")
+    return "\n".join(lines) + "\n"
+
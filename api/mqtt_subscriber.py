@@ -1,14 +1,26 @@
+import base64
+import json
 import os
+import queue
 import sys
 import time
 import threading
+from typing import Dict, Optional, Tuple
 from uuid import uuid4
 
 import boto3
+from botocore.exceptions import ClientError
 from awscrt import auth, io, mqtt
 from awscrt.exceptions import AwsCrtError
 from awsiot import mqtt_connection_builder
 
+from congestion import sensors
+
+try:
+    from orjson import loads as _loads
+except Exception:
+    from json import loads as _loads
+
 
 refresh_token = os.getenv("REFRESH_TOKEN", "")
 region = os.getenv("REGION", "ap-northeast-1")
@@ -16,14 +28,49 @@ user_pool_id = os.getenv("USER_POOL_ID", "ap-northeast-1_kRWuig6oV")
 user_pool_client_id = os.getenv("USER_POOL_CLIENT_ID", "2jl8m0q968eudj7lubpdkuvq9v")
 identity_pool_id = os.getenv("IDENTITY_POOL_ID", "ap-northeast-1:7e24baf3-0e4b-4c3a-bacf-ca1e9b7f4650")
 endpoint = os.getenv("ENDPOINT", "ak6s01k4r928v-ats.iot.ap-northeast-1.amazonaws.com")
-message_topic = os.getenv("MESSAGE_TOPIC", "object/lidar/vista-p90-3/person")
+# Comma-separated topic filters; MQTT wildcards (+, #) are allowed.
+message_topics = [t.strip() for t in os.getenv("MESSAGE_TOPIC", "object/lidar/vista-p90-3/person").split(",") if t.strip()]
+sensor_id_segment = int(os.getenv("SENSOR_ID_SEGMENT", "2"))
 client_id = os.getenv("CLIENT_ID", "sample-" + str(uuid4()))
+message_queue_size = int(os.getenv("MESSAGE_QUEUE_SIZE", "1024"))
+message_late_secs = float(os.getenv("MESSAGE_LATE_SECS", "2"))
+# Refresh the ID token (and rebuild the connection) this long before it expires
+id_token_margin_secs = int(os.getenv("ID_TOKEN_MARGIN_SECS", "300"))
+# Rebuild the connection if the CRT has not resumed it within this time
+reconnect_grace_secs = float(os.getenv("RECONNECT_GRACE_SECS", "15"))
+
+_boto_clients: Dict[Tuple[str, str], object] = {}
+_id_token: Optional[str] = None
+_id_token_exp = 0.0
+_identity_id: Optional[str] = os.getenv("IDENTITY_ID") or None
+# Error codes (Cognito) and CRT error names that mean the token or the
+# credentials behind the connection were refused.
+AUTH_ERROR_CODES = frozenset({"NotAuthorizedException", "InvalidIdentityPoolConfigurationException", "ResourceNotFoundException"})
+AUTH_ERROR_NAME_PARTS = ("AUTH", "CREDENTIALS", "SIGN", "WEBSOCKET_UPGRADE", "NOT_AUTHORIZED", "BAD_USERNAME")
+
+
+def _boto_client(service: str, region: str):
+    key = (service, region)
+    client = _boto_clients.get(key)
+    if client is None:
+        client = boto3.client(service, region_name=region)
+        _boto_clients[key] = client
+    return client
+
+
+def _token_expiry(id_token: str) -> float:
+    try:
+        payload = id_token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except Exception:
+        return time.time() + 3600
 
 
 def fetch_id_token(refresh_token: str,
                    user_pool_client_id: str,
                    region: str = "ap-northeast-1") -> str:
-    client = boto3.client("cognito-idp", region_name=region)
+    client = _boto_client("cognito-idp", region)
     response: dict = client.initiate_auth(
         AuthFlow='REFRESH_TOKEN_AUTH',
         AuthParameters={'REFRESH_TOKEN': refresh_token},
@@ -36,7 +83,7 @@ def fetch_identity_id(id_token: str,
                       user_pool_id: str,
                       identity_pool_id: str,
                       region: str = "ap-northeast-1") -> str:
-    client = boto3.client("cognito-identity", region_name=region)
+    client = _boto_client("cognito-identity", region)
     response = client.get_id(
         IdentityPoolId=identity_pool_id,
         Logins={f"cognito-idp.{region}.amazonaws.com/{user_pool_id}": id_token}
@@ -44,9 +91,58 @@ def fetch_identity_id(id_token: str,
     return response['IdentityId']
 
 
+def get_id_token() -> str:
+    global _id_token, _id_token_exp
+    if _id_token is not None and time.time() < _id_token_exp - id_token_margin_secs:
+        return _id_token
+    token = fetch_id_token(
+        refresh_token=refresh_token,
+        user_pool_client_id=user_pool_client_id,
+        region=region,
+    )
+    _id_token = token
+    _id_token_exp = _token_expiry(token)
+    return token
+
+
+def get_identity_id(id_token: str) -> str:
+    global _identity_id
+    if _identity_id is None:
+        _identity_id = fetch_identity_id(
+            id_token=id_token,
+            user_pool_id=user_pool_id,
+            identity_pool_id=identity_pool_id,
+            region=region,
+        )
+    return _identity_id
+
+
+def is_auth_error(error: BaseException) -> bool:
+    if isinstance(error, ClientError):
+        return error.response.get("Error", {}).get("Code") in AUTH_ERROR_CODES
+    if isinstance(error, AwsCrtError):
+        return any(part in error.name for part in AUTH_ERROR_NAME_PARTS)
+    return False
+
+
+def invalidate_credentials() -> None:
+    # The next connect fetches a new ID token and, unless it was configured,
+    # looks the identity up again.
+    global _id_token, _id_token_exp, _identity_id
+    _id_token = None
+    _id_token_exp = 0.0
+    _identity_id = os.getenv("IDENTITY_ID") or None
+
+
 def on_connection_interrupted(connection: mqtt.Connection,
                               error: AwsCrtError,
                               **kwargs) -> None:
+    _connection_stats["interruptions"] += 1
+    _connection_stats["connected"] = False
+    if not _connection_stats["interrupted_at"]:
+        _connection_stats["interrupted_at"] = time.time()
+    if is_auth_error(error):
+        invalidate_credentials()
     print(f"Connection interrupted. error: {error}")
 
 
@@ -54,6 +150,8 @@ def on_connection_resumed(connection: mqtt.Connection,
                           return_code: mqtt.ConnectReturnCode,
                           session_present: bool,
                           **kwargs) -> None:
+    _connection_stats["resumes"] += 1
+    _mark_connected()
     print("Connection resumed. "
           f"return_code: {return_code} session_present: {session_present}")
 
@@ -64,30 +162,74 @@ def on_message_received(topic: str,
                         qos: mqtt.QoS,
                         retain: bool,
                         **kwargs) -> None:
-    global _latest_object_count
+    # Runs on the CRT event-loop thread: only enqueue, never decode here.
+    _message_stats["received"] += 1
+    item = (time.time(), topic, payload)
     try:
-        import json
-        decoded_payload = json.loads(payload)
-        count = len(decoded_payload.get("objects", []))
-    except Exception:
-        count = 0
-    _latest_object_count = count
+        _message_queue.put_nowait(item)
+        return
+    except queue.Full:
+        pass
+    # Keep the newest sample: drop the oldest queued one to make room.
+    try:
+        _message_queue.get_nowait()
+    except queue.Empty:
+        pass
+    _message_stats["dropped"] += 1
+    try:
+        _message_queue.put_nowait(item)
+    except queue.Full:
+        _message_stats["dropped"] += 1
 
 
-def connect_and_subscribe(identity_id: str | None) -> None:
-    id_token = fetch_id_token(
-        refresh_token=refresh_token,
-        user_pool_client_id=user_pool_client_id,
-        region=region,
-    )
+def count_objects(payload: bytes) -> int:
+    objects = _loads(payload).get("objects")
+    return len(objects) if objects else 0
 
-    if identity_id is None:
-        identity_id = fetch_identity_id(
-            id_token=id_token,
-            user_pool_id=user_pool_id,
-            identity_pool_id=identity_pool_id,
-            region=region,
-        )
+
+def sensor_id_for(topic: str) -> str:
+    parts = topic.split("/")
+    if 0 <= sensor_id_segment < len(parts):
+        return parts[sensor_id_segment]
+    return topic
+
+
+def process_messages() -> None:
+    while True:
+        received_at, topic, payload = _message_queue.get()
+        if time.time() - received_at > message_late_secs:
+            _message_stats["late"] += 1
+        try:
+            count = count_objects(payload)
+        except Exception:
+            _message_stats["decode_errors"] += 1
+            count = 0
+        # This is the only decode thread: a failing listener (broadcast,
+        # archive, shared state) must not end it.
+        try:
+            sensors.record(sensor_id_for(topic), count, received_at)
+        except Exception as e:
+            _message_stats["record_errors"] += 1
+            print(f"congestion record failed: {e!r}", file=sys.stderr)
+            continue
+        _message_stats["processed"] += 1
+
+
+def _mark_connected() -> None:
+    now = time.time()
+    interrupted_at = _connection_stats["interrupted_at"]
+    if interrupted_at:
+        outage = now - interrupted_at
+        _connection_stats["last_reconnect_secs"] = round(outage, 3)
+        _connection_stats["outage_secs_total"] += outage
+        _connection_stats["interrupted_at"] = 0.0
+    _connection_stats["connected"] = True
+    _connection_stats["connected_at"] = now
+
+
+def connect_and_subscribe() -> None:
+    id_token = get_id_token()
+    identity_id = get_identity_id(id_token)
 
     credentials_provider = auth.AwsCredentialsProvider.new_cognito(
         endpoint=f"cognito-identity.{region}.amazonaws.com",
@@ -114,43 +256,91 @@ def connect_and_subscribe(identity_id: str | None) -> None:
     connect_future.result()
     print("Connected!")
 
-    subscribe_future, _ = mqtt_connection.subscribe(
-        topic=message_topic,
-        qos=mqtt.QoS.AT_MOST_ONCE,
-        callback=on_message_received,
-    )
-    subscribe_future.result()
-    print("Subscribed!")
-
     try:
+        for message_topic in message_topics:
+            subscribe_future, _ = mqtt_connection.subscribe(
+                topic=message_topic,
+                qos=mqtt.QoS.AT_MOST_ONCE,
+                callback=on_message_received,
+            )
+            subscribe_future.result()
+            print(f"Subscribed to {message_topic}!")
+        _connection_stats["connects"] += 1
+        _mark_connected()
+
+        # The CRT resumes short interruptions itself; rebuild the connection
+        # when it does not, or before the ID token behind the credentials expires.
         while True:
             time.sleep(1)
+            interrupted_at = _connection_stats["interrupted_at"]
+            if interrupted_at and time.time() - interrupted_at > reconnect_grace_secs:
+                print("Connection not resumed, reconnecting")
+                return
+            if time.time() > _id_token_exp - id_token_margin_secs:
+                print("ID token expiring, reconnecting")
+                return
     finally:
-        disconnect_future = mqtt_connection.disconnect()
-        disconnect_future.result()
+        if _connection_stats["connected"]:
+            _connection_stats["interrupted_at"] = time.time()
+        _connection_stats["connected"] = False
+        try:
+            disconnect_future = mqtt_connection.disconnect()
+            disconnect_future.result(timeout=5)
+        except Exception as e:
+            print(e, file=sys.stderr)
         print("Disconnected!")
 
 
 def subscriber_loop():
-    identity_id = None
     backoff_time = 1
     while True:
         try:
-            connect_and_subscribe(identity_id)
+            connect_and_subscribe()
+            # A session was established and ended on purpose: reconnect now.
+            backoff_time = 1
+            continue
         except Exception as e:
+            _connection_stats["connect_failures"] += 1
+            if is_auth_error(e):
+                invalidate_credentials()
             print(e, file=sys.stderr)
+        if _connection_stats["connected_at"] and not _connection_stats["interrupted_at"]:
+            _connection_stats["interrupted_at"] = time.time()
         time.sleep(backoff_time)
         backoff_time = min(backoff_time * 2, 600)
 
 
 def start_subscriber():
+    threading.Thread(target=process_messages, daemon=True).start()
     t = threading.Thread(target=subscriber_loop, daemon=True)
     t.start()
 
 
-def get_latest_object_count() -> int:
-    return int(_latest_object_count)
+def get_connection_stats() -> Dict:
+    stats = dict(_connection_stats)
+    if stats["interrupted_at"]:
+        stats["current_outage_secs"] = round(time.time() - stats["interrupted_at"], 3)
+    return stats
+
+
+def get_message_stats() -> Dict[str, int]:
+    stats = dict(_message_stats)
+    stats["queued"] = _message_queue.qsize()
+    return stats
 
 
-_latest_object_count = 0
+_message_queue: "queue.Queue[Tuple[float, str, bytes]]" = queue.Queue(maxsize=message_queue_size)
+_message_stats: Dict[str, int] = {"received": 0, "processed": 0, "dropped": 0, "late": 0, "decode_errors": 0,
+                                  "record_errors": 0}
+_connection_stats: Dict = {
+    "connected": False,
+    "connects": 0,
+    "connect_failures": 0,
+    "interruptions": 0,
+    "resumes": 0,
+    "connected_at": 0.0,
+    "interrupted_at": 0.0,
+    "last_reconnect_secs": None,
+    "outage_secs_total": 0.0,
+}
 
@@ -0,0 +1,77 @@
+import json
+import os
+import sys
+from array import array
+from datetime import date, timedelta
+from typing import Dict, Optional
+
+DAY_TYPES = ("weekday", "saturday", "holiday")
+# Day type by date.weekday(), used outside the calendar's range
+_WEEKDAY_RULE = array("B", [0, 0, 0, 0, 0, 1, 2])
+
+CALENDAR_FILE = os.getenv(
+    "SERVICE_CALENDAR_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "service_calendar.json"),
+)
+
+
+# One byte per date between start and end, holding the index into DAY_TYPES.
+# Weekends, national holidays ("holidays"), date ranges such as the New Year
+# break ("ranges") and single-day overrides ("exceptions", e.g. a university
+# event running a weekday service on a Saturday) are resolved once at load,
+# in that order, so day_type() is a subtraction and an array read.
+class ServiceCalendar:
+
+    def __init__(self, start: date, end: date, holidays: Optional[Dict[date, str]] = None):
+        self.start = start.toordinal()
+        self.end = end.toordinal()
+        self.holidays: Dict[date, str] = dict(holidays or {})
+        days = max(0, self.end - self.start + 1)
+        self._table = array("B", (_WEEKDAY_RULE[(self.start + i - 1) % 7] for i in range(days)))
+        for d in self.holidays:
+            self.set(d, "holiday")
+
+    def set(self, d: date, day_type: str) -> None:
+        i = d.toordinal() - self.start
+        if 0 <= i < len(self._table):
+            self._table[i] = DAY_TYPES.index(day_type)
+
+    def day_type(self, d: date) -> str:
+        i = d.toordinal() - self.start
+        if 0 <= i < len(self._table):
+            return DAY_TYPES[self._table[i]]
+        return DAY_TYPES[_WEEKDAY_RULE[d.weekday()]]
+
+
+def _parse_date(s: str) -> date:
+    return date.fromisoformat(s)
+
+
+def parse_calendar(data: Dict) -> ServiceCalendar:
+    holidays = {_parse_date(k): v for k, v in (data.get("holidays") or {}).items()}
+    start = _parse_date(data["start"]) if data.get("start") else min(holidays, default=date.today())
+    end = _parse_date(data["end"]) if data.get("end") else max(holidays, default=start)
+    cal = ServiceCalendar(start, end, holidays)
+    for r in data.get("ranges") or []:
+        d = _parse_date(r["from"])
+        last = _parse_date(r["to"])
+        while d <= last:
+            cal.set(d, r["dayType"])
+            d += timedelta(days=1)
+    for k, day_type in (data.get("exceptions") or {}).items():
+        cal.set(_parse_date(k), day_type)
+    return cal
+
+
+def load_calendar(path: str = CALENDAR_FILE) -> ServiceCalendar:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return parse_calendar(json.load(f))
+    except Exception as e:
+        # Fall back to weekends only rather than failing every timetable route.
+        print(f"service calendar {path}: {e}", file=sys.stderr)
+        today = date.today()
+        return ServiceCalendar(today, today)
+
+
+calendar = load_calendar()
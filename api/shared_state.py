@@ -0,0 +1,213 @@
+import json
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from typing import Dict, Optional, Tuple
+
+try:
+    import fcntl
+except Exception:
+    fcntl = None
+
+# "memory": every process keeps its own state and acts as leader (default).
+# "mmap": workers share one memory-mapped file; only the elected leader runs
+# the MQTT subscriber and bike refresher, the others read its published state.
+BACKEND = os.getenv("STATE_BACKEND", "memory")
+STATE_DIR = os.getenv("STATE_DIR", os.path.join(tempfile.gettempdir(), "digital-twin-bus"))
+LEADER_RETRY_SECS = 5.0
+# A reader racing a writer retries this many times, yielding the GIL in
+# between (never sleeping: readers run on the event loop), then falls back to
+# the last value it read.
+READ_ATTEMPTS = 16
+SLOTS = {
+    "congestion": 512 * 1024,
+    "bike": 1024 * 1024,
+    "realtime": 256 * 1024,
+    "stations": 2 * 1024 * 1024,
+}
+
+
+class MemoryStore:
+
+    def __init__(self):
+        self._data: Dict[str, Tuple[int, object]] = {}
+
+    def put(self, key: str, value) -> None:
+        version = self._data.get(key, (0, None))[0] + 1
+        self._data[key] = (version, value)
+
+    def get(self, key: str) -> Tuple[int, Optional[object]]:
+        return self._data.get(key, (0, None))
+
+    def version(self, key: str) -> int:
+        return self._data.get(key, (0, None))[0]
+
+
+# Fixed slots in a shared file, each guarded by a sequence counter (seqlock):
+# the single writer makes the counter odd while it copies, readers retry when
+# they see an odd or changed counter. Readers never take a lock. The file
+# starts with a magic and a hash of the slot layout; the file outlives the
+# processes, so until an elected leader has (re)initialized a file written
+# with another layout, readers treat every slot as empty.
+class MmapStore:
+    HEADER = struct.Struct("<QI")
+    FILE_HEADER = struct.Struct("<8sI")
+    MAGIC = b"DTBSTAT1"
+
+    def __init__(self, path: str, slots: Dict[str, int]):
+        import mmap
+
+        layout = json.dumps(sorted(slots.items())).encode()
+        self._file_header = self.FILE_HEADER.pack(self.MAGIC, zlib.crc32(layout))
+        self._offsets: Dict[str, Tuple[int, int]] = {}
+        offset = self.FILE_HEADER.size
+        for key, size in slots.items():
+            self._offsets[key] = (offset, size)
+            offset += self.HEADER.size + size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size < offset:
+                os.ftruncate(fd, offset)
+            self._mm = mmap.mmap(fd, offset)
+        finally:
+            os.close(fd)
+        self._size = offset
+        self._parsed: Dict[str, Tuple[int, object]] = {}
+
+    def initialized(self) -> bool:
+        return self._mm[:self.FILE_HEADER.size] == self._file_header
+
+    def initialize(self) -> None:
+        # Leader only: wipes a file left with another layout (or garbage).
+        if self.initialized():
+            return
+        self._mm[:self._size] = bytes(self._size)
+        self._mm[:self.FILE_HEADER.size] = self._file_header
+        self._parsed.clear()
+
+    def _seq(self, off: int) -> int:
+        return struct.unpack_from("<Q", self._mm, off)[0]
+
+    def put(self, key: str, value) -> None:
+        off, size = self._offsets[key]
+        data = json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        if len(data) > size:
+            raise ValueError(f"shared state {key!r} too large: {len(data)} > {size}")
+        seq = self._seq(off)
+        if seq & 1:
+            seq += 1
+        struct.pack_into("<Q", self._mm, off, seq + 1)
+        start = off + self.HEADER.size
+        self._mm[start:start + len(data)] = data
+        self.HEADER.pack_into(self._mm, off, seq + 1, len(data))
+        struct.pack_into("<Q", self._mm, off, seq + 2)
+
+    def _read_raw(self, key: str) -> Optional[Tuple[int, Optional[bytes]]]:
+        # None if every attempt overlapped a write.
+        off, size = self._offsets[key]
+        start = off + self.HEADER.size
+        for _ in range(READ_ATTEMPTS):
+            seq, length = self.HEADER.unpack_from(self._mm, off)
+            if not seq & 1:
+                data = self._mm[start:start + min(length, size)]
+                if self._seq(off) == seq:
+                    return seq // 2, (data if seq else None)
+            time.sleep(0)
+        return None
+
+    def get(self, key: str) -> Tuple[int, Optional[object]]:
+        version = self.version(key)
+        cached = self._parsed.get(key)
+        if cached is not None and cached[0] == version:
+            return cached
+        raw = self._read_raw(key) if self.initialized() else None
+        if raw is not None:
+            try:
+                version, data = raw
+                value = json.loads(data) if data else None
+            except ValueError as e:
+                # Not parsed again until the slot is next written.
+                print(f"shared state {key!r}: {e}", file=sys.stderr)
+                self._parsed[key] = (version, cached[1] if cached is not None else None)
+                raw = None
+        if raw is None:
+            # Keep serving the last value read rather than an empty one.
+            return cached if cached is not None else (0, None)
+        self._parsed[key] = (version, value)
+        return version, value
+
+    def version(self, key: str) -> int:
+        if not self.initialized():
+            return 0
+        return self._seq(self._offsets[key][0]) // 2
+
+
+_store = None
+_store_lock = threading.Lock()
+_leader_fd: Optional[int] = None
+_next_attempt = 0.0
+
+
+def is_shared() -> bool:
+    return BACKEND == "mmap"
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                if is_shared():
+                    os.makedirs(STATE_DIR, exist_ok=True)
+                    _store = MmapStore(os.path.join(STATE_DIR, "state.bin"), SLOTS)
+                else:
+                    _store = MemoryStore()
+    return _store
+
+
+def try_become_leader() -> bool:
+    global _leader_fd
+    if _leader_fd is not None:
+        return True
+    if not is_shared() or fcntl is None:
+        _leader_fd = -1
+        return True
+    os.makedirs(STATE_DIR, exist_ok=True)
+    fd = os.open(os.path.join(STATE_DIR, "leader.lock"), os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return False
+    # The lock is released by the kernel when this process exits.
+    _leader_fd = fd
+    get_store().initialize()
+    print(f"pid {os.getpid()} elected leader", file=sys.stderr)
+    return True
+
+
+def is_leader() -> bool:
+    global _next_attempt
+    if _leader_fd is not None:
+        return True
+    now = time.monotonic()
+    if now < _next_attempt:
+        return False
+    _next_attempt = now + LEADER_RETRY_SECS
+    return try_become_leader()
+
+
+def publish(key: str, value) -> None:
+    get_store().put(key, value)
+
+
+def read(key: str) -> Optional[object]:
+    return get_store().get(key)[1]
+
+
+def version(key: str) -> int:
+    return get_store().version(key)
@@ -0,0 +1,154 @@
+import json
+import math
+import os
+import sys
+from array import array
+from typing import Dict, Iterable, List, Optional, Tuple
+
+GROUPS_FILE = os.getenv(
+    "BIKE_STATION_GROUPS_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "station_groups.json"),
+)
+# The groups bike.compute_bike_metrics_directional is built from; used when
+# the groups file cannot be read.
+DEFAULT_GROUPS = {
+    "sfc": ["5143"],
+    "shonandai-primary": ["5609", "7395", "11403", "16084"],
+    "shonandai-secondary": ["12189", "5113", "4035", "11908"],
+}
+
+# The station_information fields an index keeps, in shared-state row order.
+INFO_FIELDS = ("station_id", "name", "lat", "lon", "capacity")
+GRID_DEG = 0.01  # about 1.1 km north-south
+EARTH_RADIUS_M = 6371008.8
+
+
+def parse_groups(data: Dict) -> Dict[str, List[str]]:
+    # Station IDs are kept as strings, in order, each listed once.
+    groups = {}
+    for name, ids in data.items():
+        if not isinstance(ids, list):
+            raise ValueError(f"group {name!r}: expected a list of station IDs")
+        groups[str(name)] = list(dict.fromkeys(str(sid) for sid in ids))
+    return groups
+
+
+def load_groups(path: str = GROUPS_FILE) -> Dict[str, List[str]]:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return parse_groups(json.load(f))
+    except Exception as e:
+        print(f"station groups {path}: {e}", file=sys.stderr)
+        return parse_groups(DEFAULT_GROUPS)
+
+
+groups = load_groups()
+
+
+def _distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    p1 = math.radians(lat1)
+    p2 = math.radians(lat2)
+    dp = p2 - p1
+    dl = math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _cell(lat: float, lon: float) -> Tuple[int, int]:
+    return math.floor(lat / GRID_DEG), math.floor(lon / GRID_DEG)
+
+
+# Station coordinates in parallel arrays, bucketed into a grid of GRID_DEG
+# cells. A nearby query only measures the stations in the cells its radius
+# touches, so it costs the same whatever the size of the national list. Built
+# once per station_information body.
+class StationIndex:
+
+    def __init__(self, stations: Iterable[Dict] = (), version: int = 0):
+        self.version = version
+        self.ids: List[str] = []
+        self.names: List[str] = []
+        self.lat = array("d")
+        self.lon = array("d")
+        self.capacity = array("H")
+        self._by_id: Dict[str, int] = {}
+        self._cells: Dict[Tuple[int, int], array] = {}
+        for s in stations:
+            self.add(s)
+
+    def add(self, station: Dict) -> None:
+        # One station_information record; those without coordinates are skipped.
+        try:
+            lat = float(station["lat"])
+            lon = float(station["lon"])
+        except (KeyError, TypeError, ValueError):
+            return
+        sid = str(station.get("station_id"))
+        i = len(self.ids)
+        self.ids.append(sid)
+        self.names.append(station.get("name") or "")
+        self.lat.append(lat)
+        self.lon.append(lon)
+        self.capacity.append(min(max(int(station.get("capacity") or 0), 0), 65535))
+        self._by_id[sid] = i
+        cell = self._cells.get(_cell(lat, lon))
+        if cell is None:
+            cell = self._cells[_cell(lat, lon)] = array("I")
+        cell.append(i)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def get(self, sid: str) -> Optional[Dict]:
+        i = self._by_id.get(sid)
+        if i is None:
+            return None
+        return {
+            "station_id": sid,
+            "name": self.names[i],
+            "lat": self.lat[i],
+            "lon": self.lon[i],
+            "capacity": self.capacity[i],
+        }
+
+    def nearby(self, lat: float, lon: float, radius: float, limit: int) -> List[Tuple[float, int]]:
+        # (distance in metres, station index) within radius, nearest first.
+        # Near the poles the radius spans more cells than there are occupied
+        # ones (or wraps the antimeridian); then every station is measured.
+        dlat = math.degrees(radius / EARTH_RADIUS_M)
+        dlon = min(dlat / max(math.cos(math.radians(lat)), 1e-6), 180.0)
+        lat0, lon0 = _cell(lat - dlat, lon - dlon)
+        lat1, lon1 = _cell(lat + dlat, lon + dlon)
+        if (lat1 - lat0 + 1) * (lon1 - lon0 + 1) > len(self._cells) or abs(lon) + dlon > 180:
+            candidates = range(len(self.ids))
+        else:
+            candidates = (
+                i
+                for ci in range(lat0, lat1 + 1)
+                for cj in range(lon0, lon1 + 1)
+                for i in self._cells.get((ci, cj), ())
+            )
+        found = []
+        for i in candidates:
+            d = _distance(lat, lon, self.lat[i], self.lon[i])
+            if d <= radius:
+                found.append((d, i))
+        found.sort()
+        return found[:limit]
+
+    def to_rows(self) -> Dict:
+        # Compact form for shared state.
+        return {
+            "version": self.version,
+            "stations": [
+                [self.ids[i], self.names[i], self.lat[i], self.lon[i], self.capacity[i]]
+                for i in range(len(self.ids))
+            ],
+        }
+
+    @classmethod
+    def from_rows(cls, data: Dict) -> "StationIndex":
+        return cls(
+            (dict(zip(INFO_FIELDS, row)) for row in data["stations"]),
+            int(data.get("version") or 0),
+        )
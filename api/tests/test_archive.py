@@ -0,0 +1,72 @@
+import os
+
+import archive
+from archive import INDEX, Archive, _Partition, _read_block
+
+T0 = 1_790_000_000.0  # 2026-09-21 UTC, away from a day boundary
+
+
+def _index_entries(base):
+    with open(base + ".idx", "rb") as f:
+        return list(INDEX.iter_unpack(f.read()))
+
+
+def test_block_round_trip_with_rows_out_of_order(tmp_path):
+    p = _Partition(str(tmp_path), "2026-09-21")
+    rows = [(T0, "a", 3, 7), (T0 - 100.5, "b", 1, 0), (T0 + 42.25, "a", 70000, -1)]
+    p.append(rows)
+    [(offset, length, n, first, last)] = _index_entries(p.base)
+    assert (n, first, last) == (3, T0 - 100.5, T0 + 42.25)
+    with open(p.base + ".log", "rb") as f:
+        start, ts, keys, v1, v2 = _read_block(f, offset, length)
+    decoded = [(start + ts[i] / 1000, keys[i], v1[i], v2[i]) for i in range(n)]
+    a, b = p.keys["a"], p.keys["b"]
+    # Sorted by time; values clamped to uint16.
+    assert decoded == [(T0 - 100.5, b, 1, 0), (T0, a, 3, 7), (T0 + 42.25, a, 65535, 0)]
+
+
+def test_query_buckets_disk_and_pending_rows(tmp_path):
+    store = Archive(str(tmp_path))
+    os.makedirs(os.path.join(str(tmp_path), "bike"))
+    day = archive._day(T0)
+    store._partition("bike", day).append([(T0 + i * 10, "s1", i, 10 - i) for i in range(6)])
+    store._partition("bike", day).append([(T0 + 1000, "s2", 50, 0)])
+    store._pending["bike"].append((T0 + 65, "s1", 9, 1))
+    points = store.query("bike", "s1", T0, T0 + 120, 60)
+    assert points == [
+        [T0, 6, 2.5, 0, 5, 7.5],
+        [T0 + 60, 1, 9.0, 9, 9, 1.0],
+    ]
+    assert store.query("bike", "s2", T0, T0 + 120, 60) == []
+    assert store.keys("bike", day) == ["s1", "s2"]
+
+
+def test_index_skips_blocks_outside_the_range(tmp_path, monkeypatch):
+    store = Archive(str(tmp_path))
+    os.makedirs(os.path.join(str(tmp_path), "congestion"))
+    day = archive._day(T0)
+    store._partition("congestion", day).append([(T0 + i, "*", 1, 0) for i in range(10)])
+    store._partition("congestion", day).append([(T0 + 5000 + i, "*", 2, 0) for i in range(10)])
+    read = []
+    real = archive._read_block
+
+    def spy(f, offset, length):
+        read.append(offset)
+        return real(f, offset, length)
+
+    monkeypatch.setattr(archive, "_read_block", spy)
+    points = store.query("congestion", "*", T0 + 4000, T0 + 6000, 3600)
+    assert points == [[T0 + 4000, 10, 2.0, 2, 2, 0.0]]
+    assert len(read) == 1
+
+
+def test_record_is_a_no_op_until_started_and_drops_when_full(tmp_path, monkeypatch):
+    store = Archive(str(tmp_path))
+    store.record("bike", "s1", T0, 1)
+    assert store.stats["queued"] == 0
+    monkeypatch.setattr(store, "_run", lambda: None)
+    store._queue.maxsize = 2
+    store.start()
+    for i in range(3):
+        store.record("bike", "s1", T0 + i, i)
+    assert (store.stats["queued"], store.stats["dropped"]) == (2, 1)
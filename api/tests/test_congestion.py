@@ -0,0 +1,96 @@
+import random
+
+import pytest
+
+from congestion import PERCENTILES, CongestionHistory, SensorTable
+
+
+def _naive_stats(samples, window_min, now):
+    values = sorted(c for ts, c in samples if ts >= now - window_min * 60)
+    if not values:
+        return None
+    n = len(values)
+    out = {"samples": n, "mean": round(sum(values) / n, 2), "max": values[-1]}
+    for p in PERCENTILES:
+        out[f"p{p}"] = values[max(1, -(-p * n // 100)) - 1]
+    return out
+
+
+@pytest.mark.parametrize("capacity", [64, 4096])
+def test_window_stats_match_a_full_scan(capacity):
+    rng = random.Random(1)
+    h = CongestionHistory(capacity, windows_min=(1, 5, 15))
+    samples = []
+    ts = 1_000_000.0
+    for _ in range(3000):
+        ts += rng.uniform(0.05, 2.0)
+        c = rng.randint(0, 40)
+        h.append(c, ts)
+        samples.append((ts, c))
+        if len(samples) % 250 == 0:
+            retained = samples[-capacity:]
+            for w in (1, 5, 15):
+                got = h.stats(w, ts)
+                want = _naive_stats(retained, w, ts)
+                assert got["samples"] == want["samples"]
+                assert {k: got[k] for k in want} == want
+
+
+def test_windows_empty_out_as_time_passes():
+    h = CongestionHistory(16, windows_min=(1, 5))
+    h.append(7, 100.0)
+    assert h.stats(1, 100.0)["samples"] == 1
+    assert h.stats(1, 161.0)["samples"] == 0
+    assert h.stats(1, 161.0)["mean"] is None
+    assert h.stats(5, 161.0)["max"] == 7
+    assert h.samples(5, now=161.0) == [[100.0, 7]]
+
+
+def test_counts_are_clamped_and_windows_validated():
+    h = CongestionHistory(8, windows_min=(1,), max_count=10)
+    h.append(-3, 1.0)
+    h.append(99, 2.0)
+    assert [c for _, c in h.samples(1, now=2.0)] == [0, 10]
+    with pytest.raises(KeyError):
+        h.stats(7, 2.0)
+
+
+def test_samples_are_downsampled_to_the_limit():
+    h = CongestionHistory(1024, windows_min=(15,))
+    for i in range(600):
+        h.append(i % 50, 1000.0 + i)
+    out = h.samples(15, limit=100, now=1600.0)
+    assert len(out) <= 100
+    assert out[0] == [1000.0, 0]
+
+
+def test_combined_count_drops_stale_sensors():
+    table = SensorTable(64, 64, stale_secs=60)
+    table.record("a", 10, 1000.0)
+    table.record("b", 5, 1001.0)
+    assert table.combined.latest() == (1001.0, 15)
+    table.record("b", 6, 1100.0)
+    assert table.combined.latest() == (1100.0, 6)
+    table.record("a", 3, 1101.0)
+    assert table.combined.latest() == (1101.0, 9)
+    assert table.latest() == {"a": 3, "b": 6}
+
+
+def test_a_failing_listener_does_not_stop_the_others():
+    table = SensorTable(16, 16)
+    seen = []
+    table.add_listener(lambda sensor, count, ts: 1 / 0)
+    table.add_listener(lambda sensor, count, ts: seen.append((sensor, count)))
+    table.record("a", 4, 10.0)
+    assert seen == [("a", 4)]
+    assert table.latest() == {"a": 4}
+
+
+def test_view_history_is_shared_out_between_sensors():
+    table = SensorTable(512, 4096)
+    for k in range(300):
+        for s in range(100):
+            table.record(f"s{s}", k % 20, 1000.0 + k + s / 1000)
+    view = table.view(1300.0)
+    assert len(view["history"]["*"]) <= 300
+    assert all(len(view["history"][f"s{s}"]) <= 60 for s in range(100))
@@ -0,0 +1,57 @@
+import json
+
+import pytest
+
+from gbfs_stream import StationStreamParser
+
+STATIONS = [
+    {"station_id": str(i), "name": f"ステーション{i}", "lat": 35.3 + i / 1000, "lon": 139.4, "capacity": i % 12}
+    for i in range(200)
+]
+DOCUMENT = json.dumps(
+    {"last_updated": 1700000000, "ttl": 60, "version": "2.3", "data": {"stations": STATIONS}},
+    ensure_ascii=False,
+).encode("utf-8")
+
+
+def _parse(body: bytes, chunk_size: int, parser=None):
+    parser = parser or StationStreamParser()
+    for i in range(0, len(body), chunk_size):
+        parser.feed(body[i:i + chunk_size])
+    return parser.close()
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 1024, len(DOCUMENT)])
+def test_any_chunking_gives_the_whole_document(chunk_size):
+    # Size 1 also splits every multi-byte UTF-8 character.
+    out = _parse(DOCUMENT, chunk_size)
+    assert out["data"]["stations"] == STATIONS
+    assert out["last_updated"] == 1700000000
+    assert out["ttl"] == 60
+
+
+def test_metadata_after_the_stations_array():
+    body = json.dumps({"data": {"stations": STATIONS[:3]}, "last_updated": 5, "ttl": 30}).encode()
+    out = _parse(body, 10)
+    assert out["data"]["stations"] == STATIONS[:3]
+    assert (out["last_updated"], out["ttl"]) == (5, 30)
+
+
+def test_truncated_feed_raises():
+    with pytest.raises(ValueError):
+        _parse(DOCUMENT[:len(DOCUMENT) // 2], 512)
+
+
+def test_subclasses_choose_what_to_keep():
+    class Ids(StationStreamParser):
+        def __init__(self):
+            super().__init__()
+            self.ids = []
+
+        def add(self, station):
+            self.ids.append(station["station_id"])
+
+    parser = Ids()
+    out = _parse(DOCUMENT, 333, parser)
+    assert parser.ids == [s["station_id"] for s in STATIONS]
+    assert out["data"]["stations"] == []
@@ -0,0 +1,71 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import gtfs_realtime
+
+TZ = timezone(timedelta(hours=9))
+NOW = datetime(2026, 4, 6, 8, 0, tzinfo=TZ)
+LINE = "下校-湘25"
+
+
+def _item(minutes: int):
+    return {"line": LINE, "datetime": NOW + timedelta(minutes=minutes)}
+
+
+def _predict(item, delay_min: int, canceled: bool = False):
+    dt = item["datetime"]
+    key = ("from-school", LINE, dt.toordinal(), dt.hour * 60 + dt.minute)
+    gtfs_realtime._predictions[key] = {
+        "tripId": f"t{dt.minute}",
+        "predicted": (dt + timedelta(minutes=delay_min)).timestamp(),
+        "delay": delay_min * 60,
+        "canceled": canceled,
+        "vehicle": None,
+        "updatedAt": NOW.timestamp(),
+    }
+
+
+@pytest.fixture(autouse=True)
+def predictions(monkeypatch):
+    monkeypatch.setattr(gtfs_realtime, "_predictions", {})
+
+
+def _minutes(items):
+    return [int((it["datetime"] - NOW).total_seconds() // 60) for it in items]
+
+
+def test_without_predictions_the_schedule_is_returned():
+    upcoming = [_item(m) for m in (0, 10, 20)]
+    assert gtfs_realtime.merge("from-school", [_item(-5)], upcoming, NOW, 2) == upcoming[:2]
+
+
+def test_delayed_bus_is_ordered_by_its_predicted_time():
+    upcoming = [_item(m) for m in (2, 5, 30)]
+    _predict(upcoming[0], 10)
+    out = gtfs_realtime.merge("from-school", [], upcoming, NOW, 2)
+    assert _minutes(out) == [5, 2]
+    assert out[1]["realtime"]["delay"] == 600
+
+
+def test_late_bus_from_the_lookback_is_still_shown():
+    past = [_item(-10), _item(-3)]
+    _predict(past[1], 8)
+    out = gtfs_realtime.merge("from-school", past, [_item(10)], NOW, 5)
+    assert _minutes(out) == [-3, 10]
+
+
+def test_cancelled_trips_only_while_upcoming():
+    past, upcoming = [_item(-4)], [_item(6), _item(15)]
+    _predict(past[0], 0, canceled=True)
+    _predict(upcoming[0], 0, canceled=True)
+    out = gtfs_realtime.merge("from-school", past, upcoming, NOW, 5)
+    assert _minutes(out) == [6, 15]
+    assert out[0]["realtime"]["canceled"] is True
+
+
+def test_predictions_of_the_other_direction_are_ignored():
+    upcoming = [_item(2), _item(5)]
+    _predict(upcoming[0], 10)
+    out = gtfs_realtime.merge("to-school", [], upcoming, NOW, 2)
+    assert out == upcoming
@@ -0,0 +1,85 @@
+import os
+import struct
+
+import pytest
+
+from shared_state import MmapStore
+
+SLOTS = {"bike": 1024, "congestion": 256}
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "state.bin")
+
+
+def _leader(path, slots=SLOTS):
+    store = MmapStore(path, slots)
+    store.initialize()
+    return store
+
+
+def test_round_trip_and_versions(path):
+    leader = _leader(path)
+    follower = MmapStore(path, SLOTS)
+    assert follower.get("bike") == (0, None)
+    leader.put("bike", {"a": 1, "名前": "駅"})
+    assert follower.version("bike") == 1
+    assert follower.get("bike") == (1, {"a": 1, "名前": "駅"})
+    leader.put("bike", [1, 2, 3])
+    assert follower.get("bike") == (2, [1, 2, 3])
+    assert follower.get("congestion") == (0, None)
+
+
+def test_oversized_value_is_rejected(path):
+    leader = _leader(path)
+    with pytest.raises(ValueError):
+        leader.put("congestion", "x" * 1000)
+    assert leader.get("congestion") == (0, None)
+
+
+def test_reader_keeps_last_value_while_a_write_is_in_progress(path):
+    leader = _leader(path)
+    follower = MmapStore(path, SLOTS)
+    leader.put("bike", {"v": 1})
+    assert follower.get("bike") == (1, {"v": 1})
+    off = leader._offsets["bike"][0]
+    # A writer that died half-way: the counter stays odd.
+    struct.pack_into("<Q", leader._mm, off, leader._seq(off) + 3)
+    assert follower.get("bike")[1] == {"v": 1}
+    leader.put("bike", {"v": 2})
+    assert follower.get("bike")[1] == {"v": 2}
+
+
+def test_corrupt_payload_falls_back_to_last_value(path):
+    leader = _leader(path)
+    follower = MmapStore(path, SLOTS)
+    leader.put("bike", {"v": 1})
+    follower.get("bike")
+    off = leader._offsets["bike"][0]
+    leader._mm[off + MmapStore.HEADER.size] = 0xFF
+    struct.pack_into("<Q", leader._mm, off, leader._seq(off) + 2)
+    assert follower.get("bike")[1] == {"v": 1}
+
+
+def test_leftover_file_is_empty_until_the_leader_initializes_it(path):
+    with open(path, "wb") as f:
+        f.write(os.urandom(4096))
+    follower = MmapStore(path, SLOTS)
+    assert not follower.initialized()
+    assert follower.version("bike") == 0
+    assert follower.get("bike") == (0, None)
+    leader = _leader(path)
+    leader.put("bike", {"ok": True})
+    assert follower.get("bike") == (1, {"ok": True})
+
+
+def test_layout_change_invalidates_the_file(path):
+    old = _leader(path)
+    old.put("bike", {"v": 1})
+    resized = dict(SLOTS, bike=2048)
+    new_follower = MmapStore(path, resized)
+    assert new_follower.get("bike") == (0, None)
+    new_leader = _leader(path, resized)
+    assert new_leader.get("bike") == (0, None)
+    assert not old.initialized()
@@ -0,0 +1,233 @@
+import csv
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from typing import Dict, NamedTuple, Optional
+
+import bus
+from bus_data import TIMETABLE_FROM_SCHOOL, TIMETABLE_TO_SCHOOL
+from service_calendar import DAY_TYPES
+
+DIRECTIONS = ("from-school", "to-school")
+# JSON ({direction: {line: {"description", day_type: {hour: [minutes]}}}}) or
+# CSV (direction,line,day_type,time[,description]). Unset: the tables in bus_data.
+TIMETABLE_FILE = os.getenv("TIMETABLE_FILE", "")
+CACHE_DIR = os.getenv("TIMETABLE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "digital-twin-bus"))
+RELOAD_CHECK_SECS = float(os.getenv("TIMETABLE_RELOAD_CHECK_SECS", "5"))
+
+MAGIC = b"DTBTT001"
+_HEADER = struct.Struct("<8sI")
+
+
+class Timetables(NamedTuple):
+    version: int
+    tables: Dict[str, Dict]
+    source: str
+
+
+def _load_json(path: str) -> Dict[str, Dict]:
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    return {d: data.get(d, {}) for d in DIRECTIONS}
+
+
+def _load_csv(path: str) -> Dict[str, Dict]:
+    tables: Dict[str, Dict] = {d: {} for d in DIRECTIONS}
+    with open(path, encoding="utf-8", newline="") as f:
+        for row in csv.DictReader(f):
+            direction, day_type = row["direction"].strip(), row["day_type"].strip()
+            if direction not in tables:
+                raise ValueError(f"unknown direction: {direction}")
+            if day_type not in DAY_TYPES:
+                raise ValueError(f"unknown day type: {day_type}")
+            line = tables[direction].setdefault(row["line"].strip(), {"description": ""})
+            if row.get("description"):
+                line["description"] = row["description"].strip()
+            h, m = row["time"].strip().split(":")
+            line.setdefault(day_type, {}).setdefault(str(int(h)), []).append(int(m))
+    for lines in tables.values():
+        for line in lines.values():
+            for day_type in DAY_TYPES:
+                hours = line.setdefault(day_type, {})
+                for minutes in hours.values():
+                    minutes.sort()
+    return tables
+
+
+def load_source(path: str) -> Dict[str, Dict]:
+    if path.lower().endswith(".csv"):
+        return _load_csv(path)
+    return _load_json(path)
+
+
+# Compiled form: MAGIC, header length, a JSON header holding the source
+# tables and the offsets of every minute array, then all arrays as one uint16
+# block. Loading maps the file and hands bus memoryview slices, so workers
+# share the pages and nothing is re-sorted or re-merged.
+def write_compiled(tables: Dict[str, Dict], path: str) -> None:
+    data = array("H")
+    layout: Dict[str, Dict] = {}
+
+    def put(values) -> list:
+        off = len(data)
+        data.extend(values)
+        return [off, len(values)]
+
+    for direction, timetable in tables.items():
+        index = bus.compile_timetable(timetable)
+        lines = index["lines"]
+        position = {line: i for i, line in enumerate(lines)}
+        layout[direction] = {
+            "lines": lines,
+            "by_line": {
+                line: {dt: put(mins) for dt, mins in per_day.items()}
+                for line, per_day in index["by_line"].items()
+            },
+            "merged": {},
+        }
+        for dt, (mins, names) in index["merged"].items():
+            off, n = put(mins)
+            names_off, _ = put(array("H", (position[name] for name in names)))
+            layout[direction]["merged"][dt] = [off, n, names_off]
+    header = json.dumps({"tables": tables, "layout": layout}, ensure_ascii=False).encode("utf-8")
+    header += b" " * (-(len(header) + _HEADER.size) % 2)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, len(header)))
+        f.write(header)
+        f.write(data.tobytes())
+    os.replace(tmp, path)
+
+
+def read_compiled(path: str):
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, header_len = _HEADER.unpack_from(mm, 0)
+    if magic != MAGIC:
+        raise ValueError(f"not a compiled timetable: {path}")
+    start = _HEADER.size + header_len
+    meta = json.loads(bytes(mm[_HEADER.size:start]))
+    data = memoryview(mm)[start:].cast("H")
+    indexes = {}
+    for direction, layout in meta["layout"].items():
+        lines = layout["lines"]
+        merged = {}
+        for dt, (off, n, names_off) in layout["merged"].items():
+            merged[dt] = (data[off:off + n], [lines[i] for i in data[names_off:names_off + n]])
+        indexes[direction] = {
+            "lines": lines,
+            "by_line": {
+                line: {dt: data[off:off + n] for dt, (off, n) in per_day.items()}
+                for line, per_day in layout["by_line"].items()
+            },
+            "merged": merged,
+        }
+    return meta["tables"], indexes
+
+
+def _cache_path(path: str, st: os.stat_result) -> str:
+    source = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:12]
+    state = hashlib.sha1(f"{st.st_mtime_ns}:{st.st_size}:{sys.byteorder}".encode()).hexdigest()[:12]
+    return os.path.join(CACHE_DIR, f"timetable-{source}-{state}.bin")
+
+
+def compile_file(path: str, st: os.stat_result):
+    # Workers started together race to build the same cache file; os.replace
+    # makes the last writer win with identical content.
+    cache = _cache_path(path, st)
+    if not os.path.exists(cache):
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        write_compiled(load_source(path), cache)
+        prefix = os.path.basename(cache).rsplit("-", 1)[0] + "-"
+        for name in os.listdir(CACHE_DIR):
+            # Mappings already open elsewhere stay valid after the unlink.
+            if name.startswith(prefix) and name.endswith(".bin") and name != os.path.basename(cache):
+                try:
+                    os.unlink(os.path.join(CACHE_DIR, name))
+                except OSError:
+                    pass
+    return read_compiled(cache)
+
+
+def _stat_key(st: os.stat_result):
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+# Holds the current Timetables and swaps it as a whole when the source file
+# changes. Requests keep whatever snapshot they started with; the version is
+# part of every response cache key, so stale bodies are never served.
+class TimetableStore:
+
+    def __init__(self, path: str = TIMETABLE_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._checked_at = 0.0
+        self._stat = None
+        self._reloading = False
+        tables = {"from-school": TIMETABLE_FROM_SCHOOL, "to-school": TIMETABLE_TO_SCHOOL}
+        self._current = Timetables(0, tables, "bus_data")
+        if path:
+            # A missing or broken file must not stop the app from starting:
+            # serve the bundled tables until a good file appears (_check
+            # picks it up then, as for any other change).
+            try:
+                st = os.stat(path)
+                self._current = self._install(0, *compile_file(path, st), None)
+                self._stat = _stat_key(st)
+            except Exception as e:
+                print(f"timetable {path}: {e}; using the bundled timetable", file=sys.stderr)
+
+    def _install(self, version: int, tables: Dict[str, Dict], indexes: Dict[str, Dict],
+                 previous: Optional[Timetables]) -> Timetables:
+        for direction, timetable in tables.items():
+            bus.set_index(timetable, indexes[direction])
+        if previous is not None:
+            for timetable in previous.tables.values():
+                bus.forget_index(timetable)
+        return Timetables(version, tables, self.path)
+
+    def current(self) -> Timetables:
+        if self.path:
+            now = time.monotonic()
+            if now - self._checked_at >= RELOAD_CHECK_SECS:
+                self._checked_at = now
+                self._check()
+        return self._current
+
+    def _check(self) -> None:
+        try:
+            st = os.stat(self.path)
+        except OSError as e:
+            print(f"timetable {self.path}: {e}", file=sys.stderr)
+            return
+        if _stat_key(st) == self._stat:
+            return
+        with self._lock:
+            if self._reloading:
+                return
+            self._reloading = True
+        threading.Thread(target=self._reload, args=(st,), daemon=True).start()
+
+    def _reload(self, st: os.stat_result) -> None:
+        try:
+            tables, indexes = compile_file(self.path, st)
+            previous = self._current
+            self._current = self._install(previous.version + 1, tables, indexes, previous)
+            self._stat = _stat_key(st)
+            print(f"timetable reloaded from {self.path} (version {self._current.version})", file=sys.stderr)
+        except Exception as e:
+            # Keep serving the previous tables; retried on the next change.
+            self._stat = _stat_key(st)
+            print(f"timetable reload failed: {e}", file=sys.stderr)
+        finally:
+            self._reloading = False
+
+
+store = TimetableStore()
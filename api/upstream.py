@@ -0,0 +1,148 @@
+import asyncio
+import queue
+import time
+from typing import Dict, Optional
+
+import httpx
+
+MAX_CONCURRENCY = 4
+TIMEOUT = httpx.Timeout(10.0, connect=5.0)
+LIMITS = httpx.Limits(max_connections=8, max_keepalive_connections=4, keepalive_expiry=120)
+CHUNK_SIZE = 65536
+# Chunks read ahead of the parser; past this the read waits for it.
+PARSE_AHEAD_CHUNKS = 4
+
+_client: Optional[httpx.AsyncClient] = None
+_semaphore: Optional[asyncio.Semaphore] = None
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_validators: Dict[str, Dict[str, str]] = {}
+_stats: Dict[str, Dict] = {}
+_closing = set()
+
+
+def get_stats() -> Dict[str, Dict]:
+    return {url: dict(s) for url, s in _stats.items()}
+
+
+def _ensure_client() -> httpx.AsyncClient:
+    # Pool and semaphore are bound to the running loop; recreate them if the
+    # loop changed (e.g. a new test client or a restarted server).
+    global _client, _semaphore, _loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _loop is not loop:
+        if _client is not None:
+            task = loop.create_task(_close_quietly(_client))
+            _closing.add(task)
+            task.add_done_callback(_closing.discard)
+        _client = httpx.AsyncClient(timeout=TIMEOUT, limits=LIMITS)
+        _semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+        _loop = loop
+    return _client
+
+
+async def _close_quietly(client: httpx.AsyncClient) -> None:
+    # A client left over from another loop: its connections may belong to a
+    # loop that is already closed, so closing them can fail.
+    try:
+        await client.aclose()
+    except Exception:
+        pass
+
+
+_END = object()
+_ABORT = object()
+
+
+def _drain(chunks: "queue.Queue", sink, loop: asyncio.AbstractEventLoop, credits: asyncio.Semaphore):
+    # Runs in an executor thread: feeds the sink until the body ends,
+    # handing a credit back to the reader for every chunk consumed.
+    while True:
+        chunk = chunks.get()
+        if chunk is _END:
+            return sink.close()
+        if chunk is _ABORT:
+            return None
+        sink.feed(chunk)
+        try:
+            loop.call_soon_threadsafe(credits.release)
+        except RuntimeError:
+            pass
+
+
+async def _credit(credits: asyncio.Semaphore, parsed: asyncio.Future) -> bool:
+    # Waits until the parser has room for another chunk; False if it has
+    # stopped (failed) instead.
+    if not credits.locked():
+        await credits.acquire()
+        return True
+    acquire = asyncio.ensure_future(credits.acquire())
+    await asyncio.wait((acquire, parsed), return_when=asyncio.FIRST_COMPLETED)
+    if acquire.done():
+        return True
+    acquire.cancel()
+    return False
+
+
+# Streams the body into sink.feed() and returns sink.close(), or None on a
+# 304. Parsing runs in an executor thread fed through a queue, so the loop
+# only does the network reads; at most PARSE_AHEAD_CHUNKS wait in the queue. Validators are only remembered once the sink
+# accepted the whole body.
+async def fetch_stream(url: str, sink, conditional: bool = True):
+    client = _ensure_client()
+    headers: Dict[str, str] = {}
+    if conditional:
+        saved = _validators.get(url) or {}
+        if "etag" in saved:
+            headers["If-None-Match"] = saved["etag"]
+        if "last-modified" in saved:
+            headers["If-Modified-Since"] = saved["last-modified"]
+
+    stats = _stats.setdefault(url, {
+        "requests": 0, "not_modified": 0, "errors": 0,
+        "last_status": None, "last_duration": None, "last_success_at": 0.0,
+    })
+    stats["requests"] += 1
+    start = time.perf_counter()
+    try:
+        async with _semaphore:
+            async with client.stream("GET", url, headers=headers) as resp:
+                stats["last_status"] = resp.status_code
+                if resp.status_code == 304:
+                    stats["not_modified"] += 1
+                    stats["last_success_at"] = time.time()
+                    return None
+                resp.raise_for_status()
+                loop = asyncio.get_running_loop()
+                chunks: "queue.Queue" = queue.Queue()
+                credits = asyncio.Semaphore(PARSE_AHEAD_CHUNKS)
+                parsed = loop.run_in_executor(None, _drain, chunks, sink, loop, credits)
+                try:
+                    async for chunk in resp.aiter_bytes(CHUNK_SIZE):
+                        if not await _credit(credits, parsed):
+                            break
+                        chunks.put_nowait(chunk)
+                except BaseException:
+                    chunks.put_nowait(_ABORT)
+                    raise
+                chunks.put_nowait(_END)
+                result = await parsed
+                saved = {}
+                if resp.headers.get("etag"):
+                    saved["etag"] = resp.headers["etag"]
+                if resp.headers.get("last-modified"):
+                    saved["last-modified"] = resp.headers["last-modified"]
+                _validators[url] = saved
+                stats["last_success_at"] = time.time()
+                return result
+    except Exception:
+        stats["errors"] += 1
+        raise
+    finally:
+        stats["last_duration"] = time.perf_counter() - start
+
+
+async def aclose() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
@@ -43,51 +43,60 @@ async function loadBus(){
   }
 }
 
+function renderCongestion(data){
+  const badge = document.getElementById('crowd');
+  const lv = String(data?.level||'').toLowerCase();
+  const jp = { low: '混雑なし', mid: 'やや混雑', high: '混雑' };
+  badge.textContent = `${jp[lv] || '--'}`;
+  badge.classList.remove('low','mid','high');
+  if(lv==='low'||lv==='mid'||lv==='high') badge.classList.add(lv);
+}
+
 async function loadCongestion(){
   try{
     const data = await AppUtil.fetchAPI('/congestion', AppUtil.BASE.api);
-    const badge = document.getElementById('crowd');
-    const lv = String(data.level||'').toLowerCase();
-    const jp = { low: '混雑なし', mid: 'やや混雑', high: '混雑' };
-    badge.textContent = `${jp[lv] || '--'}`;
-    badge.classList.remove('low','mid','high');
-    if(lv==='low'||lv==='mid'||lv==='high') badge.classList.add(lv);
+    renderCongestion(data);
   }catch(e){
     AppUtil.setText('crowd', '--');
   }
 }
 
+let _lastBike = null;
+
+function renderBike(data){
+  const dir = AppUtil.direction();
+  const leftLabel = document.getElementById('bike-left-label');
+  const rightLabel = document.getElementById('bike-right-label');
+  const leftUnit = document.getElementById('bike-left-unit');
+  const rightUnit = document.getElementById('bike-right-unit');
+  const rightSmall = document.getElementById('bike-return-secondary');
+  if(dir === 'go'){
+    if(leftLabel) leftLabel.textContent = 'SFC前 返却';
+    if(rightLabel) rightLabel.textContent = '湘南台駅前 貸出';
+    if(leftUnit) leftUnit.textContent = '台空';
+    if(rightUnit) rightUnit.textContent = '台有';
+    AppUtil.setText('bike-avail', data?.go?.sfc_returnable);
+    const pri = data?.go?.shonandai_rentable?.primary;
+    const sec = data?.go?.shonandai_rentable?.secondary;
+    AppUtil.setText('bike-return', (typeof pri === 'number') ? pri : '--');
+    rightSmall.textContent = (typeof sec === 'number') ? `+${sec}(駅遠)` : '+--(駅遠)';
+  }else{
+    if(leftLabel) leftLabel.textContent = 'SFC前 貸出';
+    if(rightLabel) rightLabel.textContent = '湘南台駅前 返却';
+    if(leftUnit) leftUnit.textContent = '台有';
+    if(rightUnit) rightUnit.textContent = '台空';
+    AppUtil.setText('bike-avail', data?.back?.sfc_rentable);
+    const pri = data?.back?.shonandai_returnable?.primary;
+    const sec = data?.back?.shonandai_returnable?.secondary;
+    AppUtil.setText('bike-return', (typeof pri === 'number') ? pri : '--');
+    rightSmall.textContent = (typeof sec === 'number') ? `+${sec}(駅遠)` : '+--(駅遠)';
+  }
+}
+
 async function loadBike(){
-  async function getData(){ return AppUtil.fetchAPI('/bike-direction', AppUtil.BASE.api); }
   try{
-    const data = await getData();
-    const dir = AppUtil.direction();
-    const leftLabel = document.getElementById('bike-left-label');
-    const rightLabel = document.getElementById('bike-right-label');
-    const leftUnit = document.getElementById('bike-left-unit');
-    const rightUnit = document.getElementById('bike-right-unit');
-    const rightSmall = document.getElementById('bike-return-secondary');
-    if(dir === 'go'){
-      if(leftLabel) leftLabel.textContent = 'SFC前 返却';
-      if(rightLabel) rightLabel.textContent = '湘南台駅前 貸出';
-      if(leftUnit) leftUnit.textContent = '台空';
-      if(rightUnit) rightUnit.textContent = '台有';
-      AppUtil.setText('bike-avail', data?.go?.sfc_returnable);
-      const pri = data?.go?.shonandai_rentable?.primary;
-      const sec = data?.go?.shonandai_rentable?.secondary;
-      AppUtil.setText('bike-return', (typeof pri === 'number') ? pri : '--');
-      rightSmall.textContent = (typeof sec === 'number') ? `+${sec}(駅遠)` : '+--(駅遠)';
-    }else{
-      if(leftLabel) leftLabel.textContent = 'SFC前 貸出';
-      if(rightLabel) rightLabel.textContent = '湘南台駅前 返却';
-      if(leftUnit) leftUnit.textContent = '台有';
-      if(rightUnit) rightUnit.textContent = '台空';
-      AppUtil.setText('bike-avail', data?.back?.sfc_rentable);
-      const pri = data?.back?.shonandai_returnable?.primary;
-      const sec = data?.back?.shonandai_returnable?.secondary;
-      AppUtil.setText('bike-return', (typeof pri === 'number') ? pri : '--');
-      rightSmall.textContent = (typeof sec === 'number') ? `+${sec}(駅遠)` : '+--(駅遠)';
-    }
+    _lastBike = await AppUtil.fetchAPI('/bike-direction', AppUtil.BASE.api);
+    renderBike(_lastBike);
   }catch(e){
     AppUtil.setText('bike-avail', '--');
     AppUtil.setText('bike-return', '--');
@@ -96,6 +105,27 @@ async function loadBike(){
   }
 }
 
+// Push updates for congestion/bike; polling covers them until the stream
+// has delivered an event, and again while it is disconnected
+let _streamLive = false;
+
+function initStream(){
+  if(!window.EventSource) return;
+  const es = new EventSource(`${AppUtil.BASE.api}/stream`);
+  es.onerror = ()=>{ _streamLive = false; };
+  es.addEventListener('congestion', (ev)=>{
+    _streamLive = true;
+    try{ renderCongestion(JSON.parse(ev.data)); }catch(e){}
+  });
+  es.addEventListener('bike', (ev)=>{
+    _streamLive = true;
+    try{
+      _lastBike = JSON.parse(ev.data);
+      renderBike(_lastBike);
+    }catch(e){}
+  });
+}
+
 async function loadRideshare(){
   try{
     const data = await AppUtil.fetchAPI('/rideshare', AppUtil.BASE.rideshareApi);
@@ -158,11 +188,18 @@ function updateBusTitles(){
 }
 
 async function refresh(){
-  await Promise.all([loadBus(), loadCongestion(), loadBike(), loadRideshare()]);
+  const tasks = [loadBus(), loadRideshare()];
+  if(_streamLive){
+    if(_lastBike) renderBike(_lastBike);
+  }else{
+    tasks.push(loadCongestion(), loadBike());
+  }
+  await Promise.all(tasks);
 }
 
 setInterval(refresh, 30000);
 initToggle();
+initStream();
 // set external rideshare link from constant
 (function(){
   const a = document.getElementById('rs-link');
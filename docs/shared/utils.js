@@ -2,7 +2,7 @@
 (function(){
 
   async function fetchFrom(url){
-    const res = await fetch(url, {cache:'no-store'});
+    const res = await fetch(url, {cache:'no-cache'});
     if(!res.ok) throw new Error(`${url} ${res.status}`);
     return res.json();
   }